@@ -0,0 +1,213 @@
+"""Versioned JSON API for Blogly.
+
+    GET /api/v1/<resource>             keyset-paginated list
+    GET /api/v1/<resource>/<id>        single row
+    GET /api/v1/<resource>/export      every row, streamed as NDJSON
+    GET /api/v1/<resource>/typeahead   ?q=prefix matches for form pickers
+    POST /api/v1/<resource>/import     bulk import of a CSV or NDJSON body
+    GET /api/v1/jobs/<id>              status of a background import
+
+where resource is users, posts, tags or posts_tags (list and export only).
+Each endpoint accepts ``?fields=a,b`` to select which columns are fetched
+and returned. Exports read through a server-side cursor, so memory stays
+constant and the first rows are sent before the query finishes.
+
+Imports with ``?background=1`` are queued as a job and answered with 202
+and the job's URL. An Idempotency-Key header makes a repeated upload
+return the first upload's job instead of importing twice.
+"""
+
+import datetime
+import io
+import json
+
+from flask import Blueprint, Response, abort, jsonify, request, stream_with_context
+from werkzeug.exceptions import HTTPException
+
+from identity import identities
+from importer import FORMATS, import_stream
+from jobs import enqueue
+from models import db, User, Post, Tag, PostTag, Job
+from pagination import paginate
+import queries
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+EXPORT_BATCH_SIZE = 1000
+
+TYPEAHEAD_LIMIT = 10
+TYPEAHEAD_MAX_LIMIT = 50
+
+
+class Resource:
+    """A model exposed through the API"""
+
+    def __init__(self, model, fields, sort_keys, descending=False):
+        self.model = model
+        self.fields = fields
+        self.sort_keys = sort_keys
+        self.descending = descending
+        self.primary_key = list(model.__table__.primary_key.columns.keys())
+
+    def columns(self, names):
+        return [getattr(self.model, name) for name in names]
+
+
+RESOURCES = {
+    'users': Resource(User,
+                      ['id', 'first_name', 'last_name', 'image_url', 'updated_at'],
+                      [User.last_name, User.first_name, User.id]),
+    'posts': Resource(Post,
+                      ['id', 'title', 'content', 'created_at', 'updated_at', 'user_id'],
+                      [Post.created_at, Post.id],
+                      descending=True),
+    'tags': Resource(Tag,
+                     ['id', 'name', 'updated_at'],
+                     [Tag.name, Tag.id]),
+    'posts_tags': Resource(PostTag,
+                           ['post_id', 'tag_id'],
+                           [PostTag.post_id, PostTag.tag_id]),
+}
+
+
+def _json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def serialize(row, fields):
+    """Return dict of the requested fields of a result row"""
+
+    return {field: _json_value(getattr(row, field)) for field in fields}
+
+
+def requested_fields(resource):
+    """Return the fields named in ?fields=, or all fields; 400 if unknown"""
+
+    fields = request.args.get('fields')
+    if not fields:
+        return resource.fields
+
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = set(fields) - set(resource.fields)
+    if unknown:
+        abort(400, description=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    return fields
+
+
+def select(resource, fields, extra=()):
+    """Return query fetching only fields plus the extra column names"""
+
+    names = list(dict.fromkeys([*fields, *extra]))
+    return db.session.query(*resource.columns(names))
+
+
+@api.errorhandler(HTTPException)
+def json_error(e):
+    """Return errors raised by API views as JSON"""
+
+    return jsonify(error=e.name, description=e.description), e.code
+
+
+@api.route('/<any(users, posts, tags, posts_tags):name>')
+def list_rows(name):
+    """Return a page of rows as JSON, with the cursor of the next page"""
+
+    resource = RESOURCES[name]
+    fields = requested_fields(resource)
+    keys = [key.key for key in resource.sort_keys]
+
+    page = paginate(select(resource, fields, keys),
+                    resource.sort_keys, descending=resource.descending)
+
+    return jsonify(data=[serialize(row, fields) for row in page],
+                   next_cursor=page.next_cursor,
+                   prev_cursor=page.prev_cursor)
+
+
+@api.route('/<any(users, posts, tags):name>/<int:row_id>')
+def show_row(name, row_id):
+    """Return a single row as JSON"""
+
+    resource = RESOURCES[name]
+    fields = requested_fields(resource)
+
+    row = select(resource, fields).filter(resource.model.id == row_id).first()
+    if row is None:
+        abort(404)
+
+    return jsonify(data=serialize(row, fields))
+
+
+@api.route('/<any(users, posts, tags, posts_tags):name>/export')
+def export_rows(name):
+    """Stream every row as newline-delimited JSON, in primary key order"""
+
+    resource = RESOURCES[name]
+    fields = requested_fields(resource)
+
+    query = (select(resource, fields)
+             .order_by(*resource.columns(resource.primary_key))
+             .yield_per(EXPORT_BATCH_SIZE))
+
+    def generate():
+        for row in query:
+            yield json.dumps(serialize(row, fields)) + "\n"
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+@api.route('/<any(posts, tags):name>/typeahead')
+def typeahead(name):
+    """Return posts or tags whose title or name starts with ?q="""
+
+    prefix = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', TYPEAHEAD_LIMIT, type=int), TYPEAHEAD_MAX_LIMIT)
+    if not prefix or limit < 1:
+        return jsonify(data=[])
+
+    if name == 'tags':
+        cards = identities.tags_starting_with(prefix, limit)
+        if cards is not None:
+            return jsonify(data=[{"id": card.id, "label": card.name} for card in cards])
+
+    column = Post.title if name == 'posts' else Tag.name
+    rows = queries.typeahead(column, prefix, limit)
+    return jsonify(data=[{"id": row.id, "label": row.label} for row in rows])
+
+
+@api.route('/<any(users, posts, tags):name>/import', methods=["POST"])
+def import_rows(name):
+    """Bulk import the CSV or NDJSON request body and report the result"""
+
+    fmt = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    if request.args.get('format'):
+        fmt = request.args['format']
+    if fmt not in FORMATS:
+        abort(400, description=f"Unknown format {fmt!r}")
+
+    body = request.get_data(as_text=True)
+
+    if request.args.get('background'):
+        key = request.headers.get('Idempotency-Key')
+        job_id = enqueue('import', key=key and f"import:{name}:{key}",
+                         kind=name, body=body, fmt=fmt)
+        db.session.commit()
+        return jsonify(job=job_id), 202, {'Location': f"/api/v1/jobs/{job_id}"}
+
+    report = import_stream(name, io.StringIO(body), fmt)
+
+    return jsonify(report.to_dict())
+
+
+@api.route('/jobs/<int:job_id>')
+def show_job(job_id):
+    """Return the status of a background job, with its result when done"""
+
+    job = Job.query.get_or_404(job_id)
+    return jsonify(data={"id": job.id, "task": job.task, "status": job.status,
+                         "attempts": job.attempts, "last_error": job.last_error,
+                         "result": job.result})
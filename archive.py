@@ -0,0 +1,325 @@
+"""Archival of old posts out of the hot posts table.
+
+posts only has to hold recent months for the home page, the timelines
+and search to stay in memory. Older posts move down two tiers:
+
+1. ``flask archive posts --months 12`` moves the posts created before the
+   last 12 whole months to archived_posts, one month per transaction.
+   That table is range partitioned by created_at, with a partition per
+   month. Moved posts leave their author's and tags' pages as deleted
+   posts do, with the counters adjusted.
+2. ``flask archive export --months 24`` writes each archived month older
+   than that to ARCHIVE_DIR/posts-YYYY-MM.ndjson.gz, records the file in
+   archive_files and drops the month's partition.
+
+/posts/<id> falls back to archived_posts and then to the file whose id
+range holds the id, so links to old posts keep working; archived posts
+are read only. Files hold `flask import posts` records, so importing one
+restores its posts.
+
+posts itself is not partitioned: unique constraints of a partitioned table
+must include the partition key, which would drop the unique post titles
+and the posts_tags foreign key on posts.id.
+"""
+
+import datetime
+import functools
+import gzip
+import json
+import os
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from counters import adjust_counts
+from models import db, User, Post, Tag, PostTag, ArchivedPost, ArchiveFile
+
+PARTITION_PREFIX = "archived_posts_"
+
+# Fields of the exported records, id first so a file is searched by prefix
+RECORD_FIELDS = ('id', 'title', 'content', 'created_at', 'updated_at', 'user_id', 'tags')
+
+
+def month_start(day):
+    """Return the first day of day's month"""
+
+    return datetime.date(day.year, day.month, 1)
+
+
+def add_months(month, months):
+    """Return the first day of the month months after month"""
+
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def cutoff_month(months, today=None):
+    """Return the first day of the month months whole months before today's"""
+
+    return add_months(month_start(today or datetime.date.today()), -months)
+
+
+def partition_name(month):
+    return f"{PARTITION_PREFIX}{month:%Y_%m}"
+
+
+def partition_months():
+    """Return the months of archived_posts' partitions, oldest first"""
+
+    names = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'archived_posts'::regclass")).scalars()
+    return sorted(datetime.datetime.strptime(name[len(PARTITION_PREFIX):], "%Y_%m").date()
+                  for name in names)
+
+
+def _in_month(column, month):
+    return db.and_(column >= month, column < add_months(month, 1))
+
+
+###########################################################################
+
+# Moving posts to archived_posts
+
+def archive_month(month):
+    """Move the posts created in month to archived_posts; return how many"""
+
+    in_month = _in_month(Post.created_at, month)
+
+    # Lock the month's posts, so no edit lands between copying and deleting
+    locked = select(Post.id).where(in_month).with_for_update().subquery()
+    count = db.session.execute(select(func.count()).select_from(locked)).scalar()
+    if not count:
+        return 0
+
+    db.session.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF archived_posts "
+        f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"))
+
+    tag_names = func.array(select(Tag.name)
+                           .join(PostTag, PostTag.tag_id == Tag.id)
+                           .where(PostTag.post_id == Post.id)
+                           .order_by(Tag.name)
+                           .scalar_subquery())
+    rows = select(Post.id, Post.created_at, Post.title, Post.content, Post.updated_at,
+                  Post.user_id, tag_names, db.literal(datetime.datetime.utcnow()))
+    db.session.execute(insert(ArchivedPost.__table__).from_select(
+        ['id', 'created_at', 'title', 'content', 'updated_at', 'user_id', 'tags',
+         'archived_at'],
+        rows.where(in_month)))
+
+    # Authors and tags lose the posts, as when they are deleted
+    authors = db.session.query(Post.user_id).filter(in_month).distinct()
+    authored = (select(func.count())
+                .where(Post.user_id == User.id, in_month)
+                .scalar_subquery())
+    adjust_counts(User.post_count, authors, -authored)
+
+    moved = db.session.query(Post.id).filter(in_month)
+    tagged = (db.session.query(PostTag.tag_id)
+              .filter(PostTag.post_id.in_(moved))
+              .distinct())
+    lost = (select(func.count())
+            .where(PostTag.tag_id == Tag.id, PostTag.post_id.in_(moved))
+            .scalar_subquery())
+    adjust_counts(Tag.post_count, tagged, -lost)
+
+    # ON DELETE CASCADE removes their tag links
+    Post.query.filter(in_month).delete(synchronize_session=False)
+    return count
+
+
+def archive_posts(cutoff):
+    """Move the posts created before cutoff, a month's first day, to archived_posts.
+
+    Commits after each month; returns {month: posts moved}.
+    """
+
+    oldest = db.session.query(func.min(Post.created_at)).scalar()
+    moved = {}
+    month = oldest and month_start(oldest)
+    while month and month < cutoff:
+        count = archive_month(month)
+        db.session.commit()
+        if count:
+            moved[month] = count
+        month = add_months(month, 1)
+    return moved
+
+
+###########################################################################
+
+# Exporting archived months to files
+
+def to_record(post):
+    """Return the export record of an archived post"""
+
+    record = {field: getattr(post, field) for field in RECORD_FIELDS}
+    for field in ('created_at', 'updated_at'):
+        record[field] = record[field].isoformat()
+    return record
+
+
+def archive_path(directory, month):
+    return os.path.join(os.path.abspath(directory), f"posts-{month:%Y-%m}.ndjson.gz")
+
+
+def export_month(month, directory):
+    """Write month's archived posts to a file in directory and drop its partition.
+
+    Posts archived into a month already exported are added to its file.
+    Returns the number of posts written.
+    """
+
+    in_month = _in_month(ArchivedPost.created_at, month)
+    fresh = set(db.session.execute(select(ArchivedPost.id).where(in_month)).scalars())
+    previous = ArchiveFile.query.get(month)
+
+    path = archive_path(directory, month)
+    ids = list(fresh)
+    with gzip.open(f"{path}.tmp", 'wt', encoding='utf-8') as out:
+        if previous is not None:
+            for line in _lines(previous.path):
+                post_id = json.loads(line)['id']
+                if post_id not in fresh:
+                    ids.append(post_id)
+                    out.write(line)
+        posts = (ArchivedPost.query
+                 .filter(in_month)
+                 .order_by(ArchivedPost.id)
+                 .yield_per(1000))
+        for post in posts:
+            out.write(json.dumps(to_record(post)) + "\n")
+
+    if ids:
+        os.replace(f"{path}.tmp", path)
+        values = {'path': path, 'min_id': min(ids), 'max_id': max(ids), 'posts': len(ids),
+                  'exported_at': datetime.datetime.utcnow()}
+        db.session.execute(insert(ArchiveFile.__table__)
+                           .values(month=month, **values)
+                           .on_conflict_do_update(index_elements=['month'], set_=values))
+    else:
+        os.remove(f"{path}.tmp")
+
+    db.session.execute(text(f"DROP TABLE {partition_name(month)}"))
+    db.session.commit()
+    return len(ids)
+
+
+def export_archive(cutoff, directory):
+    """Export the archived months before cutoff to directory; return {month: posts}"""
+
+    os.makedirs(directory, exist_ok=True)
+    return {month: export_month(month, directory)
+            for month in partition_months() if month < cutoff}
+
+
+def _lines(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as lines:
+        yield from lines
+
+
+@functools.lru_cache(maxsize=1024)
+def _find_line(path, mtime_ns, post_id):
+    prefix = f'{{"id": {post_id},'
+    for line in _lines(path):
+        if line.startswith(prefix):
+            return line
+    return None
+
+
+def read_record(path, post_id):
+    """Return the record of post_id in the archive file at path, or None"""
+
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    line = _find_line(path, mtime_ns, post_id)
+    return None if line is None else json.loads(line)
+
+
+def from_record(record):
+    """Return an unsaved ArchivedPost holding an exported record"""
+
+    return ArchivedPost(id=record['id'],
+                        title=record['title'],
+                        content=record['content'],
+                        created_at=datetime.datetime.fromisoformat(record['created_at']),
+                        updated_at=datetime.datetime.fromisoformat(record['updated_at']),
+                        user_id=record['user_id'],
+                        tags=record['tags'])
+
+
+###########################################################################
+
+# Reading archived posts
+
+def archived_statement(post_id):
+    return select(ArchivedPost).where(ArchivedPost.id == post_id)
+
+
+def files_statement(post_id):
+    return (select(ArchiveFile)
+            .where(ArchiveFile.min_id <= post_id, ArchiveFile.max_id >= post_id)
+            .order_by(ArchiveFile.month))
+
+
+def tags_statement(names):
+    return select(Tag).where(Tag.name.in_(names)).order_by(Tag.name)
+
+
+def find_in_files(files, post_id):
+    """Return post_id's record from the first of files holding it, or None"""
+
+    for archive_file in files:
+        record = read_record(archive_file.path, post_id)
+        if record is not None:
+            return record
+    return None
+
+
+def find_archived_post(post_id):
+    """Return archived post post_id, from archived_posts or a file, or None"""
+
+    post = db.session.execute(archived_statement(post_id)).scalars().first()
+    if post is None:
+        files = db.session.execute(files_statement(post_id)).scalars().all()
+        record = find_in_files(files, post_id)
+        post = record and from_record(record)
+    return post
+
+
+###########################################################################
+
+# Command line
+
+archive_cli = AppGroup('archive', help="Move old posts out of the posts table.")
+
+
+@archive_cli.command('posts')
+@click.option('--months', default=12, show_default=True,
+              help="Whole months of posts to keep in posts.")
+def posts_command(months):
+    """Move posts older than MONTHS whole months to archived_posts."""
+
+    moved = archive_posts(cutoff_month(months))
+    for month, count in moved.items():
+        click.echo(f"{month:%Y-%m}: archived {count} posts.")
+    click.echo(f"Archived {sum(moved.values())} posts.")
+
+
+@archive_cli.command('export')
+@click.option('--months', default=24, show_default=True,
+              help="Whole months of archived posts to keep in archived_posts.")
+def export_command(months):
+    """Export archived months older than MONTHS whole months to ARCHIVE_DIR."""
+
+    directory = current_app.config['ARCHIVE_DIR']
+    exported = export_archive(cutoff_month(months), directory)
+    for month, count in exported.items():
+        click.echo(f"{month:%Y-%m}: exported {count} posts to {archive_path(directory, month)}.")
+    click.echo(f"Exported {len(exported)} months.")
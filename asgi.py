@@ -0,0 +1,337 @@
+"""Async ASGI serving mode for Blogly's read pages.
+
+    uvicorn --factory asgi:create_asgi_app --workers 4
+
+The home page, posts, users, tags and their listings are loaded through an
+AsyncSession on an asyncpg engine, so one worker keeps many readers in
+flight on a single thread while each waits on PostgreSQL. Every other
+request, including all forms and writes, is handed to the Flask app on a
+thread pool, so the ASGI server runs the whole site.
+
+The async routes load what their template touches eagerly, then render the
+same templates inside a Flask request context pushed only for rendering,
+so flashes, the session cookie, cursor links and the page cache work as
+in the Flask views. They skip the ETag check, whose fingerprints are
+synchronous queries.
+
+``flask bench concurrent`` compares this mode with the Flask views.
+"""
+
+import asyncio
+import io
+import sys
+import time
+
+from flask import render_template, request
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import configure_mappers, joinedload, selectinload, sessionmaker
+from werkzeug.exceptions import HTTPException, MethodNotAllowed, NotFound
+from werkzeug.routing import Map, Rule
+from werkzeug.urls import url_decode
+
+import archive
+import queries
+import related
+from cache import page_cache
+from metrics import request_seconds, requests_total
+from models import User, Post, Tag, PostTag
+from pagination import build_page, keyset
+
+ENGINE_OPTIONS = ('pool_size', 'max_overflow', 'pool_recycle', 'pool_pre_ping')
+
+
+def async_database_uri(config):
+    """Return the asyncpg URI of the async read routes' database"""
+
+    if config.get('ASYNC_DATABASE_URI'):
+        return config['ASYNC_DATABASE_URI']
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    return str(url.set(drivername='postgresql+asyncpg'))
+
+
+###########################################################################
+
+# Read routes
+#
+# Each returns (template, context) or raises an HTTPException. args are
+# the query string arguments; nothing may be lazy loaded afterwards.
+
+async def _page(session, statement, keys, args, per_page, descending=False):
+    cursor = args.get('cursor')
+    statement, direction = keyset(statement, keys, descending, cursor, per_page)
+    rows = (await session.execute(statement)).scalars().all()
+    return build_page(rows, keys, direction, cursor, per_page)
+
+
+async def home(session, args, per_page):
+    posts = (await session.execute(
+        select(Post)
+        .options(joinedload(Post.user), selectinload(Post.tags))
+        .order_by(Post.created_at.desc(), Post.id.desc())
+        .limit(5))).scalars().all()
+    return 'posts/homepage.html', {'posts': posts}
+
+
+async def show_post(session, args, per_page, post_id):
+    post = await session.get(Post, post_id,
+                             options=[joinedload(Post.user), selectinload(Post.tags)])
+    if post is None:
+        return await show_archived_post(session, post_id)
+    return 'posts/post_details.html', {'post': post,
+                                       'related': await _related(session, post)}
+
+
+async def show_archived_post(session, post_id):
+    post = (await session.execute(archive.archived_statement(post_id))).scalars().first()
+    if post is None:
+        files = (await session.execute(archive.files_statement(post_id))).scalars().all()
+        record = await asyncio.get_running_loop().run_in_executor(
+            None, archive.find_in_files, files, post_id)
+        post = record and archive.from_record(record)
+    author = post and await session.get(User, post.user_id)
+    if author is None:
+        raise NotFound()
+    tags = (await session.execute(archive.tags_statement(post.tags))).scalars().all()
+    return 'posts/archived_post.html', {'post': post, 'author': author, 'tags': tags}
+
+
+async def _related(session, post):
+    tag_ids = [tag.id for tag in post.tags]
+    if not tag_ids:
+        return []
+    companions = (await session.execute(related.companions_statement(tag_ids))).all()
+    expanded = set(tag_ids) | {row.other_id for row in companions}
+    candidates = (await session.execute(
+        related.candidates_statement(post.id, expanded))).all()
+    ids = related.rank(tag_ids, companions, candidates)
+    rows = (await session.execute(
+        select(Post.id, Post.title).where(Post.id.in_(ids)))).all()
+    by_id = {row.id: row for row in rows}
+    return [by_id[post_id] for post_id in ids if post_id in by_id]
+
+
+async def show_all_users(session, args, per_page):
+    popular = args.get('sort') == 'popular'
+    keys = queries.USER_POPULAR_KEYS if popular else queries.USER_KEYS
+    users = await _page(session, select(User), keys, args, per_page, popular)
+    return 'users/index.html', {'users': users, 'popular': popular}
+
+
+async def show_user_details(session, args, per_page, user_id):
+    user = await session.get(User, user_id)
+    if user is None:
+        raise NotFound()
+    posts = await _page(session, select(Post).where(Post.user_id == user_id),
+                        queries.POST_KEYS, args, per_page, descending=True)
+    return 'users/details.html', {'user': user, 'posts': posts}
+
+
+async def show_all_tags(session, args, per_page):
+    popular = args.get('sort') == 'popular'
+    keys = queries.TAG_POPULAR_KEYS if popular else queries.TAG_KEYS
+    tags = await _page(session, select(Tag), keys, args, per_page, popular)
+    return 'tags/index.html', {'tags': tags, 'popular': popular}
+
+
+async def show_tag(session, args, per_page, tag_id):
+    tag = await session.get(Tag, tag_id)
+    if tag is None:
+        raise NotFound()
+    timeline = select(Post).join(PostTag).where(PostTag.tag_id == tag_id)
+    posts = await _page(session, timeline, queries.TAG_TIMELINE_KEYS, args, per_page,
+                        descending=True)
+    return 'tags/tag_details.html', {'tag': tag, 'posts': posts}
+
+
+# Other methods fall through to Flask, which answers them with 405 or
+# sends them through its hooks, the rate limiter's included
+READ_METHODS = ['GET', 'HEAD']
+
+# Pages whose Flask views are cached by page_cache are cached here too
+READ_ROUTES = Map([
+    Rule('/', endpoint=(home, True), methods=READ_METHODS),
+    Rule('/posts/<int:post_id>', endpoint=(show_post, True), methods=READ_METHODS),
+    Rule('/users', endpoint=(show_all_users, False), methods=READ_METHODS),
+    Rule('/users/<int:user_id>', endpoint=(show_user_details, True), methods=READ_METHODS),
+    Rule('/tags', endpoint=(show_all_tags, False), methods=READ_METHODS),
+    Rule('/tags/<int:tag_id>', endpoint=(show_tag, True), methods=READ_METHODS),
+], strict_slashes=False)
+
+
+###########################################################################
+
+# ASGI plumbing
+
+def wsgi_environ(scope, body):
+    """Return the WSGI environ of an ASGI http scope and its request body"""
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    # The body has been read whole, chunked or not
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    """Run wsgi_app on environ; return (status code, headers, body)"""
+
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split()[0]), headers]
+
+    iterable = wsgi_app(environ, start_response)
+    try:
+        body = b"".join(iterable)
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+    return started[0], started[1], body
+
+
+async def _receive_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b""))
+        if not message.get('more_body'):
+            return b"".join(chunks)
+
+
+async def _send_response(send, status, headers, body):
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_request(asgi_app, method, path, body=b"", headers=()):
+    """Send one request to asgi_app in process; return (status code, body)"""
+
+    path, _, query = path.partition('?')
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query.encode(), 'http_version': '1.1',
+             'headers': [(name.lower().encode(), value.encode()) for name, value in headers]}
+    messages = [{'type': 'http.request', 'body': body}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+    return sent[0]['status'], b"".join(message.get('body', b"") for message in sent[1:])
+
+
+class AsyncReads:
+    """ASGI app serving READ_ROUTES asynchronously and the rest with flask_app"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        options = flask_app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        self.engine = create_async_engine(
+            async_database_uri(flask_app.config),
+            **{name: options[name] for name in ENGINE_OPTIONS if name in options})
+        self.sessionmaker = sessionmaker(self.engine, class_=AsyncSession,
+                                         expire_on_commit=False)
+        # Backrefs like Post.user exist only once the mappers are configured
+        configure_mappers()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+
+        environ = wsgi_environ(scope, await _receive_body(receive))
+        try:
+            (view, cached), view_args = READ_ROUTES.bind_to_environ(environ).match()
+        except (NotFound, MethodNotAllowed):
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, call_wsgi, self.flask_app, environ)
+        else:
+            response = await self.read(view, cached, view_args, environ)
+        await _send_response(send, *response)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read(self, view, cached, view_args, environ):
+        """Serve a read route; return (status code, headers, body)"""
+
+        start = time.perf_counter()
+        cache_key = page = None
+        if cached:
+            with self.flask_app.request_context(environ):
+                cache_key, page = page_cache.get_page("html")
+
+        error = template = context = None
+        if page is None:
+            args = url_decode(environ['QUERY_STRING'])
+            per_page = self.flask_app.config['PAGE_SIZE']
+            try:
+                # The connection goes back to the pool before rendering
+                async with self.sessionmaker() as session:
+                    template, context = await view(session, args, per_page, **view_args)
+            except HTTPException as e:
+                error = e
+
+        with self.flask_app.request_context(environ):
+            try:
+                if error is not None:
+                    raise error
+                if page is None:
+                    page = render_template(template, **context)
+                    page_cache.store_page(cache_key, page)
+                rv = page
+            except HTTPException as e:
+                rv = self.flask_app.handle_http_exception(e)
+
+            response = self.flask_app.process_response(self.flask_app.make_response(rv))
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            request_seconds.observe(time.perf_counter() - start, route=route)
+            requests_total.inc(route=route, method=request.method,
+                               status=response.status_code)
+            return call_wsgi(response, environ)
+
+
+def create_asgi_app(config_name=None):
+    """Return the ASGI app for config_name, as create_app() takes it"""
+
+    from app import create_app
+
+    return AsyncReads(create_app(config_name))
@@ -0,0 +1,68 @@
+"""Set-difference updates of the posts_tags association.
+
+Replacing ``post.tags`` or ``tag.posts`` through the ORM loads the whole
+collection, diffs it in Python and writes one row per change. Here the
+delta is computed by PostgreSQL instead: one DELETE drops the links that
+are no longer wanted and one INSERT ... SELECT adds the missing ones, both
+returning the ids they changed. Nothing is loaded, so a rename that keeps
+a tag's thousands of posts costs the same as one with none, and the
+counters from counters.py are adjusted by exactly the delta.
+"""
+
+from sqlalchemy import Integer, delete, literal, select
+from sqlalchemy.dialects.postgresql import insert
+
+from counters import adjust_counts
+from models import db, Post, Tag, PostTag
+
+
+def _replace_links(owner, owner_id, other, other_model, wanted):
+    """Make other_model ids in wanted the only links of owner_id.
+
+    owner and other are the posts_tags columns of the two sides. Ids in
+    wanted without a row in other_model are ignored. Returns the lists of
+    (added, removed) ids.
+    """
+
+    wanted = sorted(set(wanted))
+
+    stmt = delete(PostTag.__table__).where(owner == owner_id)
+    if wanted:
+        stmt = stmt.where(other.notin_(wanted))
+    removed = db.session.execute(stmt.returning(other)).scalars().all()
+
+    added = []
+    if wanted:
+        rows = (select(literal(owner_id, Integer), other_model.id)
+                .where(other_model.id.in_(wanted)))
+        stmt = (insert(PostTag.__table__)
+                .from_select([owner.key, other.key], rows)
+                .on_conflict_do_nothing()
+                .returning(other))
+        added = db.session.execute(stmt).scalars().all()
+
+    return added, removed
+
+
+def set_post_tags(post, tag_ids):
+    """Make tag_ids the tags of post; return (added, removed) tag ids"""
+
+    added, removed = _replace_links(PostTag.post_id, post.id, PostTag.tag_id, Tag, tag_ids)
+    if added or removed:
+        adjust_counts(Post.tag_count, [post.id], len(added) - len(removed))
+        adjust_counts(Tag.post_count, added, 1)
+        adjust_counts(Tag.post_count, removed, -1)
+        db.session.expire(post, ['tags', 'tag_count', 'updated_at'])
+    return added, removed
+
+
+def set_tag_posts(tag, post_ids):
+    """Make post_ids the posts of tag; return (added, removed) post ids"""
+
+    added, removed = _replace_links(PostTag.tag_id, tag.id, PostTag.post_id, Post, post_ids)
+    if added or removed:
+        adjust_counts(Tag.post_count, [tag.id], len(added) - len(removed))
+        adjust_counts(Post.tag_count, added, 1)
+        adjust_counts(Post.tag_count, removed, -1)
+        db.session.expire(tag, ['post_count', 'updated_at'])
+    return added, removed
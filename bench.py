@@ -0,0 +1,441 @@
+"""Benchmarks for every Blogly route.
+
+Seeds a dedicated database with deterministic synthetic data, then drives
+each route through the test client and reports latency percentiles,
+throughput and SQL statements per request. Results can be saved as a
+baseline and later runs compared against it.
+
+    export BLOGLY_CONFIG=testing TEST_DATABASE_URL=postgresql:///blogly_bench
+    flask db upgrade
+    flask bench seed --users 10000 --posts 1000000 --tags 10000 --yes
+    flask bench run --save bench_baseline.json
+    flask bench run --compare bench_baseline.json
+    flask bench concurrent --concurrency 50
+
+``concurrent`` sends the same reads to the Flask views, from a thread per
+client, and to the async mode of asgi.py, from one event loop.
+
+The same seed and sizes always produce the same rows and the same request
+sequence. PostgreSQL is required, as the schema uses tsvector columns and
+row-value comparisons.
+"""
+
+import asyncio
+import datetime
+import json
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event, insert, text
+
+from cache import NullCache, page_cache
+from counters import reconcile_counts
+from models import db, User, Post, Tag, PostTag
+
+DEFAULT_SEED = 0
+DEFAULT_REQUESTS = 200
+INSERT_BATCH_SIZE = 10000
+MAX_TAGS_PER_POST = 5
+DEFAULT_TOLERANCE = 0.2
+
+WORDS = ("alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo "
+         "lima mike november oscar papa quebec romeo sierra tango uniform "
+         "victor whiskey xray yankee zulu garden river mountain coffee bread "
+         "tomato pepper basil travel music winter summer morning evening").split()
+
+EPOCH = datetime.datetime(2020, 1, 1)
+
+
+###########################################################################
+
+# Synthetic data
+
+def _sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _insert_batches(model, rows):
+    """Insert rows in executemany batches of INSERT_BATCH_SIZE"""
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == INSERT_BATCH_SIZE:
+            db.session.execute(insert(model.__table__), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(model.__table__), batch)
+
+
+def seed_data(users, posts, tags, seed=DEFAULT_SEED):
+    """Replace every row with a deterministic synthetic data set.
+
+    Ids are assigned 1..n in insertion order. Post authors are spread
+    uniformly; tag use is skewed so that a few tags are very popular, as in
+    real blogs.
+    """
+
+    rng = random.Random(seed)
+    span = int((datetime.datetime(2024, 1, 1) - EPOCH).total_seconds())
+
+    db.session.execute(text(
+        "TRUNCATE posts_tags, posts, tags, users RESTART IDENTITY CASCADE"))
+
+    _insert_batches(User, ({"first_name": rng.choice(WORDS).title(),
+                            "last_name": f"{rng.choice(WORDS).title()}{i}"}
+                           for i in range(users)))
+    _insert_batches(Tag, ({"name": f"{rng.choice(WORDS)}-{i}"}
+                          for i in range(tags)))
+    _insert_batches(Post, ({"title": f"{_sentence(rng, 4).title()} {i}",
+                            "content": _sentence(rng, 40),
+                            "user_id": rng.randint(1, users),
+                            "created_at": EPOCH + datetime.timedelta(seconds=rng.randrange(span))}
+                           for i in range(posts)))
+
+    def links():
+        for post_id in range(1, posts + 1):
+            count = rng.randint(0, min(MAX_TAGS_PER_POST, tags))
+            chosen = {min(int(rng.paretovariate(1.2)), tags) for _ in range(count)}
+            for tag_id in sorted(chosen):
+                yield {"post_id": post_id, "tag_id": tag_id}
+
+    _insert_batches(PostTag, links())
+    reconcile_counts()
+    db.session.commit()
+    db.session.execute(text("ANALYZE"))
+
+
+###########################################################################
+
+# Routes under test
+
+def _counts():
+    return {"users": db.session.query(db.func.max(User.id)).scalar() or 0,
+            "posts": db.session.query(db.func.max(Post.id)).scalar() or 0,
+            "tags": db.session.query(db.func.max(Tag.id)).scalar() or 0}
+
+
+def _read(path):
+    def request(client, rng, counts, n):
+        return client.get(path(rng, counts))
+    return request
+
+
+def _create_post(client, rng, counts, n):
+    user_id = rng.randint(1, counts["users"])
+    tag_ids = [str(rng.randint(1, counts["tags"])) for _ in range(2)]
+    return client.post(f"/users/{user_id}/posts/new",
+                       data={"title": f"Bench post {time.time_ns()} {n}",
+                             "content": _sentence(rng, 40),
+                             "tags": tag_ids})
+
+
+def _update_post(client, rng, counts, n):
+    post_id = rng.randint(1, counts["posts"])
+    tag_ids = [str(rng.randint(1, counts["tags"])) for _ in range(3)]
+    return client.post(f"/posts/{post_id}/edit",
+                       data={"title": f"Edited post {post_id}",
+                             "content": _sentence(rng, 40),
+                             "tags": tag_ids})
+
+
+READ_PATHS = {
+    "home": lambda rng, c: "/",
+    "show_all_users": lambda rng, c: "/users",
+    "show_user_details": lambda rng, c: f"/users/{rng.randint(1, c['users'])}",
+    "show_post": lambda rng, c: f"/posts/{rng.randint(1, c['posts'])}",
+    "show_all_tags": lambda rng, c: "/tags",
+    "show_tag": lambda rng, c: f"/tags/{rng.randint(1, c['tags'])}",
+    "show_edit_tag_form": lambda rng, c: f"/tags/{rng.randint(1, c['tags'])}/edit",
+    "search": lambda rng, c: f"/search?q={rng.choice(WORDS)}",
+    "api_posts": lambda rng, c: "/api/v1/posts",
+}
+
+ROUTES = {
+    **{name: _read(path) for name, path in READ_PATHS.items()},
+    "create_post": _create_post,
+    "update_post": _update_post,
+}
+
+# Routes the async mode in asgi.py serves itself
+ASYNC_ROUTES = ("home", "show_all_users", "show_user_details", "show_post",
+                "show_all_tags", "show_tag")
+DEFAULT_CONCURRENCY = 50
+
+
+###########################################################################
+
+# Running and reporting
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of sorted values"""
+
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+class RouteResult:
+    """Timings and query counts of one route's requests"""
+
+    def __init__(self, name, latencies, queries, elapsed, errors):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.queries = queries
+        self.elapsed = elapsed
+        self.errors = errors
+
+    def to_dict(self):
+        ms = [latency * 1000 for latency in self.latencies]
+        return {"requests": len(ms),
+                "errors": self.errors,
+                "p50_ms": round(percentile(ms, 50), 3),
+                "p95_ms": round(percentile(ms, 95), 3),
+                "p99_ms": round(percentile(ms, 99), 3),
+                "max_ms": round(ms[-1], 3) if ms else 0.0,
+                "rps": round(len(ms) / self.elapsed, 1) if self.elapsed else 0.0,
+                "queries_per_request": round(sum(self.queries) / len(self.queries), 2)
+                if self.queries else 0.0}
+
+
+def run_route(app, name, requests, seed=DEFAULT_SEED, warmup=5):
+    """Send requests to the route called name; return a RouteResult"""
+
+    send = ROUTES[name]
+    rng = random.Random(f"{seed}:{name}")
+    counts = _counts()
+    statements = []
+
+    def count(*args):
+        statements[-1] += 1
+
+    with app.test_client() as client:
+        for n in range(warmup):
+            send(client, rng, counts, -n - 1)
+
+        latencies, errors = [], 0
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            started = time.perf_counter()
+            for n in range(requests):
+                statements.append(0)
+                start = time.perf_counter()
+                resp = send(client, rng, counts, n)
+                latencies.append(time.perf_counter() - start)
+                if resp.status_code >= 400:
+                    errors += 1
+            elapsed = time.perf_counter() - started
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+    return RouteResult(name, latencies, statements, elapsed, errors)
+
+
+def run_benchmarks(app, names=None, requests=DEFAULT_REQUESTS, seed=DEFAULT_SEED):
+    """Return {route name: result dict} for the named routes, or all of them.
+
+    The page cache is switched off while running, so every request does
+    the route's real database and template work.
+    """
+
+    backend = page_cache.backend
+    page_cache.backend = NullCache()
+    try:
+        return {name: run_route(app, name, requests, seed).to_dict()
+                for name in (names or ROUTES)}
+    finally:
+        page_cache.backend = backend
+
+
+def _timed_results(name, timings, elapsed, statements):
+    """Return a RouteResult of concurrent (latency, status) timings.
+
+    Statements of concurrent requests cannot be told apart, so the
+    per-request count is the average.
+    """
+
+    return RouteResult(name, [latency for latency, status in timings],
+                       [statements / len(timings)] if timings else [], elapsed,
+                       sum(status >= 400 for latency, status in timings))
+
+
+def run_sync_concurrent(app, name, paths, concurrency):
+    """GET paths through the Flask app from concurrency threads"""
+
+    def get(path):
+        start = time.perf_counter()
+        status = app.test_client().get(path).status_code
+        return time.perf_counter() - start, status
+
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            timings = list(pool.map(get, paths))
+        elapsed = time.perf_counter() - started
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+
+    return _timed_results(name, timings, elapsed, statements[0])
+
+
+def run_async_concurrent(app, name, paths, concurrency):
+    """GET paths through the async mode with concurrency requests in flight"""
+
+    from asgi import AsyncReads, send_request
+
+    reads = AsyncReads(app)
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    async def get(path, gate):
+        async with gate:
+            start = time.perf_counter()
+            status, body = await send_request(reads, "GET", path)
+            return time.perf_counter() - start, status
+
+    async def get_all():
+        gate = asyncio.Semaphore(concurrency)
+        try:
+            started = time.perf_counter()
+            timings = await asyncio.gather(*(get(path, gate) for path in paths))
+            return timings, time.perf_counter() - started
+        finally:
+            await reads.engine.dispose()
+
+    event.listen(reads.engine.sync_engine, "before_cursor_execute", count)
+    timings, elapsed = asyncio.run(get_all())
+    return _timed_results(name, timings, elapsed, statements[0])
+
+
+def run_concurrent(app, names=None, requests=DEFAULT_REQUESTS, seed=DEFAULT_SEED,
+                   concurrency=DEFAULT_CONCURRENCY):
+    """Return {"route sync"/"route async": result dict} for the async routes.
+
+    Both modes get the same request sequence, from concurrency clients at
+    once, with the page cache switched off.
+    """
+
+    backend = page_cache.backend
+    page_cache.backend = NullCache()
+    counts = _counts()
+    results = {}
+    try:
+        for name in names or ASYNC_ROUTES:
+            rng = random.Random(f"{seed}:{name}")
+            paths = [READ_PATHS[name](rng, counts) for _ in range(requests)]
+            for mode, run in (("sync", run_sync_concurrent), ("async", run_async_concurrent)):
+                label = f"{name} {mode}"
+                results[label] = run(app, label, paths, concurrency).to_dict()
+    finally:
+        page_cache.backend = backend
+    return results
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Return list of regression messages of results against baseline.
+
+    A route regresses when its p95 latency grows by more than tolerance
+    (a fraction) or it runs more queries per request than before.
+    """
+
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {result['p95_ms']}ms")
+        if result["queries_per_request"] > before["queries_per_request"]:
+            regressions.append(f"{name}: queries/request {before['queries_per_request']}"
+                               f" -> {result['queries_per_request']}")
+    return regressions
+
+
+def format_table(results):
+    """Return results as a plain text table"""
+
+    header = f"{'route':<24} {'reqs':>5} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} " \
+             f"{'p99 ms':>9} {'req/s':>8} {'queries':>8}"
+    lines = [header, "-" * len(header)]
+    for name, r in results.items():
+        lines.append(f"{name:<24} {r['requests']:>5} {r['errors']:>4} {r['p50_ms']:>9.2f} "
+                     f"{r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['rps']:>8.1f} "
+                     f"{r['queries_per_request']:>8.2f}")
+    return "\n".join(lines)
+
+
+###########################################################################
+
+# Command line
+
+bench_cli = AppGroup('bench', help="Seed benchmark data and benchmark routes.")
+
+
+@bench_cli.command('seed')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--posts', default=20000, show_default=True)
+@click.option('--tags', default=500, show_default=True)
+@click.option('--seed', default=DEFAULT_SEED, show_default=True)
+@click.confirmation_option(prompt="This deletes every user, post and tag. Continue?")
+def seed_command(users, posts, tags, seed):
+    """Replace the database contents with synthetic data."""
+
+    started = time.perf_counter()
+    seed_data(users, posts, tags, seed)
+    click.echo(f"Seeded {users} users, {posts} posts and {tags} tags "
+               f"in {time.perf_counter() - started:.1f}s.")
+
+
+@bench_cli.command('run')
+@click.option('--route', 'routes', multiple=True, type=click.Choice(list(ROUTES)),
+              help="Route to benchmark; repeat for several. Default: all.")
+@click.option('--requests', default=DEFAULT_REQUESTS, show_default=True)
+@click.option('--seed', default=DEFAULT_SEED, show_default=True)
+@click.option('--save', type=click.Path(dir_okay=False), help="Write results as a baseline.")
+@click.option('--compare', 'baseline', type=click.File('r'), help="Baseline to compare with.")
+@click.option('--tolerance', default=DEFAULT_TOLERANCE, show_default=True,
+              help="Allowed p95 growth against the baseline, as a fraction.")
+def run_command(routes, requests, seed, save, baseline, tolerance):
+    """Benchmark routes and report latency, throughput and query counts."""
+
+    results = run_benchmarks(current_app._get_current_object(), routes, requests, seed)
+    click.echo(format_table(results))
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if baseline:
+        regressions = compare(results, json.load(baseline), tolerance)
+        for regression in regressions:
+            click.echo(f"REGRESSION {regression}", err=True)
+        if regressions:
+            sys.exit(1)
+
+
+@bench_cli.command('concurrent')
+@click.option('--route', 'routes', multiple=True, type=click.Choice(ASYNC_ROUTES),
+              help="Route to benchmark; repeat for several. Default: all async routes.")
+@click.option('--requests', default=DEFAULT_REQUESTS, show_default=True)
+@click.option('--concurrency', default=DEFAULT_CONCURRENCY, show_default=True)
+@click.option('--seed', default=DEFAULT_SEED, show_default=True)
+def concurrent_command(routes, requests, concurrency, seed):
+    """Compare the Flask views with the async mode under concurrent load."""
+
+    results = run_concurrent(current_app._get_current_object(), routes, requests, seed,
+                             concurrency)
+    click.echo(format_table(results))
@@ -0,0 +1,209 @@
+"""Rendered page cache for Blogly.
+
+Read views decorated with ``page_cache.cached`` store their rendered HTML
+under a key made of the request path and a cache generation number. Every
+database commit bumps the generation, so all cached pages are invalidated
+as soon as a write lands. A client that has just written bypasses the cache
+for one timeout period, which covers other workers whose in-process cache
+has not seen the new generation yet.
+
+Backends are chosen with the ``CACHE_TYPE`` setting: ``"simple"`` (an
+in-process LRU with TTL, the default), ``"redis"`` (any Redis-compatible
+server at ``CACHE_REDIS_URL``, shared by all workers) or ``"null"``.
+"""
+
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from flask import has_request_context, request, session
+from sqlalchemy import event
+
+GENERATION_KEY = "blogly:generation"
+LAST_WRITE_KEY = "_last_write"
+
+
+class NullCache:
+    """Cache backend that stores nothing"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def generation(self):
+        return 0
+
+    def bump_generation(self):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache:
+    """In-process cache evicting least recently used entries and expired ones"""
+
+    def __init__(self, max_entries=1000, timeout=300):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generation(self):
+        return self._generation
+
+    def bump_generation(self):
+        with self._lock:
+            self._generation += 1
+            # Entries of older generations can never be read again
+            self._entries.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """Cache backed by a Redis-compatible server, shared across workers"""
+
+    def __init__(self, url, timeout=300, prefix="blogly:page:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_TYPE 'redis' requires the redis package")
+
+        self.client = redis.Redis.from_url(url)
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode() if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.timeout)
+
+    def generation(self):
+        return int(self.client.get(GENERATION_KEY) or 0)
+
+    def bump_generation(self):
+        # Old entries are left to expire through their TTL
+        self.client.incr(GENERATION_KEY)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class PageCache:
+    """Caches rendered pages of read views and drops them on every commit"""
+
+    def __init__(self, app=None, db=None):
+        self.backend = NullCache()
+        self.timeout = 300
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """Configure backend from app settings and watch db for commits"""
+
+        cache_type = app.config.setdefault('CACHE_TYPE', 'simple')
+        self.timeout = app.config.setdefault('CACHE_DEFAULT_TIMEOUT', 300)
+        max_entries = app.config.setdefault('CACHE_MAX_ENTRIES', 1000)
+
+        if cache_type == 'simple':
+            self.backend = LRUCache(max_entries, self.timeout)
+        elif cache_type == 'redis':
+            url = app.config.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+            self.backend = RedisCache(url, self.timeout)
+        elif cache_type == 'null':
+            self.backend = NullCache()
+        else:
+            raise ValueError(f"Unknown CACHE_TYPE {cache_type!r}")
+
+        event.listen(db.session, 'after_commit', self._after_commit)
+
+    def _after_commit(self, db_session):
+        self.invalidate()
+        if has_request_context():
+            session[LAST_WRITE_KEY] = time.time()
+
+    def invalidate(self):
+        """Drop every cached page"""
+
+        self.backend.bump_generation()
+
+    def _bypass(self):
+        """Return True if the current request must be rendered fresh"""
+
+        if request.method != 'GET' or session.get('_flashes'):
+            return True
+
+        last_write = session.get(LAST_WRITE_KEY)
+        return last_write is not None and time.time() - last_write < self.timeout
+
+    def get_page(self, namespace):
+        """Return (key, cached string) for this request.
+
+        key is None when the request must bypass the cache, and the string
+        is None on a miss; store the rendered page with store_page(key, ...).
+        """
+
+        if self._bypass():
+            return None, None
+
+        key = f"{namespace}:{self.backend.generation()}:{request.full_path}"
+        return key, self.backend.get(key)
+
+    def store_page(self, key, value):
+        """Cache value under key from get_page(), if it is a rendered page"""
+
+        if key is not None and isinstance(value, str):
+            self.backend.set(key, value)
+
+    def lookup(self, namespace, produce):
+        """Return the cached string for this request, or store produce()"""
+
+        key, value = self.get_page(namespace)
+        if value is None:
+            value = produce()
+            self.store_page(key, value)
+
+        return value
+
+    def cached(self, view):
+        """Decorate view so its rendered HTML is served from the cache"""
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            return self.lookup("html", lambda: view(*args, **kwargs))
+
+        return wrapper
+
+
+page_cache = PageCache()
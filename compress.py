@@ -0,0 +1,84 @@
+"""Optional gzip and brotli compression of Blogly responses.
+
+With COMPRESS_RESPONSES on, HTML, JSON and other text responses of at
+least COMPRESS_MIN_SIZE bytes are compressed for clients that accept it:
+brotli when the brotli package is installed and the client takes ``br``,
+gzip otherwise. Listing pages are highly repetitive HTML and shrink
+several times over. Leave it off when a proxy in front already compresses.
+
+A compressed body is a different representation of the same page, so its
+ETag is made weak; conditional.py compares ETags weakly.
+"""
+
+import gzip
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/javascript',
+    'application/javascript', 'application/json',
+}
+
+
+class Compress:
+    """Flask extension compressing responses in an after_request hook"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Install the compression hook on app"""
+
+        app.config.setdefault('COMPRESS_RESPONSES', False)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.after_request(self._compress)
+
+    def _encoding(self):
+        """Return the encoding to send the current request, or None"""
+
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def _compress(self, response):
+        config = current_app.config
+        if (not config['COMPRESS_RESPONSES']
+                or response.mimetype not in COMPRESSIBLE_TYPES
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self._encoding()
+        if response.status_code != 200 or encoding is None:
+            return response
+
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+
+        level = config['COMPRESS_LEVEL']
+        if encoding == 'br':
+            data = brotli.compress(data, quality=min(level, 11))
+        else:
+            data = gzip.compress(data, compresslevel=min(level, 9), mtime=0)
+
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+compress = Compress()
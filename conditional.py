@@ -0,0 +1,96 @@
+"""Conditional GET support for Blogly read views.
+
+A view decorated with ``conditional(fingerprint)`` first calls fingerprint
+with the view's arguments. It returns the rows that decide what the page
+shows: ids and ``updated_at`` values of everything rendered. The ETag is a
+hash of those rows and Last-Modified is the newest ``updated_at`` among
+them. Write routes touch ``updated_at`` of the rows whose pages lose
+content (a deleted post's author, a tag losing a post), so that value
+keeps moving forward. Pages without such an owner row, like the homepage,
+send only an ETag. When the request's If-None-Match or If-Modified-Since
+header still matches, a 304 is sent without running the view or rendering
+a template.
+"""
+
+import datetime
+import functools
+import hashlib
+
+from flask import make_response, request, session
+
+from cache import page_cache
+
+
+def validators(rows):
+    """Return (etag, last_modified) for the fingerprint rows"""
+
+    etag = hashlib.sha1(repr(rows).encode()).hexdigest()
+
+    stamps = [value for row in rows if isinstance(row, tuple)
+              for value in row if isinstance(value, datetime.datetime)]
+    last_modified = max(stamps).replace(microsecond=0) if stamps else None
+
+    return etag, last_modified
+
+
+def _cached_validators(fingerprint, kwargs):
+    """Return (etag, last_modified), reusing them from the page cache"""
+
+    def produce():
+        etag, last_modified = validators(fingerprint(**kwargs))
+        stamp = last_modified.isoformat() if last_modified else "-"
+        return f"{etag} {stamp}"
+
+    etag, stamp = page_cache.lookup("validators", produce).split(" ")
+    last_modified = None if stamp == "-" else datetime.datetime.fromisoformat(stamp)
+    return etag, last_modified
+
+
+def not_modified(etag, last_modified):
+    """Return True if the client's copy matches etag / last_modified"""
+
+    # Weak comparison, as compressed responses carry a weak ETag
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    since = request.if_modified_since
+    if since is not None and last_modified is not None:
+        if since.tzinfo is not None:
+            since = since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return last_modified <= since
+
+    return False
+
+
+def conditional(fingerprint, last_modified=True):
+    """Decorate a read view to answer conditional requests with 304.
+
+    Pass last_modified=False for pages whose content can change without
+    raising the newest updated_at of their fingerprint rows.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # Flash messages are per-visit and not part of the fingerprint
+            if session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            etag, modified = _cached_validators(fingerprint, kwargs)
+            if not last_modified:
+                modified = None
+
+            if not_modified(etag, modified):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    return decorator
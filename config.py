@@ -0,0 +1,112 @@
+"""Configuration classes for Blogly, read from the environment.
+
+Pick one with ``create_app(name)`` or the BLOGLY_CONFIG environment
+variable: development (default), testing or production.
+"""
+
+import os
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+class Config:
+    """Settings shared by every environment"""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///blogly')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    # Comma separated read replica URIs; GET requests read from them
+    SQLALCHEMY_REPLICA_URIS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                               if url]
+    REPLICA_READ_YOUR_WRITES = _env_int('REPLICA_READ_YOUR_WRITES', 5)
+    # Database of the async read routes (asgi.py); defaults to the primary
+    # through asyncpg
+    ASYNC_DATABASE_URI = os.environ.get('ASYNC_DATABASE_URL')
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'itsasecret')
+
+    PAGE_SIZE = _env_int('PAGE_SIZE', 50)
+    SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.5))
+
+    CACHE_TYPE = os.environ.get('CACHE_TYPE', 'simple')
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+    # Jinja bytecode shared by the workers; fill with `flask templates compile`
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+    COMPRESS_RESPONSES = _env_flag('COMPRESS_RESPONSES')
+    COMPRESS_MIN_SIZE = _env_int('COMPRESS_MIN_SIZE', 500)
+    COMPRESS_LEVEL = _env_int('COMPRESS_LEVEL', 6)
+
+    # Where `flask archive export` writes old months of posts
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+
+    # Token buckets per client address: burst size and tokens a second.
+    # Buckets are kept per worker unless a Redis URL is given
+    RATELIMIT_ENABLED = _env_flag('RATELIMIT_ENABLED', True)
+    RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL')
+    RATELIMIT_WRITE_BURST = _env_int('RATELIMIT_WRITE_BURST', 10)
+    RATELIMIT_WRITE_RATE = float(os.environ.get('RATELIMIT_WRITE_RATE', 0.5))
+    RATELIMIT_SEARCH_BURST = _env_int('RATELIMIT_SEARCH_BURST', 20)
+    RATELIMIT_SEARCH_RATE = float(os.environ.get('RATELIMIT_SEARCH_RATE', 2))
+    # Requests and writes a worker lets in at once, 0 for no limit, and
+    # the seconds a request waits for room before it is shed
+    ADMISSION_MAX_REQUESTS = _env_int('ADMISSION_MAX_REQUESTS', 0)
+    ADMISSION_MAX_WRITES = _env_int('ADMISSION_MAX_WRITES', 0)
+    ADMISSION_TIMEOUT = float(os.environ.get('ADMISSION_TIMEOUT', 0.5))
+
+    DEBUG_TB_ENABLED = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+
+class DevelopmentConfig(Config):
+    """Local development: debug toolbar on, SQL echo on request"""
+
+    SQLALCHEMY_ECHO = _env_flag('SQLALCHEMY_ECHO')
+    DEBUG_TB_ENABLED = True
+
+
+class TestingConfig(Config):
+    """Test suite: separate database, quiet logs"""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'postgresql:///blogly_test')
+    SQLALCHEMY_REPLICA_URIS = []
+    ASYNC_DATABASE_URI = None
+    RATELIMIT_ENABLED = False
+    TESTING = True
+
+
+class ProductionConfig(Config):
+    """Multi-worker deployment: no toolbar or echo, tuned connection pool.
+
+    The pool is per worker process, so size it so that workers times
+    (pool_size + max_overflow) stays under the server's max_connections.
+    Admission lets in as many requests as the pool has connections, and
+    keeps half of them for reads.
+    """
+
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': _env_int('DB_POOL_SIZE', 5),
+        'max_overflow': _env_int('DB_MAX_OVERFLOW', 5),
+        'pool_pre_ping': True,
+        'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800),
+    }
+    ADMISSION_MAX_REQUESTS = _env_int('ADMISSION_MAX_REQUESTS',
+                                      SQLALCHEMY_ENGINE_OPTIONS['pool_size']
+                                      + SQLALCHEMY_ENGINE_OPTIONS['max_overflow'])
+    ADMISSION_MAX_WRITES = _env_int('ADMISSION_MAX_WRITES', ADMISSION_MAX_REQUESTS // 2)
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
@@ -0,0 +1,89 @@
+"""Denormalized counters: users' and tags' post_count, posts' tag_count.
+
+Write paths adjust the counters in the same transaction as the change
+they count, with ``UPDATE ... SET n = n + delta`` so concurrent writers
+never lose an increment. Listing pages can then show and sort by the
+counts without aggregate queries.
+
+Adjusting a counter also moves the row's ``updated_at`` forward (its
+onupdate applies to these UPDATEs), so the Last-Modified of a user's or
+tag's page follows posts leaving it, and a post's follows its tags.
+
+Writes that bypass the views, like raw SQL or an interrupted import, are
+repaired with
+
+    flask counts reconcile
+"""
+
+import collections
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, select
+
+from models import db, User, Post, Tag, PostTag
+
+
+def adjust_counts(column, ids, delta):
+    """Add delta to column of the rows whose id is in ids.
+
+    ids may be a list, where an id appearing n times gets n * delta, or a
+    query of distinct ids. delta may also be an SQL expression correlated
+    with the updated row, like a count subquery.
+    """
+
+    model = column.class_
+    if not isinstance(ids, (list, tuple, set)):
+        groups = {1: ids}
+    else:
+        groups = collections.defaultdict(list)
+        for row_id, times in collections.Counter(ids).items():
+            groups[times].append(row_id)
+
+    for times, group in groups.items():
+        (model.query
+         .filter(model.id.in_(group))
+         .update({column: column + delta * times}, synchronize_session=False))
+
+
+def _actual_counts():
+    """Return (counter column, subquery of the true value) pairs"""
+
+    return [
+        (User.post_count,
+         select(func.count(Post.id)).where(Post.user_id == User.id).scalar_subquery()),
+        (Tag.post_count,
+         select(func.count(PostTag.post_id)).where(PostTag.tag_id == Tag.id).scalar_subquery()),
+        (Post.tag_count,
+         select(func.count(PostTag.tag_id)).where(PostTag.post_id == Post.id).scalar_subquery()),
+    ]
+
+
+def reconcile_counts():
+    """Recompute every counter; return {counter name: rows repaired}"""
+
+    repaired = {}
+    for column, actual in _actual_counts():
+        model = column.class_
+        repaired[f"{model.__tablename__}.{column.key}"] = (
+            model.query
+            .filter(column != actual)
+            .update({column: actual}, synchronize_session=False))
+    return repaired
+
+
+###########################################################################
+
+# Command line
+
+counts_cli = AppGroup('counts', help="Maintain denormalized post and tag counters.")
+
+
+@counts_cli.command('reconcile')
+def reconcile_command():
+    """Recompute counters and report the rows that had drifted."""
+
+    repaired = reconcile_counts()
+    db.session.commit()
+    for name, rows in repaired.items():
+        click.echo(f"{name}: repaired {rows} rows")
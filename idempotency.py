@@ -0,0 +1,100 @@
+"""Idempotent create forms.
+
+Each create form carries a fresh token in a hidden ``idempotency_key``
+field. A view decorated with ``@idempotent`` first inserts the token into
+idempotency_keys, with the page the view redirects to, in the same
+transaction as the row it creates. A second submission of the same form,
+from a double click or a client retrying after a timeout, finds the token
+taken: PostgreSQL makes it wait until the first submission's transaction
+ends, and it is then redirected where the first one went without
+inserting anything. If the first submission failed and rolled back, the
+token is free again and the retry runs normally.
+
+Tokens of old submissions are deleted with
+
+    flask idempotency purge --days 7
+"""
+
+import datetime
+import functools
+import uuid
+
+import click
+from flask import flash, redirect, request
+from flask.cli import AppGroup
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, IdempotencyKey
+
+FORM_FIELD = 'idempotency_key'
+
+
+def new_token():
+    """Return a fresh token for a create form"""
+
+    return uuid.uuid4().hex
+
+
+def claim(key, location):
+    """Claim key for a submission redirecting to location, in the current transaction.
+
+    Returns None if key was free, or the location of the submission that
+    already used it.
+    """
+
+    stmt = (insert(IdempotencyKey.__table__)
+            .values(key=key, location=location)
+            .on_conflict_do_nothing()
+            .returning(IdempotencyKey.key))
+    if db.session.execute(stmt).scalar() is not None:
+        return None
+
+    return (db.session.query(IdempotencyKey.location)
+            .filter(IdempotencyKey.key == key)
+            .scalar())
+
+
+def idempotent(location):
+    """Decorate a create view so resubmitting its form creates nothing.
+
+    location is where the view redirects after creating, formatted with
+    the view's arguments. It is stored with the token, so a resubmission
+    is sent to the same place.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.form.get(FORM_FIELD)
+            if key:
+                done = claim(key, location.format(**kwargs))
+                if done is not None:
+                    db.session.rollback()
+                    flash("That form was already submitted.")
+                    return redirect(done)
+
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+###########################################################################
+
+# Command line
+
+idempotency_cli = AppGroup('idempotency', help="Maintain create form tokens.")
+
+
+@idempotency_cli.command('purge')
+@click.option('--days', default=7, show_default=True)
+def purge_command(days):
+    """Delete tokens of submissions made more than DAYS days ago."""
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    count = (IdempotencyKey.query
+             .filter(IdempotencyKey.created_at < cutoff)
+             .delete(synchronize_session=False))
+    db.session.commit()
+    click.echo(f"Deleted {count} form tokens.")
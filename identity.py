@@ -0,0 +1,283 @@
+"""Process-wide cache of user and tag display data.
+
+Bylines, tag chips and pickers only need a user's name and picture or a
+tag's name, which rarely change. ``identities`` keeps them in each worker,
+so the post form, its submission and the tag typeahead resolve them
+without a database round trip:
+
+- users are cached by id, up to IDENTITY_CACHE_MAX_USERS of them, least
+  recently used first out;
+- tags are cached as a whole table while it has at most
+  IDENTITY_CACHE_MAX_TAGS rows, which also answers typeahead prefixes
+  from memory. Bigger tables are read from the database.
+
+Invalidation is versioned. Users and tags each have a version number,
+bumped when a transaction that changed their display data commits: an ORM
+insert, update or delete of a User or Tag, or a bulk statement on their
+table other than a counter update. Entries remember the version they were
+read at, so a read racing a write is not served once the write commits.
+
+Versions live in the worker, or in Redis when CACHE_TYPE is 'redis', so
+that every worker sees a bump at once. Otherwise other workers catch up
+within IDENTITY_CACHE_TIMEOUT seconds, as they do for writes made with raw
+SQL. CACHE_TYPE 'null' turns the cache off.
+"""
+
+import bisect
+import collections
+import itertools
+import threading
+import time
+
+from sqlalchemy import event
+
+from models import db, User, Tag
+
+KINDS = {User: 'users', Tag: 'tags'}
+
+# Columns the cache holds; bulk updates of other columns, like the
+# counters, leave it valid
+DISPLAY_COLUMNS = {
+    'users': {'id', 'first_name', 'last_name', 'image_url'},
+    'tags': {'id', 'name'},
+}
+
+# Session.info key of the kinds written in the current transaction
+WRITES_KEY = 'identity_writes'
+
+
+class UserCard(collections.namedtuple('UserCard', 'id first_name last_name image_url')):
+    """Display data of a user"""
+
+    __slots__ = ()
+
+    full_name = User.full_name
+
+
+TagCard = collections.namedtuple('TagCard', 'id name')
+
+
+class LocalVersions:
+    """Version numbers kept by one worker"""
+
+    def __init__(self):
+        self._versions = collections.Counter()
+        self._lock = threading.Lock()
+
+    def get(self, kind):
+        return self._versions[kind]
+
+    def bump(self, kind):
+        with self._lock:
+            self._versions[kind] += 1
+
+
+class RedisVersions:
+    """Version numbers shared by every worker through a Redis-compatible server"""
+
+    def __init__(self, url, prefix="blogly:identity:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_TYPE 'redis' requires the redis package")
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, kind):
+        return int(self.client.get(self.prefix + kind) or 0)
+
+    def bump(self, kind):
+        self.client.incr(self.prefix + kind)
+
+
+class TagTable:
+    """Snapshot of the tags table, or of its size when too big to keep"""
+
+    def __init__(self, version, expires_at, cards):
+        self.version = version
+        self.expires_at = expires_at
+        # None when the table has more rows than the cache takes
+        self.cards = cards
+        if cards is not None:
+            cards.sort(key=lambda card: (card.name.lower(), card.id))
+            self.lowered = [card.name.lower() for card in cards]
+            self.by_id = {card.id: card for card in cards}
+            self.by_name = {card.name: card for card in cards}
+
+    def fresh(self, version):
+        return self.version == version and self.expires_at > time.monotonic()
+
+    def starting_with(self, prefix, limit):
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.lowered, prefix)
+        matches = itertools.takewhile(lambda i: self.lowered[i].startswith(prefix),
+                                      range(start, len(self.cards)))
+        return [self.cards[i] for i in itertools.islice(matches, limit)]
+
+
+class IdentityCache:
+    """Read-through cache of UserCards and TagCards"""
+
+    def __init__(self, app=None, db=None):
+        self.enabled = True
+        self.versions = LocalVersions()
+        self.max_users = 10000
+        self.max_tags = 5000
+        self.timeout = 60
+        self._users = collections.OrderedDict()
+        self._tags = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """Configure the cache from app settings and watch db for writes"""
+
+        self.max_users = app.config.setdefault('IDENTITY_CACHE_MAX_USERS', 10000)
+        self.max_tags = app.config.setdefault('IDENTITY_CACHE_MAX_TAGS', 5000)
+        self.timeout = app.config.setdefault('IDENTITY_CACHE_TIMEOUT', 60)
+
+        cache_type = app.config.get('CACHE_TYPE', 'simple')
+        self.enabled = cache_type != 'null'
+        if cache_type == 'redis':
+            self.versions = RedisVersions(app.config.get('CACHE_REDIS_URL',
+                                                         'redis://localhost:6379/0'))
+
+        for name, listener in (('after_flush', self._after_flush),
+                               ('do_orm_execute', self._do_orm_execute),
+                               ('after_commit', self._after_commit),
+                               ('after_rollback', self._after_rollback)):
+            if not event.contains(db.session, name, listener):
+                event.listen(db.session, name, listener)
+
+    ###########################################################################
+
+    # Tracking writes
+
+    def _written(self, session, kind):
+        session.info.setdefault(WRITES_KEY, set()).add(kind)
+
+    def _after_flush(self, session, flush_context):
+        for row in itertools.chain(session.new, session.deleted):
+            if type(row) in KINDS:
+                self._written(session, KINDS[type(row)])
+        for row in session.dirty:
+            if type(row) in KINDS and session.is_modified(row, include_collections=False):
+                self._written(session, KINDS[type(row)])
+
+    def _do_orm_execute(self, state):
+        statement = state.statement
+        if not statement.is_dml:
+            return
+        kind = statement.table.name
+        if kind not in DISPLAY_COLUMNS:
+            return
+        if state.is_update and statement._values:
+            columns = {getattr(column, 'key', column) for column in statement._values}
+            if not columns & DISPLAY_COLUMNS[kind]:
+                return
+        self._written(state.session, kind)
+
+    def _after_commit(self, session):
+        for kind in session.info.pop(WRITES_KEY, ()):
+            self.versions.bump(kind)
+
+    def _after_rollback(self, session):
+        session.info.pop(WRITES_KEY, None)
+
+    ###########################################################################
+
+    # Users
+
+    def user(self, user_id):
+        """Return the UserCard of user_id, or None if there is no such user"""
+
+        return self.users([user_id]).get(user_id)
+
+    def users(self, ids):
+        """Return {id: UserCard} of the users in ids that exist"""
+
+        version = self.versions.get('users')
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for user_id in set(ids):
+                entry = self._users.get(user_id) if self.enabled else None
+                if entry is not None and entry[0] == version and entry[1] > now:
+                    self._users.move_to_end(user_id)
+                    found[user_id] = entry[2]
+                else:
+                    missing.append(user_id)
+
+        if missing:
+            rows = (db.session.query(User.id, User.first_name, User.last_name, User.image_url)
+                    .filter(User.id.in_(missing)))
+            loaded = {row.id: UserCard(*row) for row in rows}
+            found.update(loaded)
+            if self.enabled:
+                with self._lock:
+                    for user_id, card in loaded.items():
+                        self._users[user_id] = (version, now + self.timeout, card)
+                        self._users.move_to_end(user_id)
+                    while len(self._users) > self.max_users:
+                        self._users.popitem(last=False)
+
+        return found
+
+    ###########################################################################
+
+    # Tags
+
+    def _tag_table(self):
+        version = self.versions.get('tags')
+        table = self._tags
+        if table is None or not table.fresh(version):
+            cards = None
+            if self.enabled:
+                rows = db.session.query(Tag.id, Tag.name).limit(self.max_tags + 1).all()
+                if len(rows) <= self.max_tags:
+                    cards = [TagCard(*row) for row in rows]
+            table = self._tags = TagTable(version, time.monotonic() + self.timeout, cards)
+        return table
+
+    def tags(self, ids):
+        """Return {id: TagCard} of the tags in ids that exist"""
+
+        ids = set(ids)
+        table = self._tag_table()
+        found = {}
+        if table.cards is not None:
+            found = {tag_id: table.by_id[tag_id] for tag_id in ids if tag_id in table.by_id}
+        # Tags created by another worker are not in its snapshot yet
+        missing = ids - found.keys()
+        if missing:
+            rows = db.session.query(Tag.id, Tag.name).filter(Tag.id.in_(missing))
+            found.update((row.id, TagCard(*row)) for row in rows)
+        return found
+
+    def tags_named(self, names):
+        """Return the TagCards of the tags named in names, ordered by name"""
+
+        names = set(names)
+        table = self._tag_table()
+        if table.cards is not None:
+            return sorted((table.by_name[name] for name in names if name in table.by_name),
+                          key=lambda card: card.name)
+        rows = db.session.query(Tag.id, Tag.name).filter(Tag.name.in_(names)).order_by(Tag.name)
+        return [TagCard(*row) for row in rows]
+
+    def tags_starting_with(self, prefix, limit):
+        """Return TagCards whose name starts with prefix, ignoring case.
+
+        Returns None when the tags table is too big to be cached; ask the
+        database instead.
+        """
+
+        table = self._tag_table()
+        if table.cards is None:
+            return None
+        return table.starting_with(prefix, limit)
+
+
+identities = IdentityCache()
@@ -0,0 +1,375 @@
+"""Bulk import of users, posts and tags from CSV or NDJSON.
+
+Records are validated in Python, then written in batches with one
+multi-row INSERT per table and one commit per batch. Tag names on posts are
+resolved to ids for the whole batch at once, creating missing tags, and the
+posts_tags rows are inserted in one statement. Malformed records are
+rejected and reported by line number without aborting their batch.
+
+    flask import users people.csv
+    flask import posts archive.ndjson --batch-size 5000
+
+Post records may carry tags as a list (NDJSON) or a comma separated string
+(CSV). Records may include an explicit id, to keep the ids of an archive.
+Large imports can run as the background ``import`` job instead.
+"""
+
+import csv
+import datetime
+import io
+import itertools
+import json
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from counters import adjust_counts
+from jobs import task
+from models import db, User, Post, Tag, PostTag, DEFAULT_IMAGE_URL
+
+DEFAULT_BATCH_SIZE = 1000
+
+FORMATS = ('csv', 'ndjson')
+
+
+class InvalidRecord(ValueError):
+    """Raised for a record that cannot be imported"""
+
+
+class ImportReport:
+    """Counts of imported and rejected records, with timing"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.rejected = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def reject(self, line, reason):
+        self.rejected.append({"line": line, "reason": reason})
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+        self.rejected.sort(key=lambda rejected: rejected["line"])
+        return self
+
+    @property
+    def rows_per_sec(self):
+        return self.inserted / self.elapsed if self.elapsed else 0.0
+
+    def to_dict(self):
+        return {"inserted": self.inserted,
+                "rejected": self.rejected,
+                "seconds": round(self.elapsed, 3),
+                "rows_per_sec": round(self.rows_per_sec, 1)}
+
+
+###########################################################################
+
+# Reading and validating records
+
+def read_records(stream, fmt):
+    """Yield (line number, record dict or InvalidRecord) from text stream"""
+
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == 'ndjson':
+        for line_num, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_num, InvalidRecord(f"invalid JSON: {e}")
+                continue
+            if not isinstance(record, dict):
+                yield line_num, InvalidRecord("record is not an object")
+                continue
+            yield line_num, record
+    else:
+        raise ValueError(f"Unknown format {fmt!r}")
+
+
+def _text(record, field, required=True):
+    value = record.get(field)
+    if value is None or (isinstance(value, str) and not value.strip()):
+        if required:
+            raise InvalidRecord(f"missing {field}")
+        return None
+    if not isinstance(value, str):
+        raise InvalidRecord(f"{field} must be a string")
+    return value.strip()
+
+
+def _integer(record, field, required=True):
+    value = record.get(field)
+    if value is None or value == "":
+        if required:
+            raise InvalidRecord(f"missing {field}")
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidRecord(f"{field} must be an integer")
+
+
+def _timestamp(record, field):
+    value = record.get(field)
+    if not value:
+        return datetime.datetime.now()
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise InvalidRecord(f"{field} must be an ISO 8601 timestamp")
+
+
+def _tag_names(record):
+    value = record.get('tags') or []
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise InvalidRecord("tags must be a list of names")
+    return sorted({name.strip() for name in value if name.strip()})
+
+
+def parse_user(record):
+    """Return insert values for a user record"""
+
+    return {"id": _integer(record, 'id', required=False),
+            "first_name": _text(record, 'first_name'),
+            "last_name": _text(record, 'last_name'),
+            "image_url": _text(record, 'image_url', required=False) or DEFAULT_IMAGE_URL}
+
+
+def parse_post(record):
+    """Return insert values for a post record, with its tag names"""
+
+    return {"id": _integer(record, 'id', required=False),
+            "title": _text(record, 'title'),
+            "content": _text(record, 'content'),
+            "user_id": _integer(record, 'user_id'),
+            "created_at": _timestamp(record, 'created_at'),
+            "tags": _tag_names(record)}
+
+
+def parse_tag(record):
+    """Return insert values for a tag record"""
+
+    return {"id": _integer(record, 'id', required=False),
+            "name": _text(record, 'name')}
+
+
+###########################################################################
+
+# Writing batches
+
+def _bulk_insert(model, rows, **on_conflict):
+    """Insert rows with executemany, grouping rows that share the same keys.
+
+    Rows with explicit ids go first, and the id sequence is moved past them
+    before any row that takes its id from the sequence.
+    """
+
+    def keys(row):
+        return ('id' not in row, sorted(row))
+
+    rows = [{k: v for k, v in row.items() if v is not None} for row in rows]
+    rows.sort(key=keys)
+    for (generated_id, _), group in itertools.groupby(rows, key=keys):
+        stmt = insert(model.__table__)
+        if on_conflict:
+            stmt = stmt.on_conflict_do_nothing(**on_conflict)
+        db.session.execute(stmt, list(group))
+        if not generated_id:
+            _reset_sequence(model)
+
+
+def _reset_sequence(model):
+    """Move the id sequence past ids inserted explicitly"""
+
+    table = model.__tablename__
+    db.session.execute(
+        text("SELECT setval(pg_get_serial_sequence(:table, 'id'), :value)"),
+        {"table": table,
+         "value": db.session.execute(select(func.coalesce(func.max(model.id), 1))).scalar()})
+
+
+def resolve_tags(names):
+    """Return {name: id} for names, creating the tags that do not exist"""
+
+    names = sorted(set(names))
+    if not names:
+        return {}
+
+    _bulk_insert(Tag, [{"name": name} for name in names],
+                 index_elements=['name'])
+    rows = db.session.execute(select(Tag.name, Tag.id).where(Tag.name.in_(names)))
+    return dict(rows.all())
+
+
+def _existing(column, values):
+    """Return the subset of values already present in column"""
+
+    if not values:
+        return set()
+    return set(db.session.execute(select(column).where(column.in_(values))).scalars())
+
+
+def _import_users(batch, report):
+    ids = _existing(User.id, [row["id"] for _, row in batch if row["id"]])
+    rows = []
+    for line, row in batch:
+        if row["id"] in ids:
+            report.reject(line, f"user {row['id']} already exists")
+        else:
+            if row["id"]:
+                ids.add(row["id"])
+            rows.append(row)
+
+    if rows:
+        _bulk_insert(User, rows)
+    return len(rows)
+
+
+def _import_tags(batch, report):
+    names = _existing(Tag.name, [row["name"] for _, row in batch])
+    ids = _existing(Tag.id, [row["id"] for _, row in batch if row["id"]])
+    rows, seen = [], set()
+    for line, row in batch:
+        if row["id"] in ids:
+            report.reject(line, f"tag {row['id']} already exists")
+        elif row["name"] in names or row["name"] in seen:
+            report.reject(line, f"tag {row['name']!r} already exists")
+        else:
+            seen.add(row["name"])
+            if row["id"]:
+                ids.add(row["id"])
+            rows.append(row)
+
+    if rows:
+        _bulk_insert(Tag, rows)
+    return len(rows)
+
+
+def _import_posts(batch, report):
+    users = _existing(User.id, list({row["user_id"] for _, row in batch}))
+    titles = _existing(Post.title, [row["title"] for _, row in batch])
+    ids = _existing(Post.id, [row["id"] for _, row in batch if row["id"]])
+
+    rows, seen = [], set()
+    for line, row in batch:
+        if row["id"] in ids:
+            report.reject(line, f"post {row['id']} already exists")
+        elif row["user_id"] not in users:
+            report.reject(line, f"user {row['user_id']} does not exist")
+        elif row["title"] in titles or row["title"] in seen:
+            report.reject(line, f"post {row['title']!r} already exists")
+        else:
+            seen.add(row["title"])
+            if row["id"]:
+                ids.add(row["id"])
+            rows.append(row)
+
+    if not rows:
+        return 0
+
+    tag_names = {row["title"]: row.pop("tags") for row in rows}
+    for row in rows:
+        row["tag_count"] = len(tag_names[row["title"]])
+    _bulk_insert(Post, rows, index_elements=['title'])
+
+    post_ids = dict(db.session.execute(
+        select(Post.title, Post.id).where(Post.title.in_(list(tag_names)))).all())
+    tag_ids = resolve_tags(itertools.chain.from_iterable(tag_names.values()))
+
+    links = [{"post_id": post_ids[title], "tag_id": tag_ids[name]}
+             for title, names in tag_names.items() for name in names]
+    if links:
+        db.session.execute(insert(PostTag.__table__).on_conflict_do_nothing(), links)
+
+    adjust_counts(User.post_count, [row["user_id"] for row in rows], 1)
+    adjust_counts(Tag.post_count, [link["tag_id"] for link in links], 1)
+
+    return len(rows)
+
+
+KINDS = {
+    'users': (parse_user, _import_users),
+    'posts': (parse_post, _import_posts),
+    'tags': (parse_tag, _import_tags),
+}
+
+
+def import_records(kind, records, batch_size=DEFAULT_BATCH_SIZE):
+    """Import (line, record) pairs of the given kind; return ImportReport"""
+
+    parse, write = KINDS[kind]
+    report = ImportReport()
+
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, batch_size))
+        if not chunk:
+            break
+
+        batch = []
+        for line, record in chunk:
+            try:
+                if isinstance(record, InvalidRecord):
+                    raise record
+                batch.append((line, parse(record)))
+            except InvalidRecord as e:
+                report.reject(line, str(e))
+
+        report.inserted += write(batch, report)
+        db.session.commit()
+
+    return report.finish()
+
+
+def import_stream(kind, stream, fmt, batch_size=DEFAULT_BATCH_SIZE):
+    """Import records of kind from a text stream in fmt"""
+
+    return import_records(kind, read_records(stream, fmt), batch_size)
+
+
+@task('import')
+def import_job(kind, body, fmt):
+    """Background job importing body, the text of a CSV or NDJSON upload"""
+
+    return import_stream(kind, io.StringIO(body), fmt).to_dict()
+
+
+###########################################################################
+
+# Command line
+
+import_cli = AppGroup('import', help="Bulk import records from CSV or NDJSON.")
+
+
+def _import_command(kind):
+    @import_cli.command(kind, help=f"Import {kind} from FILE.")
+    @click.argument('file', type=click.File('r', encoding='utf-8'))
+    @click.option('--format', 'fmt', type=click.Choice(FORMATS),
+                  help="Input format; guessed from the file name if omitted.")
+    @click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+    def command(file, fmt, batch_size):
+        fmt = fmt or ('csv' if file.name.endswith('.csv') else 'ndjson')
+        report = import_stream(kind, file, fmt, batch_size)
+
+        for rejected in report.rejected:
+            click.echo(f"line {rejected['line']}: {rejected['reason']}", err=True)
+        click.echo(f"Imported {report.inserted} {kind} in {report.elapsed:.2f}s "
+                   f"({report.rows_per_sec:.0f} rows/sec), "
+                   f"rejected {len(report.rejected)}.")
+
+    return command
+
+
+for _kind in KINDS:
+    _import_command(_kind)
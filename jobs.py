@@ -0,0 +1,259 @@
+"""Background jobs stored in the database.
+
+``enqueue()`` adds a row to the jobs table inside the caller's transaction,
+so a job becomes visible to workers exactly when the write that asked for
+it commits, and never for a write that rolled back. The request returns
+right after that commit; workers started with
+
+    flask jobs work --processes 4
+
+claim due jobs with ``SELECT ... FOR UPDATE SKIP LOCKED``, so any number
+of workers can share the table. A job that raises is retried with
+exponential backoff until it has had JOB_MAX_ATTEMPTS attempts, then
+marked failed. Jobs enqueued with a key already in the table are dropped,
+which makes retried requests safe. ``flask jobs status`` and the
+blogly_jobs gauge on /metrics show the queue depth.
+
+Tasks are plain functions registered with ``@task(name)``. They run in the
+worker's session; what they leave uncommitted is committed together with
+the job's done status.
+"""
+
+import datetime
+import logging
+import multiprocessing
+import random
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from metrics import registry
+from models import db, Job
+
+log = logging.getLogger('blogly.jobs')
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_BASE = 2.0
+DEFAULT_BACKOFF_MAX = 600.0
+DEFAULT_JOB_TIMEOUT = 600
+DEFAULT_POLL_INTERVAL = 1.0
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+TASKS = {}
+
+
+def task(name):
+    """Register the decorated function as the task called name"""
+
+    def decorator(func):
+        TASKS[name] = func
+        return func
+
+    return decorator
+
+
+def _config(name, default):
+    return current_app.config.get(name, default)
+
+
+def enqueue(task_name, key=None, delay=0, **args):
+    """Add a job running task_name(**args) to the current transaction.
+
+    Returns the job id. If a job with key already exists, no job is added
+    and that job's id is returned.
+    """
+
+    if task_name not in TASKS:
+        raise ValueError(f"Unknown task {task_name!r}")
+
+    run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+    stmt = (insert(Job.__table__)
+            .values(task=task_name, args=args, key=key, run_at=run_at)
+            .on_conflict_do_nothing(index_elements=['key'])
+            .returning(Job.id))
+    job_id = db.session.execute(stmt).scalar()
+    if job_id is None:
+        job_id = db.session.query(Job.id).filter(Job.key == key).scalar()
+    return job_id
+
+
+def backoff(attempts):
+    """Return seconds to wait before retrying a job after attempts tries"""
+
+    delay = min(_config('JOB_BACKOFF_MAX', DEFAULT_BACKOFF_MAX),
+                _config('JOB_BACKOFF_BASE', DEFAULT_BACKOFF_BASE) * 2 ** (attempts - 1))
+    # Jitter keeps jobs that failed together from retrying together
+    return delay + random.uniform(0, delay / 10)
+
+
+def claim():
+    """Mark the next due job running and return it, or None"""
+
+    now = datetime.datetime.utcnow()
+    job = (Job.query
+           .filter(Job.status == 'queued', Job.run_at <= now)
+           .order_by(Job.run_at, Job.id)
+           .with_for_update(skip_locked=True)
+           .first())
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = 'running'
+    job.attempts += 1
+    job.locked_at = now
+    db.session.commit()
+    return job
+
+
+def run_job(job):
+    """Run a claimed job and record its outcome"""
+
+    try:
+        if job.task not in TASKS:
+            raise LookupError(f"unknown task {job.task!r}")
+        result = TASKS[job.task](**job.args)
+    except Exception as e:
+        db.session.rollback()
+        job.last_error = f"{type(e).__name__}: {e}"
+        if job.attempts >= _config('JOB_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS):
+            job.status = 'failed'
+            log.error("job %s (%s) failed: %s", job.id, job.task, job.last_error)
+        else:
+            job.status = 'queued'
+            job.run_at = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=backoff(job.attempts))
+            log.warning("job %s (%s) attempt %s failed: %s",
+                        job.id, job.task, job.attempts, job.last_error)
+    else:
+        job.status = 'done'
+        job.result = result
+        job.last_error = None
+
+    job.locked_at = None
+    db.session.commit()
+
+
+def requeue_stale():
+    """Requeue running jobs whose worker died; return how many"""
+
+    timeout = datetime.timedelta(seconds=_config('JOB_TIMEOUT', DEFAULT_JOB_TIMEOUT))
+    count = (Job.query
+             .filter(Job.status == 'running',
+                     Job.locked_at < datetime.datetime.utcnow() - timeout)
+             .update({Job.status: 'queued', Job.locked_at: None},
+                     synchronize_session=False))
+    db.session.commit()
+    return count
+
+
+def run_pending(limit=None):
+    """Run due jobs until none are left or limit ran; return how many ran"""
+
+    requeue_stale()
+    ran = 0
+    while limit is None or ran < limit:
+        job = claim()
+        if job is None:
+            break
+        run_job(job)
+        ran += 1
+    return ran
+
+
+def queue_depth():
+    """Return {status: number of jobs}"""
+
+    counts = dict(db.session.query(Job.status, func.count(Job.id))
+                  .group_by(Job.status))
+    return {status: counts.get(status, 0) for status in STATUSES}
+
+
+registry.gauge('blogly_jobs', "Background jobs by status.", queue_depth, label='status')
+
+
+def _work(poll_interval):
+    """Worker process: run jobs forever, sleeping when the queue is empty"""
+
+    from app import create_app
+
+    app = create_app()
+    with app.app_context():
+        while True:
+            if not run_pending():
+                time.sleep(poll_interval)
+
+
+###########################################################################
+
+# Command line
+
+jobs_cli = AppGroup('jobs', help="Run and inspect background jobs.")
+
+
+@jobs_cli.command('work')
+@click.option('--processes', default=1, show_default=True)
+@click.option('--poll-interval', default=DEFAULT_POLL_INTERVAL, show_default=True)
+@click.option('--once', is_flag=True, help="Run the jobs due now and exit.")
+def work_command(processes, poll_interval, once):
+    """Run background jobs in a pool of worker processes."""
+
+    if once:
+        click.echo(f"Ran {run_pending()} jobs.")
+        return
+
+    # Each worker builds its own app, and with it its own connection pool
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=_work, args=(poll_interval,), daemon=True)
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+
+@jobs_cli.command('status')
+def status_command():
+    """Show the number of jobs by status and the latest failures."""
+
+    for status, count in queue_depth().items():
+        click.echo(f"{status:<8} {count}")
+
+    for job in (Job.query.filter(Job.status == 'failed')
+                .order_by(Job.updated_at.desc()).limit(10)):
+        click.echo(f"failed job {job.id} ({job.task}): {job.last_error}")
+
+
+@jobs_cli.command('retry')
+def retry_command():
+    """Queue failed jobs again."""
+
+    count = (Job.query
+             .filter(Job.status == 'failed')
+             .update({Job.status: 'queued', Job.attempts: 0,
+                      Job.run_at: datetime.datetime.utcnow()},
+                     synchronize_session=False))
+    db.session.commit()
+    click.echo(f"Queued {count} failed jobs again.")
+
+
+@jobs_cli.command('purge')
+@click.option('--days', default=7, show_default=True)
+def purge_command(days):
+    """Delete jobs that finished more than DAYS days ago."""
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    count = (Job.query
+             .filter(Job.status == 'done', Job.updated_at < cutoff)
+             .delete(synchronize_session=False))
+    db.session.commit()
+    click.echo(f"Deleted {count} finished jobs.")
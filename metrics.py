@@ -0,0 +1,254 @@
+"""Request instrumentation for Blogly.
+
+Records, per route, the request latency, the number of SQL statements and
+the time spent in them, and the time spent rendering templates. Statements
+slower than ``SLOW_QUERY_THRESHOLD`` seconds are written to the
+``blogly.slow_queries`` logger. Everything is exposed in Prometheus text
+format at ``/metrics``.
+
+Measurements are plain counters updated under a lock, cheap enough to keep
+on in production. Each worker process keeps its own numbers; scrape every
+worker, or run one worker per metrics endpoint.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, current_app, g, has_app_context, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+slow_query_log = logging.getLogger('blogly.slow_queries')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] += amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self._values.items()]
+
+
+class Gauge:
+    """Value read from a callback when metrics are collected.
+
+    With label set, callback returns {label value: value} instead of a
+    single value.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback, label=None):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.label = label
+
+    def samples(self):
+        if self.label is None:
+            return [(self.name, (), self.callback())]
+        return [(self.name, ((self.label, key),), value)
+                for key, value in sorted(self.callback().items())]
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets, optionally split by labels"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts = series[0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels):
+        series = self._series.get(tuple(sorted(labels.items())))
+        return series[2] if series else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, (counts, total, count) in self._series.items():
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    samples.append((f"{self.name}_bucket", labels + (("le", repr(float(bound))),), cumulative))
+                samples.append((f"{self.name}_bucket", labels + (("le", "+Inf"),), count))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class Registry:
+    """Collection of metrics rendered together in Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """Add metric, or return the one already registered under its name"""
+
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help, callback, label=None):
+        return self.register(Gauge(name, help, callback, label))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+requests_total = registry.counter(
+    'blogly_requests_total', "HTTP requests by route, method and status.")
+request_seconds = registry.histogram(
+    'blogly_request_seconds', "HTTP request latency by route.")
+request_queries = registry.histogram(
+    'blogly_request_queries', "SQL statements run per request, by route.", COUNT_BUCKETS)
+request_query_seconds = registry.histogram(
+    'blogly_request_query_seconds', "Time spent in SQL per request, by route.")
+template_seconds = registry.histogram(
+    'blogly_template_render_seconds', "Template render time by template.")
+slow_queries_total = registry.counter(
+    'blogly_slow_queries_total', "SQL statements slower than the slow query threshold.")
+
+
+class Metrics:
+    """Flask extension wiring request, SQL and template timings into registry"""
+
+    def __init__(self, app=None):
+        self.slow_query_threshold = 0.5
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Install hooks on app and the /metrics endpoint"""
+
+        self.slow_query_threshold = app.config.setdefault('SLOW_QUERY_THRESHOLD', 0.5)
+
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+
+        if not event.contains(Engine, 'before_cursor_execute', self._before_execute):
+            event.listen(Engine, 'before_cursor_execute', self._before_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_execute)
+
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+        registry.gauge('blogly_replica_healthy', "Read replicas passing health checks.",
+                       self._replica_health, label='replica')
+
+    def _start_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_query_seconds = 0.0
+
+    def _finish_request(self, response):
+        start = g.get('metrics_start')
+        if start is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        if route == '/metrics':
+            return response
+
+        request_seconds.observe(time.perf_counter() - start, route=route)
+        request_queries.observe(g.metrics_queries, route=route)
+        request_query_seconds.observe(g.metrics_query_seconds, route=route)
+        requests_total.inc(route=route, method=request.method, status=response.status_code)
+        return response
+
+    def _start_render(self, app, template, context):
+        g.setdefault('metrics_renders', []).append(time.perf_counter())
+
+    def _finish_render(self, app, template, context):
+        starts = g.get('metrics_renders')
+        if starts:
+            template_seconds.observe(time.perf_counter() - starts.pop(),
+                                     template=template.name)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_start')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+
+        if has_app_context() and 'metrics_start' in g:
+            g.metrics_queries += 1
+            g.metrics_query_seconds += elapsed
+
+        if elapsed >= self.slow_query_threshold:
+            slow_queries_total.inc()
+            slow_query_log.warning("%.3fs %s", elapsed, " ".join(statement.split()))
+
+    def _replica_health(self):
+        replicas = current_app.extensions.get('replicas')
+        if replicas is None:
+            return {}
+        return {url: int(healthy) for url, healthy in replicas.status()}
+
+    def metrics_view(self):
+        """Return every metric in Prometheus text format"""
+
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
@@ -0,0 +1,41 @@
+"""Indexes for the homepage, listings and tag lookups
+
+The indexes are built with CREATE INDEX CONCURRENTLY, outside of the
+migration transaction, so they can be added to a live database without
+locking out writes.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 09:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_users_name', 'users', ['last_name', 'first_name', 'id']),
+    ('ix_posts_created_at', 'posts', ['created_at', 'id']),
+    ('ix_posts_user_id_created_at', 'posts', ['user_id', 'created_at', 'id']),
+    ('ix_posts_tags_tag_id', 'posts_tags', ['tag_id', 'post_id']),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
@@ -0,0 +1,33 @@
+"""Add updated_at to users, posts and tags
+
+Existing rows are stamped with the time of the migration.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ['users', 'posts', 'tags']
+
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column(
+            'updated_at', sa.DateTime(), nullable=False,
+            server_default=sa.text("timezone('utc', now())")))
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_column(table, 'updated_at')
@@ -0,0 +1,38 @@
+"""Full-text search vector on posts, with a GIN index
+
+Adding the generated column rewrites the posts table under an exclusive
+lock, so run this upgrade during a quiet period. The index itself is built
+concurrently.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts', sa.Column(
+        'search_vector', postgresql.TSVECTOR(),
+        sa.Computed("setweight(to_tsvector('english', title), 'A') || "
+                    "setweight(to_tsvector('english', content), 'B')",
+                    persisted=True)))
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_posts_search_vector', 'posts', ['search_vector'],
+                        postgresql_using='gin', postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_posts_search_vector', table_name='posts')
+    op.drop_column('posts', 'search_vector')
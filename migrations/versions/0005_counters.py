@@ -0,0 +1,56 @@
+"""Add post_count to users and tags, tag_count to posts
+
+The counters are backfilled from posts and posts_tags, and the popularity
+sort indexes are built concurrently afterwards.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+COUNTERS = [
+    ('users', 'post_count',
+     "SELECT count(*) FROM posts WHERE posts.user_id = users.id"),
+    ('tags', 'post_count',
+     "SELECT count(*) FROM posts_tags WHERE posts_tags.tag_id = tags.id"),
+    ('posts', 'tag_count',
+     "SELECT count(*) FROM posts_tags WHERE posts_tags.post_id = posts.id"),
+]
+
+INDEXES = [
+    ('ix_users_post_count', 'users', ['post_count', 'id']),
+    ('ix_tags_post_count', 'tags', ['post_count', 'id']),
+]
+
+
+def upgrade():
+    for table, column, count in COUNTERS:
+        op.add_column(table, sa.Column(column, sa.Integer(), nullable=False,
+                                       server_default='0'))
+        op.execute(f"UPDATE {table} SET {column} = ({count})")
+
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
+
+    for table, column, count in COUNTERS:
+        op.drop_column(table, column)
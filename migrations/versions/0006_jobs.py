@@ -0,0 +1,43 @@
+"""Add jobs table for background jobs
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17 12:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('task', sa.Text(), nullable=False),
+        sa.Column('args', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column('key', sa.Text(), nullable=True),
+        sa.Column('status', sa.Text(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('run_at', sa.DateTime(), nullable=False),
+        sa.Column('locked_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('result', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('key')
+    )
+    op.create_index('ix_jobs_due', 'jobs', ['run_at', 'id'], unique=False,
+                    postgresql_where=sa.text("status = 'queued'"))
+
+
+def downgrade():
+    op.drop_index('ix_jobs_due', table_name='jobs')
+    op.drop_table('jobs')
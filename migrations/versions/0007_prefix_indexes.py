@@ -0,0 +1,39 @@
+"""Prefix indexes for the tag and post pickers
+
+lower(column) text_pattern_ops serves case-insensitive LIKE 'prefix%'
+whatever the database collation. Built concurrently, like 0002.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_tags_name_prefix', 'tags', 'lower(name) text_pattern_ops'),
+    ('ix_posts_title_prefix', 'posts', 'lower(title) text_pattern_ops'),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, expression in INDEXES:
+            op.create_index(name, table, [sa.text(expression)],
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, expression in INDEXES:
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
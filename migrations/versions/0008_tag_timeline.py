@@ -0,0 +1,59 @@
+"""Tag timelines: posts_tags.created_at with a (tag_id, created_at, post_id) index
+
+posts_tags.created_at copies the post's created_at. A trigger fills it on
+insert, so the ORM, the importer and raw SQL all keep it. The new index
+replaces ix_posts_tags_tag_id, which it covers.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-17 13:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+POSTS_TAGS_CREATED_AT = """
+CREATE OR REPLACE FUNCTION posts_tags_created_at() RETURNS trigger AS $$
+BEGIN
+    SELECT created_at INTO NEW.created_at FROM posts WHERE id = NEW.post_id;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER posts_tags_created_at BEFORE INSERT ON posts_tags
+FOR EACH ROW EXECUTE FUNCTION posts_tags_created_at();
+"""
+
+def upgrade():
+    op.add_column('posts_tags', sa.Column('created_at', sa.DateTime(), nullable=True))
+    op.execute(POSTS_TAGS_CREATED_AT)
+    op.execute("UPDATE posts_tags SET created_at = posts.created_at "
+               "FROM posts WHERE posts.id = posts_tags.post_id")
+    op.alter_column('posts_tags', 'created_at', nullable=False)
+
+    with op.get_context().autocommit_block():
+        op.create_index('ix_posts_tags_timeline', 'posts_tags',
+                        ['tag_id', 'created_at', 'post_id'],
+                        postgresql_concurrently=True)
+        op.drop_index('ix_posts_tags_tag_id', table_name='posts_tags',
+                      postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_posts_tags_tag_id', 'posts_tags', ['tag_id', 'post_id'],
+                        postgresql_concurrently=True)
+        op.drop_index('ix_posts_tags_timeline', table_name='posts_tags',
+                      postgresql_concurrently=True)
+
+    op.execute("DROP TRIGGER posts_tags_created_at ON posts_tags")
+    op.execute("DROP FUNCTION posts_tags_created_at()")
+    op.drop_column('posts_tags', 'created_at')
@@ -0,0 +1,45 @@
+"""Delete posts and tag links with ON DELETE CASCADE
+
+Each foreign key is replaced by a NOT VALID one, which only takes a brief
+lock. The swap is committed before the keys are validated, each in its
+own transaction, so the scans run without blocking writes.
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+FOREIGN_KEYS = [
+    ('posts', 'posts_user_id_fkey', 'user_id', 'users'),
+    ('posts_tags', 'posts_tags_post_id_fkey', 'post_id', 'posts'),
+    ('posts_tags', 'posts_tags_tag_id_fkey', 'tag_id', 'tags'),
+]
+
+
+def replace_foreign_keys(on_delete):
+    for table, name, column, referred in FOREIGN_KEYS:
+        op.execute(f"ALTER TABLE {table} DROP CONSTRAINT {name}, "
+                   f"ADD CONSTRAINT {name} FOREIGN KEY ({column}) "
+                   f"REFERENCES {referred} (id) {on_delete} NOT VALID")
+    # Leaving the migration's transaction releases the swap's locks
+    with op.get_context().autocommit_block():
+        for table, name, column, referred in FOREIGN_KEYS:
+            op.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+
+
+def upgrade():
+    replace_foreign_keys('ON DELETE CASCADE')
+
+
+def downgrade():
+    replace_foreign_keys('')
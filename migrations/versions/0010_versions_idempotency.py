@@ -0,0 +1,43 @@
+"""Add version columns for optimistic locking and idempotency_keys
+
+The version columns are added with a constant default, which PostgreSQL
+applies without rewriting the tables, and the default is dropped once
+existing rows have it.
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-17 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+VERSIONED = ('users', 'posts', 'tags')
+
+
+def upgrade():
+    for table in VERSIONED:
+        op.add_column(table, sa.Column('version', sa.Integer(), nullable=False,
+                                       server_default='1'))
+        op.alter_column(table, 'version', server_default=None)
+
+    op.create_table('idempotency_keys',
+        sa.Column('key', sa.Text(), nullable=False),
+        sa.Column('location', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade():
+    op.drop_table('idempotency_keys')
+    for table in VERSIONED:
+        op.drop_column(table, 'version')
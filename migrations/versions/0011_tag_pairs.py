@@ -0,0 +1,98 @@
+"""Tag co-occurrence matrix for related posts
+
+tag_pairs counts, for every two tags, the posts carrying both. Statement
+triggers on posts_tags keep it up to date. posts_tags is locked against
+writes while the triggers are created and the matrix is filled, so no link
+is counted twice or missed.
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-17 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0011'
+down_revision = '0010'
+branch_labels = None
+depends_on = None
+
+
+TAG_PAIRS_TRIGGERS = """
+CREATE OR REPLACE FUNCTION tag_pairs_added() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO tag_pairs (tag_id, other_id, posts)
+    SELECT a.tag_id, b.tag_id, count(*)
+    FROM posts_tags a
+    JOIN posts_tags b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id
+    WHERE a.post_id IN (SELECT post_id FROM added)
+      AND ((a.post_id, a.tag_id) IN (SELECT post_id, tag_id FROM added)
+           OR (b.post_id, b.tag_id) IN (SELECT post_id, tag_id FROM added))
+    GROUP BY a.tag_id, b.tag_id
+    ON CONFLICT (tag_id, other_id) DO UPDATE SET posts = tag_pairs.posts + EXCLUDED.posts;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION tag_pairs_removed() RETURNS trigger AS $$
+BEGIN
+    WITH before AS (
+        SELECT post_id, tag_id, false AS gone FROM posts_tags
+        WHERE post_id IN (SELECT post_id FROM removed)
+        UNION ALL
+        SELECT post_id, tag_id, true FROM removed
+    ), lost AS (
+        SELECT a.tag_id, b.tag_id AS other_id, count(*) AS posts
+        FROM before a
+        JOIN before b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id
+        WHERE a.gone OR b.gone
+        GROUP BY a.tag_id, b.tag_id
+    )
+    UPDATE tag_pairs SET posts = tag_pairs.posts - lost.posts
+    FROM lost
+    WHERE tag_pairs.tag_id = lost.tag_id AND tag_pairs.other_id = lost.other_id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tag_pairs_added AFTER INSERT ON posts_tags
+REFERENCING NEW TABLE AS added
+FOR EACH STATEMENT EXECUTE FUNCTION tag_pairs_added();
+
+CREATE TRIGGER tag_pairs_removed AFTER DELETE ON posts_tags
+REFERENCING OLD TABLE AS removed
+FOR EACH STATEMENT EXECUTE FUNCTION tag_pairs_removed();
+"""
+
+def upgrade():
+    op.create_table('tag_pairs',
+        sa.Column('tag_id', sa.Integer(), nullable=False),
+        sa.Column('other_id', sa.Integer(), nullable=False),
+        sa.Column('posts', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['tag_id'], ['tags.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['other_id'], ['tags.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('tag_id', 'other_id')
+    )
+
+    op.execute("LOCK TABLE posts_tags IN SHARE ROW EXCLUSIVE MODE")
+    op.execute(TAG_PAIRS_TRIGGERS)
+    op.execute("INSERT INTO tag_pairs (tag_id, other_id, posts) "
+               "SELECT a.tag_id, b.tag_id, count(*) FROM posts_tags a "
+               "JOIN posts_tags b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id "
+               "GROUP BY a.tag_id, b.tag_id")
+
+    op.create_index('ix_tag_pairs_companions', 'tag_pairs', ['tag_id', 'posts'])
+    op.create_index('ix_tag_pairs_other_id', 'tag_pairs', ['other_id'])
+
+
+def downgrade():
+    op.execute("DROP TRIGGER tag_pairs_removed ON posts_tags")
+    op.execute("DROP TRIGGER tag_pairs_added ON posts_tags")
+    op.execute("DROP FUNCTION tag_pairs_removed()")
+    op.execute("DROP FUNCTION tag_pairs_added()")
+    op.drop_index('ix_tag_pairs_other_id', table_name='tag_pairs')
+    op.drop_index('ix_tag_pairs_companions', table_name='tag_pairs')
+    op.drop_table('tag_pairs')
@@ -0,0 +1,51 @@
+"""Add archived_posts, partitioned by month, and archive_files
+
+Both start empty; `flask archive posts` and `flask archive export` fill
+them and manage archived_posts' month partitions.
+
+Revision ID: 0012
+Revises: 0011
+Create Date: 2026-10-17 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0012'
+down_revision = '0011'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('archived_posts',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('title', sa.Text(), nullable=False),
+        sa.Column('content', sa.Text(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('tags', postgresql.ARRAY(sa.Text()), nullable=False),
+        sa.Column('archived_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id', 'created_at'),
+        postgresql_partition_by='RANGE (created_at)'
+    )
+    op.create_table('archive_files',
+        sa.Column('month', sa.Date(), nullable=False),
+        sa.Column('path', sa.Text(), nullable=False),
+        sa.Column('min_id', sa.Integer(), nullable=False),
+        sa.Column('max_id', sa.Integer(), nullable=False),
+        sa.Column('posts', sa.Integer(), nullable=False),
+        sa.Column('exported_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('month')
+    )
+
+
+def downgrade():
+    op.drop_table('archive_files')
+    # Drops the month partitions with it
+    op.drop_table('archived_posts')
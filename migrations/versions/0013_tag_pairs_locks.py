@@ -0,0 +1,110 @@
+"""Lock posts in the tag_pairs triggers
+
+Two transactions linking tags to one post at once each counted only the
+links their snapshot saw, so the pair between their tags was never
+counted. The triggers now lock the rows of the posts whose links changed
+first: a second transaction waits for the first to commit and then counts
+against its links.
+
+Revision ID: 0013
+Revises: 0012
+Create Date: 2026-10-17 21:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0013'
+down_revision = '0012'
+branch_labels = None
+depends_on = None
+
+
+TAG_PAIRS_FUNCTIONS = """
+CREATE OR REPLACE FUNCTION tag_pairs_added() RETURNS trigger AS $$
+BEGIN
+    PERFORM 1 FROM posts WHERE id IN (SELECT post_id FROM added)
+    ORDER BY id FOR NO KEY UPDATE;
+    INSERT INTO tag_pairs (tag_id, other_id, posts)
+    SELECT a.tag_id, b.tag_id, count(*)
+    FROM posts_tags a
+    JOIN posts_tags b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id
+    WHERE a.post_id IN (SELECT post_id FROM added)
+      AND ((a.post_id, a.tag_id) IN (SELECT post_id, tag_id FROM added)
+           OR (b.post_id, b.tag_id) IN (SELECT post_id, tag_id FROM added))
+    GROUP BY a.tag_id, b.tag_id
+    ON CONFLICT (tag_id, other_id) DO UPDATE SET posts = tag_pairs.posts + EXCLUDED.posts;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION tag_pairs_removed() RETURNS trigger AS $$
+BEGIN
+    PERFORM 1 FROM posts WHERE id IN (SELECT post_id FROM removed)
+    ORDER BY id FOR NO KEY UPDATE;
+    WITH before AS (
+        SELECT post_id, tag_id, false AS gone FROM posts_tags
+        WHERE post_id IN (SELECT post_id FROM removed)
+        UNION ALL
+        SELECT post_id, tag_id, true FROM removed
+    ), lost AS (
+        SELECT a.tag_id, b.tag_id AS other_id, count(*) AS posts
+        FROM before a
+        JOIN before b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id
+        WHERE a.gone OR b.gone
+        GROUP BY a.tag_id, b.tag_id
+    )
+    UPDATE tag_pairs SET posts = tag_pairs.posts - lost.posts
+    FROM lost
+    WHERE tag_pairs.tag_id = lost.tag_id AND tag_pairs.other_id = lost.other_id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+PREVIOUS_FUNCTIONS = """
+CREATE OR REPLACE FUNCTION tag_pairs_added() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO tag_pairs (tag_id, other_id, posts)
+    SELECT a.tag_id, b.tag_id, count(*)
+    FROM posts_tags a
+    JOIN posts_tags b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id
+    WHERE a.post_id IN (SELECT post_id FROM added)
+      AND ((a.post_id, a.tag_id) IN (SELECT post_id, tag_id FROM added)
+           OR (b.post_id, b.tag_id) IN (SELECT post_id, tag_id FROM added))
+    GROUP BY a.tag_id, b.tag_id
+    ON CONFLICT (tag_id, other_id) DO UPDATE SET posts = tag_pairs.posts + EXCLUDED.posts;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION tag_pairs_removed() RETURNS trigger AS $$
+BEGIN
+    WITH before AS (
+        SELECT post_id, tag_id, false AS gone FROM posts_tags
+        WHERE post_id IN (SELECT post_id FROM removed)
+        UNION ALL
+        SELECT post_id, tag_id, true FROM removed
+    ), lost AS (
+        SELECT a.tag_id, b.tag_id AS other_id, count(*) AS posts
+        FROM before a
+        JOIN before b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id
+        WHERE a.gone OR b.gone
+        GROUP BY a.tag_id, b.tag_id
+    )
+    UPDATE tag_pairs SET posts = tag_pairs.posts - lost.posts
+    FROM lost
+    WHERE tag_pairs.tag_id = lost.tag_id AND tag_pairs.other_id = lost.other_id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+
+def upgrade():
+    op.execute(TAG_PAIRS_FUNCTIONS)
+
+
+def downgrade():
+    op.execute(PREVIOUS_FUNCTIONS)
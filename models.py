@@ -1,21 +1,155 @@
 """Models for Blogly."""
 
-from flask_sqlalchemy import SQLAlchemy
+from flask import has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, exc, orm, text
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR
 import datetime
-
-db = SQLAlchemy()
+import itertools
+import threading
+import time
 
 DEFAULT_IMAGE_URL = "https://www.freeiconspng.com/uploads/icon-user-blue-symbol-people-person-generic--public-domain--21.png"
 
+SEARCH_CONFIG = 'english'
+
+# Flask session key holding the time until which the client reads from the
+# primary, so it sees its own writes before they reach the replicas
+PRIMARY_UNTIL_KEY = '_primary_until'
+
+# Session.info key of the replica engine, or None, the session reads from
+REPLICA_KEY = 'replica'
+
+REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END")
+
+
+class ReplicaSet:
+    """Read replicas of one app, handed out round-robin while healthy.
+
+    A replica is checked at most every check_interval seconds, when it is
+    next picked. It is healthy if it answers and its replay lag is at most
+    max_lag seconds.
+    """
+
+    def __init__(self, urls, engine_options=None, check_interval=5.0, max_lag=10.0):
+        self.engines = [create_engine(url, **(engine_options or {})) for url in urls]
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._next = itertools.cycle(range(len(self.engines)))
+        self._checked = [0.0] * len(self.engines)
+        self._healthy = [True] * len(self.engines)
+        self._lock = threading.Lock()
+
+    def _check(self, index):
+        try:
+            with self.engines[index].connect() as conn:
+                lag = conn.execute(REPLICA_LAG_SQL).scalar()
+            healthy = lag is None or lag <= self.max_lag
+        except exc.DBAPIError:
+            healthy = False
+        self._healthy[index] = healthy
+        self._checked[index] = time.monotonic()
+
+    def pick(self):
+        """Return the engine of the next healthy replica, or None"""
+
+        for _ in range(len(self.engines)):
+            with self._lock:
+                index = next(self._next)
+            if time.monotonic() - self._checked[index] >= self.check_interval:
+                self._check(index)
+            if self._healthy[index]:
+                return self.engines[index]
+        return None
+
+    def status(self):
+        """Return [(engine url, healthy)] for every replica"""
+
+        return [(repr(engine.url), healthy)
+                for engine, healthy in zip(self.engines, self._healthy)]
+
+
+class RoutingSession(SignallingSession):
+    """Session sending reads of GET requests to a replica.
+
+    Everything else goes to the primary: other methods, flushes, sessions
+    holding unflushed changes, work outside requests, and requests from a
+    client that wrote within REPLICA_READ_YOUR_WRITES seconds.
+
+    The replica is picked once per session, which Flask-SQLAlchemy removes
+    at the end of each request, so a request reads one replica's snapshot
+    and holds a connection to that replica only.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.extensions.get('replicas')
+        if replicas is not None and self._reads_from_replica():
+            if REPLICA_KEY not in self.info:
+                self.info[REPLICA_KEY] = replicas.pick()
+            engine = self.info[REPLICA_KEY]
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+    def close(self):
+        self.info.pop(REPLICA_KEY, None)
+        super().close()
+
+    def _reads_from_replica(self):
+        if not has_request_context() or request.method not in ('GET', 'HEAD'):
+            return False
+        if self._flushing or self.new or self.dirty or self.deleted:
+            return False
+        return session.get(PRIMARY_UNTIL_KEY, 0) <= time.time()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions route reads to replicas"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+def _read_your_writes(db_session):
+    if has_request_context():
+        window = db_session.app.config.get('REPLICA_READ_YOUR_WRITES', 5)
+        session[PRIMARY_UNTIL_KEY] = time.time() + window
+
+
 def connect_db(app):
-    """Connect this database to Flask app"""
+    """Connect this database to Flask app, with its read replicas if any.
+
+    SQLALCHEMY_REPLICA_URIS lists the replicas' URIs; they share the
+    primary's SQLALCHEMY_ENGINE_OPTIONS.
+    """
     db.app = app
     db.init_app(app)
 
+    urls = app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+    app.config.setdefault('REPLICA_READ_YOUR_WRITES', 5)
+    if urls:
+        app.extensions['replicas'] = ReplicaSet(
+            urls,
+            app.config.get('SQLALCHEMY_ENGINE_OPTIONS'),
+            app.config.get('REPLICA_CHECK_INTERVAL', 5.0),
+            app.config.get('REPLICA_MAX_LAG', 10.0))
+
+    if not event.contains(db.session, 'after_commit', _read_your_writes):
+        event.listen(db.session, 'after_commit', _read_your_writes)
+
 
 class User(db.Model):
     """User Model"""
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('ix_users_name', 'last_name', 'first_name', 'id'),
+        db.Index('ix_users_post_count', 'post_count', 'id'),
+    )
 
     id = db.Column(db.Integer,
                     primary_key=True,
@@ -31,7 +165,28 @@ class User(db.Model):
                           nullable=False,
                           default=DEFAULT_IMAGE_URL)
 
-    posts = db.relationship('Post', backref='user', cascade="all, delete-orphan")
+    # Maintained by the write paths, see counters.py
+    post_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # UTC, as it feeds the Last-Modified header of pages showing the row
+    updated_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
+
+    # Optimistic locking: bumped by every ORM update, which fails with
+    # StaleDataError if another writer bumped it first
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # Posts and their tag links are deleted by the database's ON DELETE
+    # CASCADE, so deleting a user never loads them
+    posts = db.relationship('Post',
+                            backref=db.backref('user', lazy='joined', innerjoin=True),
+                            cascade="all, delete-orphan",
+                            passive_deletes=True,
+                            lazy='dynamic')
 
     @property
     def full_name(self):
@@ -44,6 +199,11 @@ class Post(db.Model):
     """ Model for post """
 
     __tablename__ = "posts"
+    __table_args__ = (
+        db.Index('ix_posts_created_at', 'created_at', 'id'),
+        db.Index('ix_posts_user_id_created_at', 'user_id', 'created_at', 'id'),
+        db.Index('ix_posts_search_vector', 'search_vector', postgresql_using='gin'),
+    )
 
     id = db.Column(db.Integer,
                     primary_key=True,
@@ -60,10 +220,29 @@ class Post(db.Model):
                             nullable=False,
                             default=datetime.datetime.now)
 
+    updated_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
+
     user_id = db.Column(db.Integer, 
-                        db.ForeignKey('users.id'), 
+                        db.ForeignKey('users.id', ondelete='CASCADE'),
                         nullable=False)
 
+    tag_count = db.Column(db.Integer, nullable=False, default=0)
+
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # Maintained by PostgreSQL on every insert and update; deferred so
+    # loading posts does not fetch it
+    search_vector = db.deferred(db.Column(
+        TSVECTOR,
+        db.Computed(f"setweight(to_tsvector('{SEARCH_CONFIG}', title), 'A') || "
+                    f"setweight(to_tsvector('{SEARCH_CONFIG}', content), 'B')",
+                    persisted=True)))
+
 
     @property
     def friendly_date(self):
@@ -75,40 +254,260 @@ class Post(db.Model):
         return f"<Post {self.id}  {self.title}  {self.content} {self.created_at} {self.user_id} >"
 
 
+# Prefix search for the post picker
+db.Index('ix_posts_title_prefix',
+         db.func.lower(Post.title).label('title_lower'),
+         postgresql_ops={'title_lower': 'text_pattern_ops'})
+
+
 
 class PostTag(db.Model):
     """ PostTag model that joins a post and a tag together"""
 
     __tablename__ = "posts_tags"
+    __table_args__ = (
+        # Each tag's timeline, newest first; the primary key only serves
+        # lookups by post_id
+        db.Index('ix_posts_tags_timeline', 'tag_id', 'created_at', 'post_id'),
+    )
 
     post_id = db.Column(db.Integer, 
-                        db.ForeignKey('posts.id'),         
+                        db.ForeignKey('posts.id', ondelete='CASCADE'),
                         primary_key=True)
 
     tag_id = db.Column(db.Integer,
-                        db.ForeignKey('tags.id'),
+                        db.ForeignKey('tags.id', ondelete='CASCADE'),
                         primary_key=True)
 
+    # Copy of the post's created_at, set by the posts_tags_created_at
+    # trigger however the row is inserted
+    created_at = db.Column(db.DateTime, nullable=False)
+
+
+POSTS_TAGS_CREATED_AT = """
+CREATE OR REPLACE FUNCTION posts_tags_created_at() RETURNS trigger AS $$
+BEGIN
+    SELECT created_at INTO NEW.created_at FROM posts WHERE id = NEW.post_id;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER posts_tags_created_at BEFORE INSERT ON posts_tags
+FOR EACH ROW EXECUTE FUNCTION posts_tags_created_at();
+"""
+
+event.listen(PostTag.__table__, 'after_create', db.DDL(POSTS_TAGS_CREATED_AT))
+
+# Keep tag_pairs exact by applying each statement's added and removed
+# links; posts_tags rows are never updated in place. Each trigger first
+# locks the rows of the posts whose links changed, so transactions changing
+# one post's tags take turns, and the later one counts against the earlier
+# one's committed links instead of a snapshot missing them
+TAG_PAIRS_TRIGGERS = """
+CREATE OR REPLACE FUNCTION tag_pairs_added() RETURNS trigger AS $$
+BEGIN
+    PERFORM 1 FROM posts WHERE id IN (SELECT post_id FROM added)
+    ORDER BY id FOR NO KEY UPDATE;
+    INSERT INTO tag_pairs (tag_id, other_id, posts)
+    SELECT a.tag_id, b.tag_id, count(*)
+    FROM posts_tags a
+    JOIN posts_tags b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id
+    WHERE a.post_id IN (SELECT post_id FROM added)
+      AND ((a.post_id, a.tag_id) IN (SELECT post_id, tag_id FROM added)
+           OR (b.post_id, b.tag_id) IN (SELECT post_id, tag_id FROM added))
+    GROUP BY a.tag_id, b.tag_id
+    ON CONFLICT (tag_id, other_id) DO UPDATE SET posts = tag_pairs.posts + EXCLUDED.posts;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION tag_pairs_removed() RETURNS trigger AS $$
+BEGIN
+    PERFORM 1 FROM posts WHERE id IN (SELECT post_id FROM removed)
+    ORDER BY id FOR NO KEY UPDATE;
+    WITH before AS (
+        SELECT post_id, tag_id, false AS gone FROM posts_tags
+        WHERE post_id IN (SELECT post_id FROM removed)
+        UNION ALL
+        SELECT post_id, tag_id, true FROM removed
+    ), lost AS (
+        SELECT a.tag_id, b.tag_id AS other_id, count(*) AS posts
+        FROM before a
+        JOIN before b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id
+        WHERE a.gone OR b.gone
+        GROUP BY a.tag_id, b.tag_id
+    )
+    UPDATE tag_pairs SET posts = tag_pairs.posts - lost.posts
+    FROM lost
+    WHERE tag_pairs.tag_id = lost.tag_id AND tag_pairs.other_id = lost.other_id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tag_pairs_added AFTER INSERT ON posts_tags
+REFERENCING NEW TABLE AS added
+FOR EACH STATEMENT EXECUTE FUNCTION tag_pairs_added();
+
+CREATE TRIGGER tag_pairs_removed AFTER DELETE ON posts_tags
+REFERENCING OLD TABLE AS removed
+FOR EACH STATEMENT EXECUTE FUNCTION tag_pairs_removed();
+"""
+
+event.listen(PostTag.__table__, 'after_create', db.DDL(TAG_PAIRS_TRIGGERS))
+
 
 
 class Tag(db.Model):
     """Tag Model"""
 
     __tablename__ = "tags"
+    __table_args__ = (
+        db.Index('ix_tags_post_count', 'post_count', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text, nullable=False, unique=True)
+    post_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1)
 
+    __mapper_args__ = {'version_id_col': version}
+
+    # posts_tags rows go with either side through ON DELETE CASCADE
     posts = db.relationship('Post', 
                             secondary="posts_tags", 
-                            # cascade= "all, delete"
-                            backref="tags")
+                            passive_deletes=True,
+                            backref=db.backref('tags', passive_deletes=True),
+                            lazy='dynamic')
+
+
+# Prefix search for the tag picker
+db.Index('ix_tags_name_prefix',
+         db.func.lower(Tag.name).label('name_lower'),
+         postgresql_ops={'name_lower': 'text_pattern_ops'})
+
+
+class TagPair(db.Model):
+    """Tag co-occurrence: how many posts carry both tag_id and other_id.
+
+    Both orders of each pair are stored. Maintained by the triggers in
+    TAG_PAIRS_TRIGGERS; pairs whose posts all lost a tag keep a count of 0.
+    """
+
+    __tablename__ = "tag_pairs"
+    __table_args__ = (
+        # A tag's most frequent companions first
+        db.Index('ix_tag_pairs_companions', 'tag_id', 'posts'),
+        db.Index('ix_tag_pairs_other_id', 'other_id'),
+    )
+
+    tag_id = db.Column(db.Integer,
+                       db.ForeignKey('tags.id', ondelete='CASCADE'),
+                       primary_key=True)
+    other_id = db.Column(db.Integer,
+                         db.ForeignKey('tags.id', ondelete='CASCADE'),
+                         primary_key=True)
+    posts = db.Column(db.Integer, nullable=False)
+
+
+
+class Job(db.Model):
+    """Background job, run by `flask jobs work` after its transaction commits"""
+
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # Workers only ever look for due queued jobs
+        db.Index('ix_jobs_due', 'run_at', 'id',
+                 postgresql_where=db.text("status = 'queued'")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    task = db.Column(db.Text, nullable=False)
+    args = db.Column(JSONB, nullable=False, default=dict)
+
+    # Enqueueing again with the same key is a no-op
+    key = db.Column(db.Text, unique=True)
+
+    status = db.Column(db.Text, nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    result = db.Column(JSONB)
 
+    created_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.task} {self.status} attempts={self.attempts}>"
+
+
+class IdempotencyKey(db.Model):
+    """Token of a create form submission already handled, see idempotency.py"""
+
+    __tablename__ = "idempotency_keys"
+
+    key = db.Column(db.Text, primary_key=True)
+
+    # Where the submission redirected to
+    location = db.Column(db.Text, nullable=False)
+
+    created_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.datetime.utcnow)
 
 
-    
+class ArchivedPost(db.Model):
+    """Post moved out of posts by `flask archive posts`, see archive.py.
 
+    The table is partitioned by created_at month, one partition per month
+    archived. Rows keep the post's id, and its tags by name, in the record
+    format of `flask import posts`.
+    """
 
+    __tablename__ = "archived_posts"
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created_at)'}
 
+    # Partitioned tables need the partition key in their primary key
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    created_at = db.Column(db.DateTime, primary_key=True)
+
+    title = db.Column(db.Text, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id', ondelete='CASCADE'),
+                        nullable=False)
+    tags = db.Column(ARRAY(db.Text), nullable=False, default=list)
+
+    archived_at = db.Column(db.DateTime,
+                            nullable=False,
+                            default=datetime.datetime.utcnow)
+
+    friendly_date = Post.friendly_date
 
 
+class ArchiveFile(db.Model):
+    """Month of archived posts exported to gzipped NDJSON by `flask archive export`"""
+
+    __tablename__ = "archive_files"
+
+    month = db.Column(db.Date, primary_key=True)
+    path = db.Column(db.Text, nullable=False)
+
+    # Range of the ids in the file, to find a post's file without opening others
+    min_id = db.Column(db.Integer, nullable=False)
+    max_id = db.Column(db.Integer, nullable=False)
+    posts = db.Column(db.Integer, nullable=False)
+
+    exported_at = db.Column(db.DateTime,
+                            nullable=False,
+                            default=datetime.datetime.utcnow)
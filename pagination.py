@@ -0,0 +1,160 @@
+"""Keyset (cursor) pagination for Blogly listings.
+
+Pages are fetched with ``WHERE (sort keys) > (last row's keys) LIMIT n``
+instead of OFFSET, so the cost of a page does not depend on how deep it is.
+Cursors are opaque to clients: base64 encoded JSON holding the sort key
+values of the boundary row and the direction to read in.
+"""
+
+import base64
+import binascii
+import datetime
+import json
+from urllib.parse import urlencode
+
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 50
+
+
+class Page:
+    """One page of results plus the cursors to reach its neighbours"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _decode_value(column, value):
+    """Return cursor value as the key column's type; ValueError if it is not"""
+
+    python_type = column.type.python_type
+    if python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(value)
+
+    # JSON turns whole floats into ints, and bool is a subclass of int
+    if python_type is float and isinstance(value, int):
+        value = float(value)
+    if isinstance(value, bool) or not isinstance(value, python_type):
+        raise ValueError(f"cursor value {value!r} is not {python_type.__name__}")
+    return value
+
+
+def encode_cursor(keys, row, direction):
+    """Return an opaque cursor pointing just past row in direction"""
+
+    values = [_encode_value(getattr(row, key.key)) for key in keys]
+    raw = json.dumps({"k": values, "d": direction}).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(keys, cursor):
+    """Return (values, direction) from cursor, aborting with 400 if invalid"""
+
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(data["k"], list) or len(data["k"]) != len(keys):
+            abort(400)
+        values = [_decode_value(key, value) for key, value in zip(keys, data["k"])]
+        direction = data["d"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        abort(400)
+
+    if direction not in ("next", "prev"):
+        abort(400)
+
+    return values, direction
+
+
+def cursor_url(cursor):
+    """Return relative URL of the current page's listing at cursor"""
+
+    args = request.args.to_dict()
+    args['cursor'] = cursor
+    return '?' + urlencode(args)
+
+
+def page_size():
+    """Return the configured number of rows per page"""
+
+    return current_app.config.get('PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def keyset(query, keys, descending, cursor, per_page):
+    """Return (query, direction) fetching up to per_page + 1 rows after cursor.
+
+    query may be a Query or a select(), so the async read path shares this
+    with paginate(). Pass the fetched rows to build_page().
+    """
+
+    direction = "next"
+    if cursor:
+        values, direction = decode_cursor(keys, cursor)
+
+    # Reading backwards means flipping both the comparison and the order,
+    # then reversing the fetched rows back into display order.
+    backwards = (direction == "prev") != descending
+    order = [key.desc() if backwards else key.asc() for key in keys]
+    query = query.order_by(None).order_by(*order)
+
+    if cursor:
+        boundary = tuple_(*keys)
+        if backwards:
+            query = query.filter(boundary < tuple_(*values))
+        else:
+            query = query.filter(boundary > tuple_(*values))
+
+    return query.limit(per_page + 1), direction
+
+
+def build_page(rows, keys, direction, cursor, per_page):
+    """Return a Page of rows fetched by a keyset() query"""
+
+    rows = list(rows)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if direction == "prev":
+        rows.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, bool(cursor)
+
+    next_cursor = prev_cursor = None
+    if rows and has_next:
+        next_cursor = encode_cursor(keys, rows[-1], "next")
+    if rows and has_prev:
+        prev_cursor = encode_cursor(keys, rows[0], "prev")
+
+    return Page(rows, next_cursor, prev_cursor)
+
+
+def paginate(query, keys, descending=False, cursor=None, per_page=None):
+    """Return a Page of query ordered by keys, starting after cursor.
+
+    keys are the columns the listing is sorted by and must end with a
+    unique column (normally the primary key) so every row has a distinct
+    position. All keys are sorted in the same direction.
+    """
+
+    if cursor is None:
+        cursor = request.args.get('cursor')
+    if per_page is None:
+        per_page = page_size()
+
+    query, direction = keyset(query, keys, descending, cursor, per_page)
+    return build_page(query.all(), keys, direction, cursor, per_page)
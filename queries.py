@@ -0,0 +1,245 @@
+"""Shared queries for Blogly views.
+
+Each helper loads exactly the relationships its template touches, so a view
+runs a fixed number of queries no matter how many rows it renders.
+"""
+
+from flask import abort, g
+from sqlalchemy.orm import joinedload, selectinload
+from archive import find_archived_post
+from identity import identities
+from models import db, User, Post, Tag, PostTag
+from pagination import paginate
+from related import related_post_ids
+
+# Sort keys of posts, and of a tag's posts read from its timeline in
+# posts_tags; the label lets cursors read post_id from Post rows
+POST_KEYS = [Post.created_at, Post.id]
+TAG_TIMELINE_KEYS = [PostTag.created_at, PostTag.post_id.label('id')]
+
+# Listing sort keys, by name and by popularity (descending)
+USER_KEYS = [User.last_name, User.first_name, User.id]
+USER_POPULAR_KEYS = [User.post_count, User.id]
+TAG_KEYS = [Tag.name, Tag.id]
+TAG_POPULAR_KEYS = [Tag.post_count, Tag.id]
+
+
+def recent_posts(limit=5):
+    """Return the newest posts with their author and tags loaded"""
+
+    return (Post.query
+            .options(joinedload(Post.user), selectinload(Post.tags))
+            .order_by(Post.created_at.desc(), Post.id.desc())
+            .limit(limit)
+            .all())
+
+
+def get_post(post_id):
+    """Return post with its author and tags loaded, or None"""
+
+    return (Post.query
+            .options(joinedload(Post.user), selectinload(Post.tags))
+            .get(post_id))
+
+
+def get_post_or_404(post_id):
+    """Return post with its author and tags loaded, or abort with 404"""
+
+    post = get_post(post_id)
+    if post is None:
+        abort(404)
+    return post
+
+
+def get_archived_post_or_404(post_id):
+    """Return (post, author, tags) of an archived post, or abort with 404"""
+
+    post = find_archived_post(post_id)
+    # Exported posts outlive their author's deletion, but are not shown
+    author = post and identities.user(post.user_id)
+    if author is None:
+        abort(404)
+    return post, author, identities.tags_named(post.tags)
+
+
+def _related_ids(post_id, tag_ids):
+    """Return related_post_ids(post_id, tag_ids), computed once per request.
+
+    A post page needs them twice, for its fingerprint and for rendering.
+    """
+
+    memo = g.setdefault('related_ids', {})
+    key = (post_id, tuple(sorted(tag_ids)))
+    if key not in memo:
+        memo[key] = related_post_ids(post_id, tag_ids)
+    return memo[key]
+
+
+def related_posts(post):
+    """Return (id, title) of the posts most related to post, best first"""
+
+    ids = _related_ids(post.id, [tag.id for tag in post.tags])
+    return _in_order(ids, db.session.query(Post.id, Post.title).filter(Post.id.in_(ids)))
+
+
+def _in_order(ids, rows):
+    by_id = {row.id: row for row in rows}
+    return [by_id[row_id] for row_id in ids if row_id in by_id]
+
+
+def get_user_or_404(user_id):
+    """Return user, or abort with 404"""
+
+    return User.query.get_or_404(user_id)
+
+
+def get_user_card_or_404(user_id):
+    """Return the cached display data of a user, or abort with 404"""
+
+    user = identities.user(user_id)
+    if user is None:
+        abort(404)
+    return user
+
+
+def get_tag_or_404(tag_id):
+    """Return tag, or abort with 404"""
+
+    return Tag.query.get_or_404(tag_id)
+
+
+def users_page(popular=False):
+    """Return the requested page of users, by name or most posts first"""
+
+    if popular:
+        return paginate(User.query, USER_POPULAR_KEYS, descending=True)
+    return paginate(User.query, USER_KEYS)
+
+
+def tags_page(popular=False):
+    """Return the requested page of tags, by name or most posts first"""
+
+    if popular:
+        return paginate(Tag.query, TAG_POPULAR_KEYS, descending=True)
+    return paginate(Tag.query, TAG_KEYS)
+
+
+def user_posts(user):
+    """Return the requested page of posts written by user, newest first"""
+
+    return paginate(user.posts, POST_KEYS, descending=True)
+
+
+def _tag_timeline(tag_id):
+    return Post.query.join(PostTag).filter(PostTag.tag_id == tag_id)
+
+
+def tag_posts(tag):
+    """Return the requested page of posts labelled with tag, newest first.
+
+    Reads the tag's timeline index, so the cost depends on the page size,
+    not on how many posts the tag has.
+    """
+
+    return paginate(_tag_timeline(tag.id), TAG_TIMELINE_KEYS, descending=True)
+
+
+def tag_post_choices(tag):
+    """Return (id, title) of the posts labelled with tag, ordered by title"""
+
+    return tag.posts.with_entities(Post.id, Post.title).order_by(Post.title).all()
+
+
+def typeahead(column, prefix, limit):
+    """Return (id, label) of rows whose column starts with prefix.
+
+    Matching ignores case and is served by the lower(column)
+    text_pattern_ops index, so it stays fast however big the table is.
+    """
+
+    model = column.class_
+    lowered = db.func.lower(column)
+    return (db.session.query(model.id, column.label('label'))
+            .filter(lowered.startswith(prefix.lower(), autoescape=True))
+            .order_by(lowered, model.id)
+            .limit(limit))
+
+
+###########################################################################
+
+# Fingerprints: the rows deciding what a read view renders, used for ETags
+
+
+def _posts_with_tags(posts):
+    """Return (post, author, tag) ids and update times for posts subquery"""
+
+    rows = (db.session.query(posts.c.id, posts.c.updated_at, User.updated_at,
+                             Tag.id, Tag.updated_at)
+            .join(User, User.id == posts.c.user_id)
+            .outerjoin(PostTag, PostTag.post_id == posts.c.id)
+            .outerjoin(Tag, Tag.id == PostTag.tag_id)
+            .order_by(posts.c.id, Tag.id)
+            .all())
+    return [tuple(row) for row in rows]
+
+
+def home_fingerprint(limit=5):
+    """Return fingerprint of the homepage"""
+
+    posts = (db.session.query(Post.id, Post.updated_at, Post.user_id)
+             .order_by(Post.created_at.desc(), Post.id.desc())
+             .limit(limit)
+             .subquery())
+    return _posts_with_tags(posts)
+
+
+def post_fingerprint(post_id):
+    """Return fingerprint of a post's page, or abort with 404"""
+
+    posts = (db.session.query(Post.id, Post.updated_at, Post.user_id)
+             .filter(Post.id == post_id)
+             .subquery())
+    rows = _posts_with_tags(posts)
+    if not rows:
+        post, author, tags = get_archived_post_or_404(post_id)
+        stamps = (db.session.query(User.updated_at).filter(User.id == author.id).all()
+                  + db.session.query(Tag.id, Tag.updated_at)
+                              .filter(Tag.id.in_([tag.id for tag in tags]))
+                              .order_by(Tag.id)
+                              .all())
+        return [(post.id, post.updated_at)] + [tuple(row) for row in stamps]
+
+    ids = _related_ids(post_id, [row[3] for row in rows if row[3] is not None])
+    related = _in_order(ids, db.session.query(Post.id, Post.updated_at)
+                                       .filter(Post.id.in_(ids)))
+    return rows + [tuple(row) for row in related]
+
+
+def _page_fingerprint(owner, query, keys=POST_KEYS):
+    """Return fingerprint of owner and the requested page of its posts"""
+
+    if owner is None:
+        abort(404)
+
+    page = paginate(query.with_entities(Post.id, Post.created_at, Post.updated_at),
+                    keys, descending=True)
+    return [tuple(owner), *((row.id, row.updated_at) for row in page),
+            page.next_cursor, page.prev_cursor]
+
+
+def user_fingerprint(user_id):
+    """Return fingerprint of a user's page, or abort with 404"""
+
+    owner = (db.session.query(User.id, User.updated_at)
+             .filter(User.id == user_id)
+             .first())
+    return _page_fingerprint(owner, Post.query.filter(Post.user_id == user_id))
+
+
+def tag_fingerprint(tag_id):
+    """Return fingerprint of a tag's page, or abort with 404"""
+
+    owner = (db.session.query(Tag.id, Tag.updated_at)
+             .filter(Tag.id == tag_id)
+             .first())
+    return _page_fingerprint(owner, _tag_timeline(tag_id), TAG_TIMELINE_KEYS)
@@ -0,0 +1,233 @@
+"""Rate limiting and admission control for Blogly.
+
+Two checks run before a view, so a rejected request never takes a
+database connection:
+
+1. Rate limits. Each client address gets a token bucket per rule: ``write``
+   for POST requests (every form and import) and ``search`` for /search
+   and the typeahead API. A bucket holds up to RATELIMIT_<RULE>_BURST
+   tokens and refills at RATELIMIT_<RULE>_RATE tokens a second; a request
+   with none left is refused with 429. Buckets live in the worker, or in a
+   Redis-compatible server at RATELIMIT_STORAGE_URL, so every worker
+   shares them.
+2. Admission. A worker lets at most ADMISSION_MAX_REQUESTS requests in at
+   once, ADMISSION_MAX_WRITES of them writes, so a burst of writes cannot
+   hold every pooled connection while readers queue behind it. A request
+   waits up to ADMISSION_TIMEOUT seconds for room, then is shed with 503.
+   Size the limits from the pool: past pool_size + max_overflow a request
+   would only wait on the pool instead.
+
+Refusals carry Retry-After and are counted in /metrics. Limits of 0 turn
+a check off. Behind a proxy, let werkzeug's ProxyFix set the client
+address. The async read routes of asgi.py bypass both checks; their
+forwarded requests do not.
+"""
+
+import collections
+import math
+import threading
+import time
+
+from flask import current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from metrics import registry
+
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+SEARCH_ENDPOINTS = {'views.search', 'api.typeahead'}
+
+# Monitoring has to keep working while the site is shedding load
+EXEMPT_ENDPOINTS = {'static', 'metrics'}
+
+# Refill the bucket at KEYS[1] and take a token. ARGV is burst, rate and
+# now; returns the seconds until a token is free, 0 if one was taken.
+TAKE_SCRIPT = """
+local burst, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(state[1]) or burst
+local stamp = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+rate_limited_total = registry.counter(
+    'blogly_rate_limited_total', "Requests refused with 429 by rate limit rule.")
+shed_total = registry.counter(
+    'blogly_shed_total', "Requests shed with 503 by the admission limit that was full.")
+
+
+class MemoryBuckets:
+    """Token buckets of one worker, the least recently used dropped past max_keys"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate):
+        """Take a token from key's bucket; return 0, or the seconds until one is free"""
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBuckets:
+    """Token buckets shared by every worker through a Redis-compatible server"""
+
+    def __init__(self, url, prefix="blogly:ratelimit:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RATELIMIT_STORAGE_URL requires the redis package")
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, burst, rate):
+        """Take a token from key's bucket; return 0, or the seconds until one is free"""
+
+        return float(self._take(keys=[self.prefix + key], args=[burst, rate, time.time()]))
+
+
+class AdmissionGate:
+    """Requests and writes in flight in one worker, admitted while under limits"""
+
+    def __init__(self):
+        self.requests = 0
+        self.writes = 0
+        self._changed = threading.Condition()
+
+    def _full(self, write, max_requests, max_writes):
+        if max_requests and self.requests >= max_requests:
+            return 'requests'
+        if write and max_writes and self.writes >= max_writes:
+            return 'writes'
+        return None
+
+    def enter(self, write, max_requests, max_writes, timeout):
+        """Admit a request, waiting up to timeout seconds for room.
+
+        Returns None once admitted, or the limit, 'requests' or 'writes',
+        still full when the time ran out.
+        """
+
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            full = self._full(write, max_requests, max_writes)
+            while full is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return full
+                self._changed.wait(remaining)
+                full = self._full(write, max_requests, max_writes)
+            self.requests += 1
+            self.writes += write
+        return None
+
+    def leave(self, write):
+        """Release the room of an admitted request"""
+
+        with self._changed:
+            self.requests -= 1
+            self.writes -= write
+            self._changed.notify_all()
+
+
+class Limiter:
+    """Flask extension rate limiting and admitting requests in a before_request hook"""
+
+    def __init__(self, app=None):
+        self.buckets = MemoryBuckets()
+        self.gate = AdmissionGate()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Install the hooks on app and pick the bucket store"""
+
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_STORAGE_URL', None)
+        app.config.setdefault('RATELIMIT_WRITE_BURST', 10)
+        app.config.setdefault('RATELIMIT_WRITE_RATE', 0.5)
+        app.config.setdefault('RATELIMIT_SEARCH_BURST', 20)
+        app.config.setdefault('RATELIMIT_SEARCH_RATE', 2.0)
+        app.config.setdefault('ADMISSION_MAX_REQUESTS', 0)
+        app.config.setdefault('ADMISSION_MAX_WRITES', 0)
+        app.config.setdefault('ADMISSION_TIMEOUT', 0.5)
+
+        if app.config['RATELIMIT_STORAGE_URL']:
+            self.buckets = RedisBuckets(app.config['RATELIMIT_STORAGE_URL'])
+
+        app.before_request(self._admit)
+        app.after_request(self._retry_after)
+        app.teardown_request(self._leave)
+        registry.gauge('blogly_requests_in_flight', "Requests admitted and not yet finished.",
+                       lambda: self.gate.requests)
+
+    def _rule(self):
+        if request.method in WRITE_METHODS:
+            return 'write'
+        if request.endpoint in SEARCH_ENDPOINTS:
+            return 'search'
+        return None
+
+    def _admit(self):
+        if request.endpoint in EXEMPT_ENDPOINTS:
+            return
+        config = current_app.config
+        rule = self._rule()
+
+        if rule is not None and config['RATELIMIT_ENABLED']:
+            name = rule.upper()
+            burst = config[f'RATELIMIT_{name}_BURST']
+            rate = config[f'RATELIMIT_{name}_RATE']
+            if burst and rate:
+                wait = self.buckets.take(f"{rule}:{request.remote_addr}", burst, rate)
+                if wait:
+                    rate_limited_total.inc(rule=rule)
+                    g.retry_after = math.ceil(wait)
+                    raise TooManyRequests("Too many requests; slow down and try again.")
+
+        write = rule == 'write'
+        full = self.gate.enter(write, config['ADMISSION_MAX_REQUESTS'],
+                               config['ADMISSION_MAX_WRITES'], config['ADMISSION_TIMEOUT'])
+        if full is not None:
+            shed_total.inc(limit=full)
+            g.retry_after = 1
+            raise ServiceUnavailable("The site is busy; try again shortly.")
+        g.admitted_write = write
+
+    def _retry_after(self, response):
+        retry_after = g.get('retry_after')
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    def _leave(self, exc):
+        write = g.pop('admitted_write', None)
+        if write is not None:
+            self.gate.leave(write)
+
+
+limiter = Limiter()
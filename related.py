@@ -0,0 +1,149 @@
+"""Related posts, ranked by the tags they share.
+
+tag_pairs holds the tag co-occurrence matrix: for every two tags, the
+number of posts carrying both. Statement-level triggers on posts_tags (see
+TAG_PAIRS_TRIGGERS in models.py) apply each statement's added and removed
+links to it, so it stays exact through every write path: the post and tag
+forms, the importer and cascading deletes alike. The triggers lock the
+posts whose links changed, so concurrent transactions tagging one post
+take turns instead of each missing the other's links.
+
+Finding a post's related posts reads a bounded number of rows however many
+posts its tags label:
+
+1. Companions: the COMPANIONS tags most often found with each of the
+   post's tags, from ix_tag_pairs_companions.
+2. Candidates: the newest CANDIDATES_PER_TAG posts of each of those tags,
+   from the tag timeline index, with their tags among those.
+3. Ranking: for each of the post's tags, a candidate scores 1 if it
+   carries the tag too, else the best cosine similarity
+   C[t, u] / sqrt(n_t * n_u) between the tag and one of its own tags.
+   Shared tags dominate; tags that usually go together break ties, and
+   then recency does.
+
+The matrix is recomputed from posts_tags with
+
+    flask related rebuild
+"""
+
+import collections
+import math
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select, text, true
+from sqlalchemy.orm import aliased
+
+from models import db, Tag, PostTag, TagPair
+
+RELATED_LIMIT = 5
+COMPANIONS = 3
+CANDIDATES_PER_TAG = 50
+
+REBUILD_SQL = text("""
+    INSERT INTO tag_pairs (tag_id, other_id, posts)
+    SELECT a.tag_id, b.tag_id, count(*)
+    FROM posts_tags a
+    JOIN posts_tags b ON b.post_id = a.post_id AND b.tag_id <> a.tag_id
+    GROUP BY a.tag_id, b.tag_id
+""")
+
+
+def companions_statement(tag_ids):
+    """Return a select of (tag_id, n_t, other_id, C[t, u], n_u) for tag_ids' companions"""
+
+    companion = (select(TagPair.other_id, TagPair.posts)
+                 .where(TagPair.tag_id == Tag.id, TagPair.posts > 0)
+                 .order_by(TagPair.posts.desc())
+                 .limit(COMPANIONS)
+                 .lateral())
+    other = aliased(Tag)
+    return (select(Tag.id, Tag.post_count, companion.c.other_id, companion.c.posts,
+                   other.post_count)
+            .select_from(Tag)
+            .join(companion, true())
+            .join(other, other.id == companion.c.other_id)
+            .where(Tag.id.in_(tag_ids)))
+
+
+def candidates_statement(post_id, tag_ids):
+    """Return a select of (post_id, tag_id, created_at) of candidate posts' links among tag_ids"""
+
+    tags = select(Tag.id).where(Tag.id.in_(tag_ids)).subquery()
+    newest = (select(PostTag.post_id)
+              .where(PostTag.tag_id == tags.c.id, PostTag.post_id != post_id)
+              .order_by(PostTag.created_at.desc(), PostTag.post_id.desc())
+              .limit(CANDIDATES_PER_TAG)
+              .lateral())
+    candidates = (select(newest.c.post_id).select_from(tags)
+                  .join(newest, true()).distinct().subquery())
+    # Probe each candidate's links by primary key, never a whole tag's; the
+    # limit, which a candidate cannot exceed, keeps the planner from
+    # flattening this into a join over every link of the tags
+    links = (select(PostTag.tag_id, PostTag.created_at)
+             .where(PostTag.post_id == candidates.c.post_id, PostTag.tag_id.in_(tag_ids))
+             .limit(len(tag_ids))
+             .lateral())
+    return (select(candidates.c.post_id, links.c.tag_id, links.c.created_at)
+            .select_from(candidates)
+            .join(links, true()))
+
+
+def rank(tag_ids, companions, candidates, limit=RELATED_LIMIT):
+    """Return ids of the best candidates for a post with tag_ids, best first"""
+
+    similarity = collections.defaultdict(dict)
+    for tag_id, tag_posts, other_id, both, other_posts in companions:
+        if tag_posts and other_posts:
+            similarity[tag_id][other_id] = both / math.sqrt(tag_posts * other_posts)
+
+    tags_of = collections.defaultdict(set)
+    created = {}
+    for post_id, tag_id, created_at in candidates:
+        tags_of[post_id].add(tag_id)
+        created[post_id] = created_at
+
+    def score(post_id):
+        theirs = tags_of[post_id]
+        return sum(1.0 if tag_id in theirs
+                   else max((similarity[tag_id].get(other, 0.0) for other in theirs), default=0.0)
+                   for tag_id in tag_ids)
+
+    ranked = sorted(tags_of, key=lambda post_id: (score(post_id), created[post_id], post_id),
+                    reverse=True)
+    return ranked[:limit]
+
+
+def related_post_ids(post_id, tag_ids, limit=RELATED_LIMIT):
+    """Return ids of the posts most related to post_id, which has tag_ids"""
+
+    if not tag_ids:
+        return []
+
+    companions = db.session.execute(companions_statement(tag_ids)).all()
+    expanded = set(tag_ids) | {row.other_id for row in companions}
+    candidates = db.session.execute(candidates_statement(post_id, expanded)).all()
+    return rank(tag_ids, companions, candidates, limit)
+
+
+def rebuild_tag_pairs():
+    """Recompute the co-occurrence matrix from posts_tags; return the number of pairs"""
+
+    db.session.query(TagPair).delete(synchronize_session=False)
+    return db.session.execute(REBUILD_SQL).rowcount
+
+
+###########################################################################
+
+# Command line
+
+related_cli = AppGroup('related', help="Maintain the tag co-occurrence matrix.")
+
+
+@related_cli.command('rebuild')
+def rebuild_command():
+    """Recompute the tag co-occurrence matrix from posts_tags."""
+
+    pairs = rebuild_tag_pairs()
+    db.session.commit()
+    click.echo(f"Rebuilt {pairs} tag pairs.")
@@ -0,0 +1,59 @@
+"""Full-text search over posts.
+
+Matching and ranking run against the GIN-indexed ``Post.search_vector``.
+Results are keyset-paginated on (rank, id), and highlighted snippets are
+computed with ``ts_headline`` for the posts of the current page only.
+"""
+
+from markupsafe import Markup, escape
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+
+from models import db, Post, PostTag, SEARCH_CONFIG
+from pagination import paginate
+
+# Control characters cannot appear in HTML text, so they can mark matches
+# in the raw snippet and be swapped for <mark> tags after escaping
+START_SEL, STOP_SEL = "\x02", "\x03"
+HEADLINE_OPTIONS = (f"StartSel={START_SEL}, StopSel={STOP_SEL}, "
+                    "MaxFragments=2, MaxWords=30, MinWords=10")
+
+
+def highlight(snippet):
+    """Return snippet HTML-escaped, with matches wrapped in <mark>"""
+
+    html = str(escape(snippet))
+    return Markup(html.replace(START_SEL, "<mark>").replace(STOP_SEL, "</mark>"))
+
+
+def search_posts(terms, tag_id=None, user_id=None):
+    """Return (page of post ids and ranks, posts, snippets) matching terms.
+
+    posts are the Post objects of the page in rank order, and snippets maps
+    each post id to its highlighted content.
+    """
+
+    tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, terms)
+    # ts_rank_cd returns float4; a cursor holding it as a Python float would
+    # not compare equal to the row's rank, so rank in double precision
+    rank = db.cast(func.ts_rank_cd(Post.search_vector, tsquery),
+                   DOUBLE_PRECISION).label('rank')
+
+    query = (db.session.query(Post.id, rank)
+             .filter(Post.search_vector.op('@@')(tsquery)))
+    if tag_id is not None:
+        query = query.join(PostTag, PostTag.post_id == Post.id).filter(PostTag.tag_id == tag_id)
+    if user_id is not None:
+        query = query.filter(Post.user_id == user_id)
+
+    page = paginate(query, [rank, Post.id], descending=True)
+    ids = [row.id for row in page]
+    if not ids:
+        return page, [], {}
+
+    by_id = {post.id: post for post in Post.query.filter(Post.id.in_(ids))}
+    headline = func.ts_headline(SEARCH_CONFIG, Post.content, tsquery, HEADLINE_OPTIONS)
+    snippets = {post_id: highlight(snippet) for post_id, snippet in
+                db.session.query(Post.id, headline).filter(Post.id.in_(ids))}
+
+    return page, [by_id[post_id] for post_id in ids], snippets
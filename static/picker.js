@@ -0,0 +1,57 @@
+/* Typeahead pickers: see templates/picker.html */
+
+document.querySelectorAll('.picker').forEach(function (picker) {
+  var name = picker.dataset.name;
+  var input = picker.querySelector('.picker-input');
+  var options = picker.querySelector('datalist');
+  var selected = picker.querySelector('.picker-selected');
+  var matches = {};
+  var timer = null;
+
+  function add(id, label) {
+    var fieldId = name + '_' + id;
+    if (document.getElementById(fieldId)) return;
+
+    var row = document.createElement('div');
+    var box = document.createElement('input');
+    box.className = 'form-check-input';
+    box.type = 'checkbox';
+    box.value = id;
+    box.id = fieldId;
+    box.name = name;
+    box.checked = true;
+    var text = document.createElement('label');
+    text.className = 'form-check-label';
+    text.htmlFor = fieldId;
+    text.textContent = label;
+    row.appendChild(box);
+    row.appendChild(text);
+    selected.appendChild(row);
+  }
+
+  function lookup() {
+    var url = picker.dataset.source + '?q=' + encodeURIComponent(input.value.trim());
+    fetch(url)
+      .then(function (resp) { return resp.json(); })
+      .then(function (body) {
+        matches = {};
+        options.innerHTML = '';
+        body.data.forEach(function (item) {
+          matches[item.label] = item.id;
+          var option = document.createElement('option');
+          option.value = item.label;
+          options.appendChild(option);
+        });
+      });
+  }
+
+  input.addEventListener('input', function () {
+    if (input.value in matches) {
+      add(matches[input.value], input.value);
+      input.value = '';
+      return;
+    }
+    clearTimeout(timer);
+    if (input.value.trim()) timer = setTimeout(lookup, 150);
+  });
+});
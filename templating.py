@@ -0,0 +1,65 @@
+"""Jinja settings and template precompilation for Blogly.
+
+Templates render with trim_blocks and lstrip_blocks, so block tags leave
+no blank lines or indentation behind in the HTML.
+
+With TEMPLATE_CACHE_DIR set, compiled templates are stored there as Jinja
+bytecode, shared by every worker on the host. Fill it when deploying with
+
+    flask templates compile
+
+and workers load each template's bytecode instead of parsing and
+compiling it on its first request. The cache is keyed by the template
+source, so an edited template is recompiled by whichever worker meets it
+first.
+"""
+
+import os
+import sys
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from jinja2 import FileSystemBytecodeCache
+
+
+def configure_templates(app):
+    """Apply the template settings to app's Jinja environment"""
+
+    env = app.jinja_env
+    env.trim_blocks = True
+    env.lstrip_blocks = True
+
+    cache_dir = app.config.get('TEMPLATE_CACHE_DIR')
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+
+def compile_templates(app):
+    """Compile every template of app, filling its bytecode cache; return their names"""
+
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
+
+
+###########################################################################
+
+# Command line
+
+templates_cli = AppGroup('templates', help="Precompile Jinja templates.")
+
+
+@templates_cli.command('compile')
+def compile_command():
+    """Compile every template into the TEMPLATE_CACHE_DIR bytecode cache."""
+
+    app = current_app._get_current_object()
+    if app.jinja_env.bytecode_cache is None:
+        click.echo("TEMPLATE_CACHE_DIR is not set, so there is no cache to fill.", err=True)
+        sys.exit(1)
+
+    names = compile_templates(app)
+    click.echo(f"Compiled {len(names)} templates into {app.config['TEMPLATE_CACHE_DIR']}.")
@@ -1,29 +1,47 @@
 from unittest import TestCase
+import base64
+import datetime
+import json
+import re
+from sqlalchemy import event, text
+from sqlalchemy.dialects import postgresql
 
-from app import app
-from models import db, User, Post, Tag, PostTag
+from app import create_app
+from models import db, User, Post, Tag, PostTag, Job
 
-# Use test database and don't clutter test with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///blogly_test'
-app.config['SQLALCHEMY_ECHO'] = False
-
-# Make Flask errors be real errors, rather than HTML pages with error infor
-app.config['TESTING'] = True
-
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+# Test database, real errors instead of error pages, no debug toolbar
+app = create_app('testing')
 
 db.drop_all()
 db.create_all()
 
+class QueryCounter:
+    """ Context manager counting SQL statements sent to the database"""
+
+    def __init__(self):
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(db.engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, "before_cursor_execute", self._count)
+
+
 class BloglyViewTestCase(TestCase):
     """ Tests view functions for Blogly app"""
 
     def setUp(self):
         """ Add sample user and post before every test """
 
-        User.query.delete()
+        Job.query.delete()
+        PostTag.query.delete()
         Post.query.delete()
+        User.query.delete()
         Tag.query.delete()
 
         user = User(first_name="TestUser", last_name="TestLastName", image_url="https://www.freeiconspng.com/uploads/icon-user-blue-symbol-people-person-generic--public-domain--21.png")
@@ -255,7 +273,7 @@ class BloglyViewTestCase(TestCase):
         """Check if form to edit a specific form is rendered"""
 
         with app.test_client() as client:
-            resp = client.get("/tags/{self.tag_id}/edit")
+            resp = client.get(f"/tags/{self.tag_id}/edit")
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -281,4 +299,1234 @@ class BloglyViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
-            self.assertIn('<h1>All Tags</h1>', html)
\ No newline at end of file
+            self.assertIn('<h1>All Tags</h1>', html)
+
+###########################################################################
+
+# Tests for number of queries per view
+
+    def count_queries(self, url):
+        """ Return number of queries run while rendering url"""
+        with app.test_client() as client:
+            with QueryCounter() as counter:
+                resp = client.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            return counter.count
+
+
+    def add_tagged_posts(self, n):
+        """ Add n more posts for the sample user, each with its own tag"""
+        tag = Tag.query.get(self.tag_id)
+
+        for i in range(n):
+            post = Post(title=f"ExtraPost{i}", content="Extra", user_id=self.user_id, tags=[tag, Tag(name=f"ExtraTag{i}")])
+            db.session.add(post)
+
+        db.session.commit()
+
+
+    def test_query_counts_do_not_grow_with_rows(self):
+        """ Check that each read view runs the same number of queries regardless of row count"""
+        urls = ["/",
+                f"/users/{self.user_id}",
+                f"/posts/{self.post_id}",
+                f"/posts/{self.post_id}/edit",
+                f"/tags/{self.tag_id}",
+                f"/tags/{self.tag_id}/edit"]
+
+        before = {url: self.count_queries(url) for url in urls}
+        self.add_tagged_posts(5)
+        after = {url: self.count_queries(url) for url in urls}
+
+        self.assertEqual(before, after)
+
+
+    def test_home_query_count(self):
+        """ Check that homepage loads its ETag fingerprint, then posts, authors and tags in two queries"""
+        self.add_tagged_posts(5)
+
+        self.assertEqual(self.count_queries("/"), 3)
+
+###########################################################################
+
+# Tests for paginated listings
+
+    def test_users_keyset_pagination(self):
+        """ Check that next and previous cursors walk every user exactly once"""
+        for i in range(4):
+            db.session.add(User(first_name=f"Page{i}", last_name="Zed"))
+        db.session.commit()
+
+        app.config['PAGE_SIZE'] = 2
+        try:
+            with app.test_client() as client:
+                seen = []
+                url = "/users"
+                pages = []
+                while url:
+                    html = client.get(url).get_data(as_text=True)
+                    pages.append(html)
+                    seen.extend(re.findall(r'<a href="/users/\d+">(\w+)', html))
+                    cursor = re.search(r'href="\?cursor=([^"]+)">Next', html)
+                    url = cursor and f"/users?cursor={cursor.group(1)}"
+
+                prev = re.search(r'href="\?cursor=([^"]+)">Previous', pages[-1]).group(1)
+                html = client.get(f"/users?cursor={prev}").get_data(as_text=True)
+        finally:
+            app.config['PAGE_SIZE'] = 50
+
+        self.assertEqual(seen, ["TestUser", "Page0", "Page1", "Page2", "Page3"])
+        self.assertEqual(len(pages), 3)
+        self.assertIn("Page1", html)
+        self.assertIn("Page2", html)
+
+
+    def test_invalid_cursor(self):
+        """ Check that a tampered cursor is rejected"""
+        with app.test_client() as client:
+            resp = client.get("/tags?cursor=not-a-cursor")
+
+            self.assertEqual(resp.status_code, 400)
+
+
+    def test_cursor_with_wrong_value_types(self):
+        """ Check that a well-formed cursor holding values of the wrong types is rejected"""
+        cursors = [{"k": [[1], {}, 3], "d": "next"},
+                   {"k": ["Zed", "Ann", "3"], "d": "next"},
+                   {"k": ["Zed", "Ann"], "d": "next"},
+                   {"k": {"a": 1}, "d": "prev"},
+                   ["Zed", "Ann", 3]]
+
+        with app.test_client() as client:
+            for data in cursors:
+                cursor = base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+                resp = client.get(f"/users?cursor={cursor}")
+
+                self.assertEqual(resp.status_code, 400, data)
+
+###########################################################################
+
+# Tests for query plans of hot queries
+
+    def explain(self, query):
+        """ Return the query plan of query, discouraging sequential scans"""
+        sql = query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        rows = db.session.execute(text(f"EXPLAIN {sql}"))
+        return "\n".join(row[0] for row in rows)
+
+
+    def test_hot_queries_use_indexes(self):
+        """ Check that homepage, listing and tag queries are served by indexes"""
+        user = User.query.get(self.user_id)
+        tag = Tag.query.get(self.tag_id)
+        plans = {
+            "ix_posts_created_at": Post.query.order_by(Post.created_at.desc(), Post.id.desc()).limit(5),
+            "ix_users_name": User.query.order_by(User.last_name, User.first_name, User.id).limit(50),
+            "ix_posts_user_id_created_at": user.posts.order_by(Post.created_at.desc(), Post.id.desc()).limit(50),
+            "ix_posts_tags_timeline": (Post.query.join(PostTag).filter(PostTag.tag_id == tag.id)
+                                       .order_by(PostTag.created_at.desc(), PostTag.post_id.desc()).limit(50)),
+        }
+
+        for index, query in plans.items():
+            self.assertIn(index, self.explain(query))
+
+###########################################################################
+
+# Tests for page cache
+
+    def test_cached_page_runs_no_queries(self):
+        """ Check that a repeated read of a post is served from the cache"""
+        url = f"/posts/{self.post_id}"
+        self.count_queries(url)
+
+        self.assertEqual(self.count_queries(url), 0)
+
+
+    def test_cache_invalidated_on_write(self):
+        """ Check that readers see an edit as soon as it is committed"""
+        url = f"/posts/{self.post_id}"
+        self.count_queries(url)
+
+        with app.test_client() as writer:
+            d = {"title": "Test4Post", "content": "Edited"}
+            writer.post(f"/posts/{self.post_id}/edit", data=d)
+
+        with app.test_client() as reader:
+            html = reader.get(url).get_data(as_text=True)
+
+            self.assertIn('<h1>Test4Post</h1>', html)
+
+###########################################################################
+
+# Tests for conditional GET
+
+    def test_not_modified(self):
+        """ Check that a matching ETag or Last-Modified gets a 304 without rendering"""
+        with app.test_client() as client:
+            resp = client.get(f"/tags/{self.tag_id}")
+            etag = resp.headers["ETag"]
+            last_modified = resp.headers["Last-Modified"]
+
+            resp = client.get(f"/tags/{self.tag_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            resp = client.get(f"/tags/{self.tag_id}", headers={"If-Modified-Since": last_modified})
+            self.assertEqual(resp.status_code, 304)
+
+
+    def test_last_modified_moves_after_delete(self):
+        """ Check that deleting a user's newest post moves their page's Last-Modified forward"""
+        long_ago = datetime.datetime(2020, 1, 1)
+        post = Post(title="Newest", content="Gone soon", user_id=self.user_id,
+                    updated_at=datetime.datetime(2020, 1, 2))
+        db.session.add(post)
+        db.session.commit()
+        User.query.filter_by(id=self.user_id).update({"updated_at": long_ago})
+        Post.query.filter_by(id=self.post_id).update({"updated_at": long_ago})
+        db.session.commit()
+
+        with app.test_client() as client:
+            url = f"/users/{self.user_id}"
+            last_modified = client.get(url).headers["Last-Modified"]
+
+            with app.test_client() as writer:
+                writer.post(f"/posts/{post.id}/delete")
+
+            resp = client.get(url, headers={"If-Modified-Since": last_modified})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn(f"/posts/{post.id}", resp.get_data(as_text=True))
+
+
+    def test_homepage_sends_no_last_modified(self):
+        """ Check that homepage relies on its ETag alone"""
+        with app.test_client() as client:
+            resp = client.get("/")
+
+            self.assertIn("ETag", resp.headers)
+            self.assertNotIn("Last-Modified", resp.headers)
+
+
+    def test_etag_changes_after_edit(self):
+        """ Check that editing a post's tags gives its page a new ETag"""
+        with app.test_client() as client:
+            url = f"/posts/{self.post_id}"
+            etag = client.get(url).headers["ETag"]
+
+            d = {"title": "TestPost", "content": "Blogly1234", "tags": [str(self.tag_id)]}
+            client.post(f"/posts/{self.post_id}/edit", data=d, follow_redirects=True)
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+###########################################################################
+
+# Tests for JSON API
+
+    def test_api_list_with_fields(self):
+        """ Check that API lists return only the requested fields"""
+        with app.test_client() as client:
+            resp = client.get("/api/v1/users?fields=id,first_name")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["data"], [{"id": self.user_id, "first_name": "TestUser"}])
+            self.assertIsNone(resp.json["next_cursor"])
+
+
+    def test_api_unknown_field(self):
+        """ Check that an unknown field is rejected with a JSON error"""
+        with app.test_client() as client:
+            resp = client.get(f"/api/v1/posts/{self.post_id}?fields=password")
+
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json["error"], "Bad Request")
+
+
+    def test_api_export_ndjson(self):
+        """ Check that export streams one JSON object per line"""
+        self.add_tagged_posts(3)
+        with app.test_client() as client:
+            resp = client.get("/api/v1/posts_tags/export")
+            lines = resp.get_data(as_text=True).splitlines()
+
+            self.assertEqual(resp.mimetype, "application/x-ndjson")
+            self.assertEqual(len(lines), 6)
+            self.assertEqual(set(json.loads(lines[0])), {"post_id", "tag_id"})
+
+###########################################################################
+
+# Tests for bulk import
+
+    def test_import_posts_ndjson(self):
+        """ Check that posts import in bulk with their tags, rejecting malformed rows"""
+        lines = [
+            {"title": "Imported1", "content": "One", "user_id": self.user_id, "tags": ["TestTag", "NewTag"]},
+            {"title": "Imported2", "content": "Two", "user_id": self.user_id},
+            {"title": "Imported3", "content": "Three", "user_id": 0},
+            {"title": "TestPost", "content": "Duplicate", "user_id": self.user_id},
+            {"content": "No title", "user_id": self.user_id},
+        ]
+        body = "\n".join(json.dumps(line) for line in lines) + "\n{not json"
+
+        with app.test_client() as client:
+            resp = client.post("/api/v1/posts/import", data=body, content_type="application/x-ndjson")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["inserted"], 2)
+            self.assertEqual([r["line"] for r in resp.json["rejected"]], [3, 4, 5, 6])
+
+        post = Post.query.filter_by(title="Imported1").one()
+        self.assertEqual(sorted(tag.name for tag in post.tags), ["NewTag", "TestTag"])
+
+
+    def test_import_users_csv(self):
+        """ Check that users import from CSV with default images"""
+        body = "first_name,last_name,image_url\nAda,Lovelace,\nAlan,,\n"
+
+        with app.test_client() as client:
+            resp = client.post("/api/v1/users/import", data=body, content_type="text/csv")
+
+            self.assertEqual(resp.json["inserted"], 1)
+            self.assertEqual(resp.json["rejected"], [{"line": 3, "reason": "missing last_name"}])
+
+###########################################################################
+
+# Tests for search
+
+    def test_search_ranks_and_highlights(self):
+        """ Check that search ranks title matches first and highlights escaped snippets"""
+        tag = Tag.query.get(self.tag_id)
+        db.session.add_all([
+            Post(title="Gardening tips", content="Water tomatoes & beans daily", user_id=self.user_id),
+            Post(title="Cooking", content="Slice the tomatoes thin", user_id=self.user_id, tags=[tag]),
+            Post(title="Tomatoes", content="All about tomatoes", user_id=self.user_id),
+        ])
+        db.session.commit()
+
+        with app.test_client() as client:
+            html = client.get("/search?q=tomato").get_data(as_text=True)
+
+            titles = re.findall(r'<a href="/posts/\d+">([^<]+)</a>', html)
+            self.assertEqual(titles[0], "Tomatoes")
+            self.assertEqual(len(titles), 3)
+            self.assertIn("<mark>tomatoes</mark> &amp; beans", html)
+
+            html = client.get(f"/search?q=tomato&tag={self.tag_id}").get_data(as_text=True)
+            self.assertEqual(re.findall(r'<a href="/posts/\d+">([^<]+)</a>', html), ["Cooking"])
+
+
+    def test_search_pagination(self):
+        """ Check that search pages follow each other by rank without repeats"""
+        for i in range(3):
+            db.session.add(Post(title=f"Walrus {i}", content="walrus " * (i + 1), user_id=self.user_id))
+        db.session.commit()
+
+        app.config['PAGE_SIZE'] = 1
+        try:
+            with app.test_client() as client:
+                seen = []
+                url = "/search?q=walrus"
+                while url and len(seen) < 10:
+                    html = client.get(url).get_data(as_text=True)
+                    seen.extend(re.findall(r'<a href="/posts/\d+">([^<]+)</a>', html))
+                    cursor = re.search(r'href="([^"]+)">Next', html)
+                    url = cursor and "/search" + cursor.group(1).replace("&amp;", "&")
+        finally:
+            app.config['PAGE_SIZE'] = 50
+
+        self.assertEqual(sorted(seen), ["Walrus 0", "Walrus 1", "Walrus 2"])
+
+
+    def test_search_pagination_tied_ranks(self):
+        """ Check that search pages through posts with equal ranks without skipping or repeating"""
+        for i in range(4):
+            db.session.add(Post(title=f"Narwhal {i}", content="same words", user_id=self.user_id))
+        db.session.commit()
+
+        app.config['PAGE_SIZE'] = 1
+        try:
+            with app.test_client() as client:
+                seen = []
+                url = "/search?q=narwhal"
+                while url and len(seen) < 10:
+                    html = client.get(url).get_data(as_text=True)
+                    seen.extend(re.findall(r'<a href="/posts/\d+">([^<]+)</a>', html))
+                    cursor = re.search(r'href="([^"]+)">Next', html)
+                    url = cursor and "/search" + cursor.group(1).replace("&amp;", "&")
+        finally:
+            app.config['PAGE_SIZE'] = 50
+
+        self.assertEqual(seen, ["Narwhal 3", "Narwhal 2", "Narwhal 1", "Narwhal 0"])
+
+
+    def test_import_explicit_ids(self):
+        """ Check that duplicate ids in a batch are rejected and rows without ids follow explicit ones"""
+        next_id = db.session.query(db.func.max(User.id)).scalar() + 1
+        lines = [
+            {"id": next_id, "first_name": "Ada", "last_name": "Lovelace"},
+            {"id": next_id, "first_name": "Copy", "last_name": "Cat"},
+            {"id": next_id + 1, "first_name": "Alan", "last_name": "Turing"},
+            {"first_name": "Grace", "last_name": "Hopper"},
+        ]
+        body = "\n".join(json.dumps(line) for line in lines)
+
+        with app.test_client() as client:
+            resp = client.post("/api/v1/users/import?format=ndjson", data=body)
+            self.assertEqual(resp.json["inserted"], 3)
+            self.assertEqual(resp.json["rejected"], [{"line": 2, "reason": f"user {next_id} already exists"}])
+
+            resp = client.post("/api/v1/users/import", data=json.dumps({"first_name": "Linus", "last_name": "T"}))
+            self.assertEqual(resp.json["inserted"], 1)
+
+        self.assertEqual(User.query.get(next_id + 2).first_name, "Grace")
+
+###########################################################################
+
+# Tests for instrumentation
+
+    def test_metrics_record_route_and_queries(self):
+        """ Check that a request shows up in /metrics with its query count"""
+        from metrics import request_queries, template_seconds
+
+        route = "/posts/<int:post_id>"
+        before = request_queries.count(route=route)
+        with app.test_client() as client:
+            client.get(f"/posts/{self.post_id}", headers={"Cache-Control": "no-cache"})
+            resp = client.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(request_queries.count(route=route), before + 1)
+        self.assertGreater(template_seconds.count(template="posts/post_details.html"), 0)
+        self.assertIn(f'blogly_request_seconds_count{{route="{route}"}}', text)
+        self.assertIn('# TYPE blogly_request_queries histogram', text)
+
+
+    def test_slow_query_log(self):
+        """ Check that statements over the threshold are logged"""
+        from metrics import metrics
+
+        threshold = metrics.slow_query_threshold
+        metrics.slow_query_threshold = 0
+        try:
+            with self.assertLogs('blogly.slow_queries', level='WARNING') as logs:
+                db.session.execute(text("SELECT 1"))
+        finally:
+            metrics.slow_query_threshold = threshold
+
+        self.assertIn("SELECT 1", logs.output[0])
+
+###########################################################################
+
+# Tests for configuration
+
+    def test_production_config(self):
+        """ Check that production skips the toolbar and echo and tunes the pool"""
+        from config import ProductionConfig
+
+        self.assertFalse(ProductionConfig.DEBUG_TB_ENABLED)
+        self.assertFalse(ProductionConfig.SQLALCHEMY_ECHO)
+        self.assertEqual(set(ProductionConfig.SQLALCHEMY_ENGINE_OPTIONS),
+                         {"pool_size", "max_overflow", "pool_pre_ping", "pool_recycle"})
+
+###########################################################################
+
+# Tests for benchmark suite
+
+    def test_bench_seed_and_run(self):
+        """ Check that seeding is deterministic and every route is benchmarked"""
+        import bench
+
+        bench.seed_data(users=5, posts=30, tags=8, seed=1)
+        first = [(p.title, p.user_id, [t.id for t in p.tags]) for p in Post.query.order_by(Post.id)]
+        bench.seed_data(users=5, posts=30, tags=8, seed=1)
+        second = [(p.title, p.user_id, [t.id for t in p.tags]) for p in Post.query.order_by(Post.id)]
+        self.assertEqual(first, second)
+        self.assertEqual(len(first), 30)
+
+        results = bench.run_benchmarks(app, requests=3)
+        self.assertEqual(set(results), set(bench.ROUTES))
+        for name, result in results.items():
+            self.assertEqual(result["errors"], 0, name)
+            self.assertGreater(result["queries_per_request"], 0, name)
+
+        self.assertEqual(bench.compare(results, results), [])
+        slower = {"home": dict(results["home"], p95_ms=results["home"]["p95_ms"] / 2 - 1,
+                               queries_per_request=0)}
+        self.assertEqual(len(bench.compare(results, slower)), 2)
+
+        concurrent = bench.run_concurrent(app, ["show_tag"], requests=6, concurrency=3)
+        self.assertEqual(set(concurrent), {"show_tag sync", "show_tag async"})
+        for name, result in concurrent.items():
+            self.assertEqual((result["requests"], result["errors"]), (6, 0), name)
+
+###########################################################################
+
+# Tests for denormalized counters
+
+    def counts(self):
+        """ Return (user post_count, tag post_count, post tag_count) of the samples"""
+        db.session.expire_all()
+        return (User.query.get(self.user_id).post_count,
+                Tag.query.get(self.tag_id).post_count,
+                Post.query.get(self.post_id).tag_count)
+
+
+    def test_counters_follow_writes(self):
+        """ Check that every write path keeps the counters exact"""
+        from counters import reconcile_counts
+
+        reconcile_counts()
+        db.session.commit()
+        self.assertEqual(self.counts(), (1, 0, 0))
+
+        with app.test_client() as client:
+            client.post(f"/users/{self.user_id}/posts/new",
+                        data={"title": "Counted", "content": "x", "tags": [self.tag_id]})
+            new_id = Post.query.filter_by(title="Counted").one().id
+            self.assertEqual(self.counts(), (2, 1, 0))
+
+            client.post(f"/tags/{self.tag_id}/edit",
+                        data={"name": "TestTag", "posts": [self.post_id, new_id]})
+            self.assertEqual(self.counts(), (2, 2, 1))
+
+            client.post(f"/posts/{new_id}/edit", data={"title": "Counted", "content": "x"})
+            self.assertEqual(self.counts(), (2, 1, 1))
+            self.assertEqual(Post.query.get(new_id).tag_count, 0)
+
+            client.post(f"/posts/{new_id}/delete")
+            self.assertEqual(self.counts(), (1, 1, 1))
+
+            other = User(first_name="Other", last_name="Author")
+            db.session.add(other)
+            db.session.commit()
+            client.post(f"/users/{other.id}/posts/new",
+                        data={"title": "Doomed", "content": "x", "tags": [self.tag_id]})
+            self.assertEqual(self.counts(), (1, 2, 1))
+            client.post(f"/users/{other.id}/delete")
+            self.assertEqual(self.counts(), (1, 1, 1))
+
+            client.post(f"/tags/{self.tag_id}/delete")
+            self.assertEqual(Post.query.get(self.post_id).tag_count, 0)
+
+        self.assertEqual(set(reconcile_counts().values()), {0})
+
+
+    def test_delete_user_cascades_in_database(self):
+        """ Check that deleting a user runs the same statements however many posts they have"""
+        counts = []
+        for n in (1, 20):
+            user = User(first_name="Prolific", last_name=f"Author{n}")
+            db.session.add(user)
+            db.session.commit()
+            self.add_posts_for(user, n)
+
+            with app.test_client() as client:
+                with QueryCounter() as counter:
+                    client.post(f"/users/{user.id}/delete")
+            counts.append(counter.count)
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(Post.query.filter(Post.title.like("Prolific%")).count(), 0)
+        self.assertEqual(PostTag.query.count(), 0)
+        self.assertEqual(Tag.query.get(self.tag_id).post_count, 0)
+
+    def add_posts_for(self, user, n):
+        """ Add n posts by user, each tagged with the sample tag, keeping counters right"""
+        tag = Tag.query.get(self.tag_id)
+        for i in range(n):
+            db.session.add(Post(title=f"Prolific{user.id}-{i}", content="x", user=user,
+                                tags=[tag], tag_count=1))
+        user.post_count = n
+        tag.post_count += n
+        db.session.commit()
+
+
+    def test_popular_sort(self):
+        """ Check that sorting tags by popularity reads the counter in one query"""
+        Tag.query.get(self.tag_id).post_count = 3
+        db.session.add(Tag(name="Unused"))
+        db.session.commit()
+
+        self.assertEqual(self.count_queries("/tags?sort=popular"), 1)
+        with app.test_client() as client:
+            html = client.get("/tags?sort=popular").get_data(as_text=True)
+        self.assertLess(html.index("TestTag"), html.index("Unused"))
+        self.assertIn("(3 posts)", html)
+
+###########################################################################
+
+# Tests for background jobs
+
+    def test_background_import(self):
+        """ Check that a background import is queued once per key and run by a worker"""
+        from jobs import queue_depth, run_pending
+
+        body = json.dumps({"first_name": "Queued", "last_name": "Person"})
+        headers = {"Idempotency-Key": "abc"}
+        with app.test_client() as client:
+            first = client.post("/api/v1/users/import?background=1", data=body, headers=headers)
+            again = client.post("/api/v1/users/import?background=1", data=body, headers=headers)
+            self.assertEqual(first.status_code, 202)
+            self.assertEqual(first.json["job"], again.json["job"])
+            self.assertEqual(queue_depth()["queued"], 1)
+            self.assertIsNone(User.query.filter_by(first_name="Queued").first())
+
+            self.assertEqual(run_pending(), 1)
+            resp = client.get(first.headers["Location"])
+
+        self.assertEqual(resp.json["data"]["status"], "done")
+        self.assertEqual(resp.json["data"]["result"]["inserted"], 1)
+        self.assertIsNotNone(User.query.filter_by(first_name="Queued").first())
+
+
+    def test_job_retry_and_failure(self):
+        """ Check that failing jobs back off, retry, and fail after the last attempt"""
+        from jobs import TASKS, enqueue, run_pending
+
+        calls = []
+        def flaky(fail_times):
+            calls.append(1)
+            if len(calls) <= fail_times:
+                raise RuntimeError("boom")
+            return len(calls)
+
+        TASKS['flaky'] = flaky
+        self.addCleanup(TASKS.pop, 'flaky')
+        self.addCleanup(app.config.pop, 'JOB_MAX_ATTEMPTS', None)
+
+        with app.app_context():
+            job_id = enqueue('flaky', fail_times=1)
+            db.session.commit()
+
+            self.assertEqual(run_pending(), 1)
+            job = Job.query.get(job_id)
+            self.assertEqual((job.status, job.attempts, job.last_error),
+                             ("queued", 1, "RuntimeError: boom"))
+            self.assertGreater(job.run_at, datetime.datetime.utcnow())
+            self.assertEqual(run_pending(), 0)
+
+            job.run_at = datetime.datetime.utcnow()
+            db.session.commit()
+            self.assertEqual(run_pending(), 1)
+            self.assertEqual((Job.query.get(job_id).status, Job.query.get(job_id).result), ("done", 2))
+
+            app.config['JOB_MAX_ATTEMPTS'] = 1
+            job_id = enqueue('flaky', fail_times=99)
+            db.session.commit()
+            run_pending()
+            self.assertEqual(Job.query.get(job_id).status, "failed")
+
+
+    def test_job_dropped_with_rolled_back_write(self):
+        """ Check that a job enqueued in a rolled back transaction never runs"""
+        from jobs import enqueue
+
+        enqueue('import', kind='users', body='', fmt='ndjson')
+        db.session.rollback()
+        self.assertEqual(Job.query.count(), 0)
+
+###########################################################################
+
+# Tests for association updates
+
+    def edit_tag_statements(self, data):
+        """ Return SQL statements run by posting data to the sample tag's edit form"""
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.test_client() as client:
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = client.post(f"/tags/{self.tag_id}/edit", data=data)
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+
+        self.assertEqual(resp.status_code, 302)
+        return statements
+
+
+    def test_tag_rename_skips_collection(self):
+        """ Check that renaming a tag costs the same however many posts it has"""
+        self.add_tagged_posts(2)
+        post_ids = [post.id for post in Tag.query.get(self.tag_id).posts]
+        small = self.edit_tag_statements({"name": "Renamed", "posts": post_ids})
+
+        for i in range(30):
+            db.session.add(Post(title=f"More{i}", content="x", user_id=self.user_id,
+                                tags=[Tag.query.get(self.tag_id)]))
+        db.session.commit()
+        post_ids = [post.id for post in Tag.query.get(self.tag_id).posts]
+        large = self.edit_tag_statements({"name": "Renamed again", "posts": post_ids})
+
+        self.assertEqual(len(small), len(large))
+        self.assertFalse(any(s.startswith("SELECT posts.") for s in large))
+        self.assertEqual(Tag.query.get(self.tag_id).posts.count(), 32)
+
+
+    def test_association_delta(self):
+        """ Check that only the changed links are written and counters follow"""
+        from associations import set_post_tags
+
+        tags = [Tag(name=f"Delta{i}") for i in range(3)]
+        db.session.add_all(tags)
+        db.session.commit()
+        post = Post.query.get(self.post_id)
+
+        added, removed = set_post_tags(post, [tags[0].id, tags[1].id, 999999])
+        db.session.commit()
+        self.assertEqual((sorted(added), removed), (sorted([tags[0].id, tags[1].id]), []))
+
+        added, removed = set_post_tags(post, [tags[1].id, tags[2].id])
+        db.session.commit()
+        self.assertEqual((added, removed), ([tags[2].id], [tags[0].id]))
+        self.assertEqual(sorted(tag.name for tag in post.tags), ["Delta1", "Delta2"])
+        self.assertEqual(post.tag_count, 2)
+        self.assertEqual([Tag.query.get(tag.id).post_count for tag in tags], [0, 1, 1])
+
+###########################################################################
+
+# Tests for typeahead pickers
+
+    def test_typeahead(self):
+        """ Check that typeahead matches prefixes case-insensitively and literally"""
+        db.session.add_all([Tag(name="Python"), Tag(name="pytest"), Tag(name="py%thing"),
+                            Tag(name="Rust")])
+        db.session.commit()
+
+        with app.test_client() as client:
+            labels = [row["label"] for row in client.get("/api/v1/tags/typeahead?q=PY").json["data"]]
+            self.assertEqual(labels, ["py%thing", "pytest", "Python"])
+            labels = [row["label"] for row in client.get("/api/v1/tags/typeahead?q=py%").json["data"]]
+            self.assertEqual(labels, ["py%thing"])
+            self.assertEqual(len(client.get("/api/v1/tags/typeahead?q=p&limit=1").json["data"]), 1)
+            posts = client.get("/api/v1/posts/typeahead?q=test").json["data"]
+            self.assertEqual(posts, [{"id": self.post_id, "label": "TestPost"}])
+
+        import queries
+        plan = self.explain(queries.typeahead(Tag.name, "py", 10))
+        self.assertIn("ix_tags_name_prefix", plan)
+
+
+    def test_edit_tag_form_lists_only_tagged_posts(self):
+        """ Check that the tag edit form preloads only the tag's posts"""
+        post = Post.query.get(self.post_id)
+        post.tags.append(Tag.query.get(self.tag_id))
+        db.session.add(Post(title="Untagged", content="x", user_id=self.user_id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            html = client.get(f"/tags/{self.tag_id}/edit").get_data(as_text=True)
+
+        self.assertIn("TestPost", html)
+        self.assertNotIn("Untagged", html)
+        self.assertIn('data-source="/api/v1/posts/typeahead"', html)
+
+###########################################################################
+
+# Tests for read replica routing
+
+    def use_replicas(self, *urls):
+        """ Route GET requests to replicas at urls for the rest of the test"""
+        from models import ReplicaSet
+
+        replicas = ReplicaSet(urls, check_interval=60)
+        app.extensions['replicas'] = replicas
+        self.addCleanup(app.extensions.pop, 'replicas')
+        return replicas
+
+
+    def test_replica_routing(self):
+        """ Check that GETs read from a replica, and writers read from the primary for a while"""
+        replicas = self.use_replicas(app.config['SQLALCHEMY_DATABASE_URI'])
+        replica = QueryCounter()
+        event.listen(replicas.engines[0], "before_cursor_execute", replica._count)
+        self.addCleanup(event.remove, replicas.engines[0], "before_cursor_execute", replica._count)
+
+        with app.test_client() as client:
+            with QueryCounter() as primary:
+                client.get(f"/posts/{self.post_id}", headers={"Cache-Control": "no-cache"})
+            self.assertEqual(primary.count, 0)
+            self.assertGreater(replica.count, 0)
+
+            client.post(f"/users/{self.user_id}/edit",
+                        data={"first_name": "A", "last_name": "B", "image_url": ""})
+            before = replica.count
+            with QueryCounter() as primary:
+                client.get(f"/users/{self.user_id}")
+            self.assertGreater(primary.count, 0)
+            self.assertEqual(replica.count, before)
+
+
+    def test_request_reads_one_replica(self):
+        """ Check that every read of a request goes to the same replica"""
+        from cache import page_cache
+
+        url = app.config['SQLALCHEMY_DATABASE_URI']
+        replicas = self.use_replicas(url, url)
+        counters = [QueryCounter(), QueryCounter()]
+        for engine, counter in zip(replicas.engines, counters):
+            event.listen(engine, "before_cursor_execute", counter._count)
+            self.addCleanup(event.remove, engine, "before_cursor_execute", counter._count)
+
+        with app.test_client() as client:
+            for _ in range(2):
+                page_cache.invalidate()
+                before = [counter.count for counter in counters]
+                client.get(f"/users/{self.user_id}")
+                ran = sorted(counter.count - start for counter, start in zip(counters, before))
+                self.assertEqual(ran[0], 0)
+                self.assertGreater(ran[1], 1)
+
+
+    def test_unhealthy_replica_falls_back_to_primary(self):
+        """ Check that reads go to the primary when no replica is healthy"""
+        replicas = self.use_replicas("postgresql:///no_such_database")
+
+        with app.test_client() as client:
+            resp = client.get("/users")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(replicas.status()[0][1], False)
+
+###########################################################################
+
+# Tests for tag timelines
+
+    def test_tag_timeline_order(self):
+        """ Check that tag pages list posts newest first from the timeline, whatever their ids"""
+        from associations import set_tag_posts
+
+        tag = Tag.query.get(self.tag_id)
+        old = Post(title="Old", content="x", user_id=self.user_id,
+                   created_at=datetime.datetime(2001, 1, 1), tags=[tag])
+        new = Post(title="New", content="x", user_id=self.user_id,
+                   created_at=datetime.datetime(2030, 1, 1))
+        db.session.add_all([new, old])
+        db.session.commit()
+        set_tag_posts(tag, [old.id, new.id, self.post_id])
+        db.session.commit()
+
+        stamps = dict(db.session.query(PostTag.post_id, PostTag.created_at))
+        self.assertEqual(stamps[old.id], datetime.datetime(2001, 1, 1))
+        self.assertEqual(stamps[new.id], datetime.datetime(2030, 1, 1))
+
+        app.config['PAGE_SIZE'] = 2
+        try:
+            with app.test_client() as client:
+                html = client.get(f"/tags/{self.tag_id}").get_data(as_text=True)
+                titles = re.findall(r'<a href="/posts/\d+">([^<]+)</a>', html)
+                cursor = re.search(r'href="([^"]+)">Next', html).group(1).replace("&amp;", "&")
+                html = client.get(f"/tags/{self.tag_id}{cursor}").get_data(as_text=True)
+                titles += re.findall(r'<a href="/posts/\d+">([^<]+)</a>', html)
+        finally:
+            app.config['PAGE_SIZE'] = 50
+
+        self.assertEqual([t.strip() for t in titles], ["New", "TestPost", "Old"])
+
+###########################################################################
+
+# Tests for the async ASGI mode
+
+    def asgi_requests(self, requests):
+        """ Send (method, path, body) requests to the ASGI app; return (status, html) of each"""
+        import asyncio
+        from asgi import AsyncReads, send_request
+
+        reads = AsyncReads(app)
+        form = [("Content-Type", "application/x-www-form-urlencoded")]
+
+        async def send_all():
+            try:
+                return [await send_request(reads, method, path, body, form)
+                        for method, path, body in requests]
+            finally:
+                await reads.engine.dispose()
+
+        return [(status, body.decode()) for status, body in asyncio.run(send_all())]
+
+    def test_asgi_reads_match_flask_views(self):
+        """ Check that the async read routes render the same pages as the Flask views"""
+        post = Post.query.get(self.post_id)
+        post.tags = [Tag.query.get(self.tag_id)]
+        db.session.commit()
+
+        paths = ["/", f"/posts/{self.post_id}", "/users", "/users?sort=popular",
+                 f"/users/{self.user_id}", "/tags", f"/tags/{self.tag_id}"]
+        responses = self.asgi_requests([("GET", path, b"") for path in paths])
+
+        with app.test_client() as client:
+            for path, (status, html) in zip(paths, responses):
+                self.assertEqual(status, 200)
+                self.assertEqual(html, client.get(path).get_data(as_text=True), path)
+
+    def test_asgi_errors_and_writes(self):
+        """ Check that the ASGI app returns 404s and 400s and hands writes to Flask"""
+        (missing, _), (bad_cursor, _), (created, _) = self.asgi_requests([
+            ("GET", "/posts/0", b""),
+            ("GET", f"/users/{self.user_id}?cursor=nonsense", b""),
+            ("POST", "/users/new", b"first_name=Async&last_name=Writer&image_url="),
+        ])
+        (post_list, _), (delete_user, _), (head_user, _) = self.asgi_requests([
+            ("POST", "/users", b""),
+            ("DELETE", f"/users/{self.user_id}", b""),
+            ("HEAD", f"/users/{self.user_id}", b""),
+        ])
+
+        self.assertEqual(post_list, 405)
+        self.assertEqual(delete_user, 405)
+        self.assertEqual(head_user, 200)
+        self.assertEqual(missing, 404)
+        self.assertEqual(bad_cursor, 400)
+        self.assertEqual(created, 302)
+        self.assertEqual(User.query.filter_by(first_name="Async").count(), 1)
+
+###########################################################################
+
+# Tests for templates and compression
+
+    def test_templates_trimmed_and_precompiled(self):
+        """ Check that block tags leave no blank lines and compile fills the bytecode cache"""
+        import os
+        import tempfile
+        from flask import Flask
+        from templating import configure_templates, templates_cli
+
+        rendered = app.jinja_env.from_string(
+            "<ul>\n  {% for i in [1, 2] %}\n  <li>{{ i }}</li>\n  {% endfor %}\n</ul>").render()
+        self.assertEqual(rendered, "<ul>\n  <li>1</li>\n  <li>2</li>\n</ul>")
+
+        # A bare app, as a second Blogly app would rebind db
+        def bare_app(cache_dir):
+            fresh = Flask(__name__)
+            fresh.config['TEMPLATE_CACHE_DIR'] = cache_dir
+            configure_templates(fresh)
+            fresh.cli.add_command(templates_cli)
+            return fresh
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            fresh = bare_app(cache_dir)
+            result = fresh.test_cli_runner().invoke(args=['templates', 'compile'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertEqual(len(os.listdir(cache_dir)), len(fresh.jinja_env.list_templates()))
+
+        result = bare_app(None).test_cli_runner().invoke(args=['templates', 'compile'])
+        self.assertEqual(result.exit_code, 1)
+
+    def test_compressed_responses(self):
+        """ Check that pages are gzipped for clients accepting it and still answer conditional GETs"""
+        import gzip
+
+        app.config['COMPRESS_RESPONSES'] = True
+        try:
+            with app.test_client() as client:
+                plain = client.get("/users")
+                self.assertNotIn("Content-Encoding", plain.headers)
+                self.assertIn("Accept-Encoding", plain.headers["Vary"])
+
+                resp = client.get("/users", headers={"Accept-Encoding": "gzip, deflate"})
+                self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+                self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+                resp = client.get(f"/posts/{self.post_id}", headers={"Accept-Encoding": "gzip"})
+                self.assertTrue(resp.headers["ETag"].startswith('W/'))
+                again = client.get(f"/posts/{self.post_id}",
+                                   headers={"Accept-Encoding": "gzip",
+                                            "If-None-Match": resp.headers["ETag"]})
+                self.assertEqual(again.status_code, 304)
+                self.assertNotIn("Content-Encoding", again.headers)
+        finally:
+            app.config['COMPRESS_RESPONSES'] = False
+
+###########################################################################
+
+# Tests for idempotent creates and optimistic locking
+
+    def test_resubmitted_create_form_creates_once(self):
+        """ Check that a create form submitted twice adds one post, and duplicate titles get a 409"""
+        with app.test_client() as client:
+            html = client.get(f"/users/{self.user_id}/posts/new").get_data(as_text=True)
+            token = re.search(r'name="idempotency_key" value="(\w+)"', html).group(1)
+            data = {"title": "Once", "content": "x", "idempotency_key": token}
+
+            first = client.post(f"/users/{self.user_id}/posts/new", data=data)
+            second = client.post(f"/users/{self.user_id}/posts/new", data=data,
+                                 follow_redirects=True)
+            self.assertEqual(first.status_code, 302)
+            self.assertIn("That form was already submitted.", second.get_data(as_text=True))
+            self.assertEqual(Post.query.filter_by(title="Once").count(), 1)
+            self.assertEqual(User.query.get(self.user_id).post_count, 1)
+
+            data["idempotency_key"] = "another-token"
+            resp = client.post(f"/users/{self.user_id}/posts/new", data=data)
+            self.assertEqual(resp.status_code, 409)
+            self.assertIn("A post with that title already exists.", resp.get_data(as_text=True))
+
+            # The failed submission released its token
+            data["title"] = "Twice"
+            self.assertEqual(client.post(f"/users/{self.user_id}/posts/new", data=data).status_code, 302)
+
+    def test_stale_edit_form_conflicts(self):
+        """ Check that saving an edit form rendered before another save returns 409"""
+        with app.test_client() as client:
+            html = client.get(f"/posts/{self.post_id}/edit").get_data(as_text=True)
+            version = re.search(r'name="version" value="(\d+)"', html).group(1)
+
+            # A tags-only edit still counts as a change
+            client.post(f"/posts/{self.post_id}/edit",
+                        data={"title": "TestPost", "content": "Blogly1234",
+                              "tags": [self.tag_id], "version": version})
+            resp = client.post(f"/posts/{self.post_id}/edit",
+                               data={"title": "Overwrite", "content": "x", "version": version})
+
+            self.assertEqual(resp.status_code, 409)
+            self.assertIn("Someone else saved changes", resp.get_data(as_text=True))
+            post = Post.query.get(self.post_id)
+            self.assertEqual((post.title, post.version, len(post.tags)), ("TestPost", 2, 1))
+
+
+    def test_related_posts(self):
+        """ Check that related posts rank by shared tags and tag_pairs follows every write"""
+        from cache import page_cache
+        from related import rebuild_tag_pairs
+        from models import TagPair
+
+        def pairs():
+            return sorted(db.session.query(TagPair.tag_id, TagPair.other_id, TagPair.posts)
+                          .filter(TagPair.posts > 0))
+
+        a, b, c = self.tag_id, *[Tag(name=name) for name in ("B", "C")]
+        db.session.add_all([b, c])
+        db.session.commit()
+        b, c = b.id, c.id
+
+        with app.test_client() as client:
+            client.post(f"/posts/{self.post_id}/edit",
+                        data={"title": "TestPost", "content": "x", "tags": [a, b]})
+            for title, tags in (("Both", [a, b]), ("OnlyA", [a]), ("BAndC", [b, c]),
+                                ("OnlyC", [c]), ("Untagged", [])):
+                client.post(f"/users/{self.user_id}/posts/new",
+                            data={"title": title, "content": "x", "tags": tags})
+
+            html = client.get(f"/posts/{self.post_id}").get_data(as_text=True)
+
+            # Without flashes the fingerprint runs too, sharing the page's lookup
+            page_cache.invalidate()
+            statements = []
+            record = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                self.assertEqual(client.get(f"/posts/{self.post_id}").status_code, 200)
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+            self.assertEqual(len([s for s in statements if "FROM tag_pairs" in s]), 1)
+            self.assertTrue([s for s in statements if "updated_at" in s])
+
+            related = html.split("Related posts")[1]
+            titles = re.findall(r'<a href="/posts/\d+">([^<]+)</a>', related)
+            # BAndC and OnlyA share one tag; b goes with a, and BAndC is newer
+            self.assertEqual(titles, ["Both", "BAndC", "OnlyA", "OnlyC"])
+
+            counted = pairs()
+            self.assertIn((a, b, 2), counted)
+            self.assertIn((b, c, 1), counted)
+
+            both = Post.query.filter_by(title="Both").one()
+            client.post(f"/tags/{c}/edit", data={"name": "C", "posts": [both.id]})
+            client.post(f"/posts/{both.id}/delete")
+            client.post(f"/tags/{b}/delete")
+
+        counted = pairs()
+        rebuild_tag_pairs()
+        db.session.commit()
+        self.assertEqual(counted, pairs())
+
+
+    def test_tag_pairs_count_concurrent_links(self):
+        """ Check that transactions tagging one post at once count the pair between their tags"""
+        import threading
+        from models import TagPair
+
+        other = Tag(name="Other")
+        db.session.add(other)
+        db.session.commit()
+        tags = (self.tag_id, other.id)
+        links = PostTag.__table__
+
+        def pairs():
+            db.session.rollback()
+            return sorted(db.session.query(TagPair.tag_id, TagPair.other_id, TagPair.posts))
+
+        def race(statement):
+            """Run statement(tags[0]) and statement(tags[1]) in overlapping transactions"""
+            with db.engine.connect() as first:
+                with first.begin():
+                    first.execute(statement(tags[0]))
+                    second = threading.Thread(target=lambda: db.engine.execute(statement(tags[1])))
+                    second.start()
+                    second.join(0.5)
+                    # The second waits for the first to commit
+                    self.assertTrue(second.is_alive())
+            second.join()
+
+        race(lambda tag_id: links.insert().values(post_id=self.post_id, tag_id=tag_id))
+        self.assertEqual(pairs(), sorted([(*tags, 1), (*reversed(tags), 1)]))
+
+        race(lambda tag_id: links.delete().where(links.c.post_id == self.post_id,
+                                                 links.c.tag_id == tag_id))
+        self.assertEqual(pairs(), sorted([(*tags, 0), (*reversed(tags), 0)]))
+
+
+    def test_archived_posts_stay_readable(self):
+        """ Check that archived posts leave posts but still show, from archived_posts and from files"""
+        import tempfile
+        from archive import archive_posts, export_archive, partition_months
+        from counters import reconcile_counts
+        from models import ArchivedPost, ArchiveFile
+
+        old = Post(title="OldPost", content="From 2001", user_id=self.user_id,
+                   created_at=datetime.datetime(2001, 3, 5), tags=[Tag.query.get(self.tag_id)])
+        db.session.add(old)
+        db.session.commit()
+        old_id = old.id
+        reconcile_counts()
+        db.session.commit()
+
+        cutoff = datetime.date(2002, 1, 1)
+        self.assertEqual(archive_posts(cutoff), {datetime.date(2001, 3, 1): 1})
+        self.assertIsNone(Post.query.get(old_id))
+        self.assertEqual(set(reconcile_counts().values()), {0})
+        self.assertEqual(ArchivedPost.query.filter_by(id=old_id).one().tags, ["TestTag"])
+
+        with app.test_client() as client:
+            html = client.get(f"/posts/{old_id}").get_data(as_text=True)
+            self.assertIn("OldPost", html)
+            self.assertIn(f'<a href="/tags/{self.tag_id}">', html)
+            self.assertIn("This post is archived", html)
+
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                self.assertEqual(export_archive(cutoff, directory), {datetime.date(2001, 3, 1): 1})
+                self.assertEqual(partition_months(), [])
+
+                with app.test_client() as client:
+                    resp = client.get(f"/posts/{old_id}")
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIn("OldPost", resp.get_data(as_text=True))
+                    self.assertEqual(client.get(f"/posts/{old_id + 1000}").status_code, 404)
+
+                (status, html), = self.asgi_requests([("GET", f"/posts/{old_id}", b"")])
+                self.assertEqual(status, 200)
+                self.assertIn("This post is archived", html)
+            finally:
+                ArchiveFile.query.delete()
+                db.session.commit()
+
+
+    def test_identity_cache(self):
+        """ Check that user and tag display data is served from memory until a write changes it"""
+        from counters import adjust_counts
+        from identity import identities
+
+        self.assertEqual(identities.user(self.user_id).full_name, "TestUser  TestLastName")
+        self.assertEqual(list(identities.tags([self.tag_id, -1])), [self.tag_id])
+
+        # Counter updates leave display data alone
+        adjust_counts(User.post_count, [self.user_id], 1)
+        adjust_counts(Tag.post_count, [self.tag_id], 1)
+        db.session.commit()
+        with QueryCounter() as counter:
+            self.assertEqual(identities.user(self.user_id).first_name, "TestUser")
+            self.assertEqual(identities.tags_starting_with("test", 5)[0].name, "TestTag")
+        self.assertEqual(counter.count, 0)
+
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        with app.test_client() as client:
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                client.post(f"/users/{self.user_id}/posts/new",
+                            data={"title": "Cached", "content": "x", "tags": [self.tag_id]})
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+            self.assertFalse([s for s in statements
+                              if s.startswith("SELECT") and re.search(r"FROM (users|tags)\b", s)])
+            self.assertEqual([tag.id for tag in Post.query.filter_by(title="Cached").one().tags],
+                             [self.tag_id])
+
+            client.post(f"/users/{self.user_id}/edit",
+                        data={"first_name": "Renamed", "last_name": "User", "image_url": ""})
+            client.post(f"/tags/{self.tag_id}/edit", data={"name": "Retagged"})
+            labels = client.get("/api/v1/tags/typeahead?q=re").json["data"]
+
+        self.assertEqual(identities.user(self.user_id).full_name, "Renamed  User")
+        self.assertEqual(labels, [{"id": self.tag_id, "label": "Retagged"}])
+
+    def test_new_post_keeps_tags_the_cache_has_not_seen(self):
+        """ Check that a tag created behind the identity cache's back is linked, and a bogus one refused"""
+        from identity import identities
+
+        identities.tags([self.tag_id])
+        with db.engine.begin() as conn:
+            other_id = conn.execute(Tag.__table__.insert()
+                                    .values(name="Elsewhere").returning(Tag.id)).scalar()
+        self.assertEqual(set(identities.tags([self.tag_id, other_id])), {self.tag_id, other_id})
+
+        with app.test_client() as client:
+            resp = client.post(f"/users/{self.user_id}/posts/new",
+                               data={"title": "Both", "content": "x",
+                                     "tags": [self.tag_id, other_id]})
+            self.assertEqual(resp.status_code, 302)
+            resp = client.post(f"/users/{self.user_id}/posts/new",
+                               data={"title": "Bogus", "content": "x", "tags": [other_id + 1000]})
+            self.assertEqual(resp.status_code, 409)
+
+        self.assertEqual(sorted(tag.id for tag in Post.query.filter_by(title="Both").one().tags),
+                         sorted([self.tag_id, other_id]))
+        self.assertIsNone(Post.query.filter_by(title="Bogus").first())
+
+    def test_rate_limits_and_admission(self):
+        """ Check that bursts get 429 per client and a full worker sheds requests with 503"""
+        from ratelimit import limiter, rate_limited_total, shed_total
+
+        limited = rate_limited_total.value(rule="write")
+        shed = shed_total.value(limit="writes")
+        app.config.update(RATELIMIT_ENABLED=True, RATELIMIT_WRITE_BURST=2,
+                          RATELIMIT_WRITE_RATE=0.01, ADMISSION_MAX_REQUESTS=2,
+                          ADMISSION_MAX_WRITES=1, ADMISSION_TIMEOUT=0.05)
+        try:
+            with app.test_client() as client:
+                bot = {"environ_base": {"REMOTE_ADDR": "203.0.113.7"}}
+                for name in ("Burst1", "Burst2", "Burst3"):
+                    resp = client.post("/tags/new", data={"name": name}, **bot)
+                self.assertEqual(resp.status_code, 429)
+                self.assertGreater(int(resp.headers["Retry-After"]), 0)
+                self.assertEqual(client.post("/api/v1/tags/import", data=b"", **bot).json["error"],
+                                 "Too Many Requests")
+                self.assertEqual(rate_limited_total.value(rule="write"), limited + 2)
+                self.assertIsNone(Tag.query.filter_by(name="Burst3").first())
+
+                # Other clients and reads are not limited
+                self.assertEqual(client.post("/tags/new", data={"name": "Other"}).status_code, 302)
+                self.assertEqual(client.get("/tags", **bot).status_code, 200)
+
+                # A write in flight fills the write limit, but not the reads'
+                self.assertIsNone(limiter.gate.enter(True, 2, 1, 0))
+                try:
+                    resp = client.post("/tags/new", data={"name": "Shed"})
+                    self.assertEqual(resp.status_code, 503)
+                    self.assertEqual(resp.headers["Retry-After"], "1")
+                    self.assertEqual(client.get("/tags").status_code, 200)
+                    self.assertIn('blogly_requests_in_flight 1',
+                                  client.get("/metrics").get_data(as_text=True))
+                finally:
+                    limiter.gate.leave(True)
+                self.assertEqual(shed_total.value(limit="writes"), shed + 1)
+                self.assertEqual(limiter.gate.requests, 0)
+        finally:
+            app.config.update(RATELIMIT_ENABLED=False, ADMISSION_MAX_REQUESTS=0,
+                              ADMISSION_MAX_WRITES=0)
@@ -0,0 +1,386 @@
+"""Blogly HTML views."""
+
+import datetime
+
+from flask import Blueprint, request, render_template, redirect, flash
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from models import db, User, Post, Tag, PostTag
+from cache import page_cache
+from conditional import conditional
+import queries
+from search import search_posts
+from counters import adjust_counts
+from associations import set_post_tags, set_tag_posts
+from idempotency import idempotent
+
+views = Blueprint('views', __name__)
+
+
+@views.route('/')
+@conditional(queries.home_fingerprint, last_modified=False)
+@page_cache.cached
+def home():
+  """Show home page"""
+  posts = queries.recent_posts(5)
+  return render_template('posts/homepage.html', posts=posts)
+
+
+@views.app_errorhandler(404)
+def page_not_found(e):
+    """ Show 404 NOT FOUND page"""
+
+    return render_template('404.html'), 404
+
+
+# Messages for the unique constraints a form can run into
+CONFLICT_MESSAGES = {
+    'posts_title_key': "A post with that title already exists.",
+    'tags_name_key': "A tag with that name already exists.",
+}
+STALE_MESSAGE = "Someone else saved changes to this while you were editing it."
+
+
+def conflict(message):
+    """Return a 409 page explaining why the submitted form was not saved"""
+
+    db.session.rollback()
+    return render_template('409.html', message=message, back=request.path), 409
+
+
+@views.errorhandler(IntegrityError)
+def integrity_conflict(e):
+    constraint = getattr(getattr(e.orig, 'diag', None), 'constraint_name', None)
+    return conflict(CONFLICT_MESSAGES.get(
+        constraint, "That change conflicts with data saved in the meantime."))
+
+
+@views.errorhandler(StaleDataError)
+def stale_conflict(e):
+    return conflict(STALE_MESSAGE)
+
+
+def changed_since_form(row):
+    """Return True if row was saved again after its edit form was rendered"""
+
+    version = request.form.get('version', type=int)
+    return version is not None and version != row.version
+
+
+###########################################################################
+
+# User routes
+
+@views.route('/users')
+def show_all_users():
+    """Show list of all users in database"""
+    popular = request.args.get('sort') == 'popular'
+    users = queries.users_page(popular)
+    return render_template('users/index.html', users=users, popular=popular)
+
+
+@views.route('/users/new', methods=["GET"])
+def show_user_form():
+    """Show form to create new user"""
+    return render_template('users/new.html')
+
+
+@views.route('/users/new', methods=["POST"])
+@idempotent("/users")
+def create_user():
+    """ Handle form submission for new user"""
+
+    first_name = request.form['first_name']
+    last_name = request.form['last_name']
+    image_url = request.form['image_url'] or None
+
+    new_user = User(first_name=first_name, last_name=last_name,        image_url=image_url)
+
+    db.session.add(new_user)
+    db.session.commit()
+    flash(f"User {new_user.full_name} added.")
+
+    return redirect("/users")
+
+
+@views.route('/users/<int:user_id>')
+@conditional(queries.user_fingerprint)
+@page_cache.cached
+def show_user_details(user_id):
+    """Show details about  specific user"""
+
+    user = queries.get_user_or_404(user_id)
+    posts = queries.user_posts(user)
+    return render_template('users/details.html', user=user, posts=posts)
+
+
+@views.route('/users/<int:user_id>/edit')
+def show_edit_page(user_id):
+    """ Show edit form for specific user"""
+    
+    user = User.query.get_or_404(user_id)
+    return render_template('users/edit.html', user=user)
+
+
+@views.route('/users/<int:user_id>/edit', methods=["POST"])
+def update_user_details(user_id):
+    """Handle form submission for updating user details for specific user"""
+
+    user = User.query.get_or_404(user_id)
+    if changed_since_form(user):
+        return conflict(STALE_MESSAGE)
+
+    user.first_name = request.form['first_name']
+    user.last_name = request.form['last_name']
+    user.image_url = request.form['image_url']
+
+    db.session.add(user)
+    db.session.commit()
+    flash(f"User {user.full_name} updated.")
+
+    return redirect('/users')
+
+
+@views.route('/users/<int:user_id>/delete', methods=["POST"])
+def delete_user(user_id):
+    """Handle form submission for deleting user from database"""
+
+    user = User.query.get_or_404(user_id)
+
+    # Tags lose one post for each of this user's posts they labelled,
+    # counted by the database rather than loaded here
+    authored = db.session.query(Post.id).filter(Post.user_id == user_id)
+    tagged = (db.session.query(PostTag.tag_id)
+              .filter(PostTag.post_id.in_(authored))
+              .distinct())
+    lost = (db.select(db.func.count())
+            .where(PostTag.tag_id == Tag.id, PostTag.post_id.in_(authored))
+            .scalar_subquery())
+    adjust_counts(Tag.post_count, tagged, -lost)
+
+    # ON DELETE CASCADE removes the posts and their tag links
+    db.session.delete(user)
+    db.session.commit()
+    flash(f"User {user.full_name} deleted.")
+
+    return redirect('/users')
+
+###########################################################################
+
+# Posts routes
+
+@views.route('/users/<int:user_id>/posts/new', methods=["GET"])
+def show_post_form(user_id):
+    """ Show form to create new post """
+
+    user = queries.get_user_card_or_404(user_id)
+    return render_template('posts/newpost.html', user=user)
+
+
+@views.route('/users/<int:user_id>/posts/new', methods=["POST"])
+@idempotent("/users/{user_id}")
+def create_post(user_id):
+    """ Handle form submission for new post by specific user"""
+
+    # The user is checked against the identity cache and the tags not at
+    # all: a user or tag deleted meanwhile, or a tag id that never
+    # existed, fails the foreign keys and the form gets a 409. A worker's
+    # cache may not have tags created elsewhere yet, so it cannot filter them
+    queries.get_user_card_or_404(user_id)
+    tag_ids = sorted({int(num) for num in request.form.getlist('tags')})
+
+    title = request.form['title']
+    content = request.form['content']
+
+    new_post = Post(title=title, content=content, user_id=user_id, tag_count=len(tag_ids))
+    db.session.add(new_post)
+    db.session.flush()
+    if tag_ids:
+        db.session.execute(insert(PostTag.__table__),
+                           [{"post_id": new_post.id, "tag_id": tag_id} for tag_id in tag_ids])
+    adjust_counts(User.post_count, [user_id], 1)
+    adjust_counts(Tag.post_count, tag_ids, 1)
+
+    db.session.commit()
+    flash(f"Post titled '{title}' added.")
+
+    return redirect(f"/users/{user_id}")
+
+
+@views.route('/posts/<int:post_id>', methods=["GET"])
+@conditional(queries.post_fingerprint)
+@page_cache.cached
+def show_post(post_id):
+    """ Show a specific post"""
+
+    post = queries.get_post(post_id)
+    if post is None:
+        post, author, tags = queries.get_archived_post_or_404(post_id)
+        return render_template('posts/archived_post.html', post=post, author=author, tags=tags)
+
+    related = queries.related_posts(post)
+    return render_template('posts/post_details.html', post=post, related=related)
+
+
+@views.route('/posts/<int:post_id>/edit', methods=["GET"])
+def show_post_edit_form(post_id):
+    """Show form to edit specific post"""
+
+    post = queries.get_post_or_404(post_id)
+    return render_template('posts/edit_post.html', post=post)
+
+
+@views.route('/posts/<int:post_id>/edit', methods=["POST"])
+def update_post(post_id):
+    """Handle form submission for editing specific post"""
+
+    post = Post.query.get_or_404(post_id)
+    if changed_since_form(post):
+        return conflict(STALE_MESSAGE)
+
+    post.title = request.form['title']
+    post.content = request.form['content']
+
+    tag_ids = [int(num) for num in request.form.getlist('tags')]
+    set_post_tags(post, tag_ids)
+    # Always update the row, so a tags-only edit bumps the version too
+    post.updated_at = datetime.datetime.utcnow()
+
+    db.session.add(post)
+    db.session.commit()
+    flash(f"Post '{post.title}' updated.")
+
+    return redirect(f"/posts/{post_id}")   
+
+
+@views.route('/posts/<int:post_id>/delete', methods=["POST"])
+def delete_post(post_id):
+    """ Delete specific post """
+
+    post = Post.query.get_or_404(post_id)
+
+    # The author's and tags' pages no longer list the post
+    adjust_counts(User.post_count, [post.user_id], -1)
+    tagged = db.session.query(PostTag.tag_id).filter(PostTag.post_id == post_id)
+    adjust_counts(Tag.post_count, tagged, -1)
+
+    db.session.delete(post)
+    db.session.commit()
+    flash(f"Post '{post.title}' deleted.")
+
+    return redirect(f"/users/{post.user_id}")
+
+@views.route('/search')
+def search():
+    """Show posts matching search terms, optionally within a tag or by a user"""
+
+    terms = request.args.get('q', '').strip()
+    tag_id = request.args.get('tag', type=int)
+    user_id = request.args.get('user', type=int)
+
+    page, posts, snippets = None, [], {}
+    if terms:
+        page, posts, snippets = search_posts(terms, tag_id=tag_id, user_id=user_id)
+
+    return render_template('posts/search.html', terms=terms, tag_id=tag_id,
+                           user_id=user_id, page=page, posts=posts,
+                           snippets=snippets)
+
+#################################################################
+
+# Tags routes
+
+@views.route('/tags')
+def show_all_tags():
+    """Show list of all tags"""
+
+    popular = request.args.get('sort') == 'popular'
+    tags = queries.tags_page(popular)
+    return render_template('tags/index.html', tags=tags, popular=popular)
+
+
+@views.route('/tags/<int:tag_id>', methods=["GET"])
+@conditional(queries.tag_fingerprint)
+@page_cache.cached
+def show_tag(tag_id):
+    """ Show a specific tag"""
+
+    tag = queries.get_tag_or_404(tag_id)
+    posts = queries.tag_posts(tag)
+    return render_template('tags/tag_details.html', tag=tag, posts=posts)
+
+
+@views.route('/tags/new', methods=["GET"])
+def show_create_tag_form():
+    """Display form to create new tag"""
+
+    return render_template('tags/new.html')
+
+
+@views.route('/tags/new', methods=["POST"])
+@idempotent("/tags")
+def create_tag():
+    """ Handle form submission for creating new tag"""
+
+    post_ids = [int(num) for num in request.form.getlist('posts')]
+    posts = Post.query.filter(Post.id.in_(post_ids)).all()
+    name = request.form['name']
+
+    new_tag = Tag(name=name, posts=posts, post_count=len(posts))
+    adjust_counts(Post.tag_count, [post.id for post in posts], 1)
+
+    db.session.add(new_tag)
+    db.session.commit()
+
+    flash(f"New tag '{new_tag.name}' added.")
+
+    return redirect('/tags')
+
+
+@views.route('/tags/<int:tag_id>/edit', methods=["GET"])
+def show_edit_tag_form(tag_id):
+    """ Display form to edit tag"""
+
+    tag = queries.get_tag_or_404(tag_id)
+    posts = queries.tag_post_choices(tag)
+    return render_template('tags/edit.html', tag=tag, posts=posts)
+
+
+@views.route('/tags/<int:tag_id>/edit', methods=["POST"])
+def edit_tag(tag_id):
+    """Handle form submission for editing tag """
+
+    tag = Tag.query.get_or_404(tag_id)
+    if changed_since_form(tag):
+        return conflict(STALE_MESSAGE)
+
+    tag.name= request.form['name']
+
+    post_ids = [int(num) for num in request.form.getlist("posts")]
+    set_tag_posts(tag, post_ids)
+    # Always update the row, so a posts-only edit bumps the version too
+    tag.updated_at = datetime.datetime.utcnow()
+
+    db.session.add(tag)
+    db.session.commit()
+    flash(f"Tag name has been updated to '{tag.name}' ")
+
+    return redirect('/tags')
+
+
+@views.route('/tags/<int:tag_id>/delete', methods=["POST"])
+def delete_tag(tag_id):
+    """Handle form submission for deleting tag """
+
+    tag = Tag.query.get_or_404(tag_id)
+
+    # Pages of the posts it labelled no longer show it
+    tagged = db.session.query(PostTag.post_id).filter(PostTag.tag_id == tag_id)
+    adjust_counts(Post.tag_count, tagged, -1)
+
+    db.session.delete(tag)
+    db.session.commit()
+    flash(f"Tag named '{tag.name}' deleted.")
+
+    return redirect('/tags')
\ No newline at end of file